@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+import sys, getopt
+from os import path
+sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
+import itertools
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import subprocess
+import time
+from datetime import datetime
+import numpy as np
+import tracing
+import util
+from pphtm.pphtm_brain import PPHTMBrain
+from pphtm.pphtm_predictor import PPHTMPredictor
+from encoders import SimpleFullWidthEncoder
+
+# Scaling benchmark for PPHTM step throughput
+#
+# Builds seeded brains over a grid of configs, streams a data file through
+# each (first with learning, then inference only, then learning with a
+# PPHTMPredictor lookahead after every step) and writes one JSON result per
+# config/dataset: init time, steps/s, per-phase step time (brain.stats()),
+# mean predictor call time and inference snapshot rebuilds while learning,
+# and peak RSS, plus the brain's memory_report() totals. Each run happens in
+# a fresh process so peak RSS is per run (the "memory" grid varies region size
+# only, for peak RSS versus region size).
+#
+#   python bench_pphtm.py -g quick -s 200 -o before.json
+#   python bench_pphtm.py -g full -d hamlet -o after.json
+#   python bench_pphtm.py -g memory -s 20 -o memory.json
+#   python bench_pphtm.py -g binary -d hamlet -o binary.json
+
+VERBOSITY = 1
+DATA_DIR = path.join(path.dirname(path.dirname(path.abspath(__file__))), "data")
+SEED = 1
+PREDICT_HORIZON = 3  # Steps of predict_distribution() lookahead in the learn_predict mode
+
+# Dataset name -> (file, format). "cats" files hold the category list on the
+# first line and the sequence on the second (see FileProcesser), "text" files
+# are free text reduced to letters A-Z.
+DATASETS = {
+    "longer_char_sequences2": ("longer_char_sequences2.txt", "cats"),
+    "hamlet": ("hamlet.txt", "text")
+}
+
+# Grid name -> config key -> values. Every combination is benchmarked.
+GRIDS = {
+    "quick": {
+        "CELLS_PER_REGION": [7**2, 14**2],
+        "N_REGIONS": [1, 2],
+        "DISTAL_SEGMENTS": [3],
+        "DISTAL_SYNAPSE_CHANCE": [0.4]
+    },
+    "full": {
+        "CELLS_PER_REGION": [7**2, 14**2, 20**2, 30**2, 40**2],
+        "N_REGIONS": [1, 2, 3],
+        "DISTAL_SEGMENTS": [2, 3, 4],
+        "DISTAL_SYNAPSE_CHANCE": [0.2, 0.4]
+    },
+    "binary": {
+        "CELLS_PER_REGION": [14**2, 30**2],
+        "N_REGIONS": [1],
+        "DISTAL_SEGMENTS": [3],
+        "DISTAL_SYNAPSE_CHANCE": [0.4],
+        "BINARY_ENGINE": [False, True]
+    },
+    "memory": {
+        "CELLS_PER_REGION": [7**2, 14**2, 20**2, 30**2, 40**2],
+        "N_REGIONS": [1],
+        "DISTAL_SEGMENTS": [3],
+        "DISTAL_SYNAPSE_CHANCE": [0.4]
+    }
+}
+
+
+def load_dataset(name):
+    '''
+    Returns (cats, sequence) of a dataset, sequence uppercase and limited to cats
+    '''
+    filename, format = DATASETS[name]
+    with open(path.join(DATA_DIR, filename), 'r') as f:
+        if format == "cats":
+            cats = f.readline().strip().upper()
+            data = f.readline().strip().upper()
+        else:
+            cats = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+            data = f.read().upper()
+    return (cats, "".join([c for c in data if c in cats]))
+
+
+def grid_configs(grid):
+    keys = sorted(grid.keys())
+    return [dict(zip(keys, values)) for values in itertools.product(*[grid[k] for k in keys])]
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024. * 1024.) if sys.platform == "darwin" else rss / 1024.  # bytes on OS X, KB on Linux
+
+
+def phase_means(stats):
+    '''
+    Per region dict of phase -> mean step time (ms) and mean step time, from brain.stats()
+    '''
+    return [{
+        "step_ms": r["step_ms"],
+        "phases": dict((phase, s["mean"]) for phase, s in r["phases"].items())
+    } for r in stats["regions"]]
+
+
+def run_benchmark(dataset, params, steps=200, seed=SEED):
+    '''
+    Build a seeded brain with params and run `steps` learning steps, then
+    `steps` inference steps over the dataset (wrapping around)
+
+    Returns:
+        dict (JSON-serializable) with timings of this run
+    '''
+    tracing.quiet()
+    cats, data = load_dataset(dataset)
+    n_inputs = len(cats) ** 2
+    encoder = SimpleFullWidthEncoder(n_inputs=n_inputs, n_cats=len(cats))
+    inputs = [encoder.encode_sparse(cats.index(c)) for c in data[:steps * 2]]
+    random.seed(seed)
+    np.random.seed(seed)
+    config = dict(params)
+    config["STATS_HISTORY"] = steps  # Stats window covers exactly one phase of the run
+    start = time.time()
+    b = PPHTMBrain(min_overlap=1, r1_inputs=n_inputs)
+    b.initialize(**config)
+    init_s = time.time() - start
+    result = {
+        "dataset": dataset,
+        "params": params,
+        "seed": seed,
+        "steps": steps,
+        "init_s": init_s
+    }
+    for mode, learning in [("learn", True), ("infer", False)]:
+        start = time.time()
+        for i in range(steps):
+            b.process_sparse(inputs[b.t % len(inputs)], learning=learning)
+        elapsed = time.time() - start
+        result["%s_steps_per_s" % mode] = steps / elapsed if elapsed else None
+        result["%s_regions" % mode] = phase_means(b.stats())
+    # Forks for lookahead share the inference snapshot, which learning steps
+    # update row by row (snapshot_rebuilds stays at 1)
+    predictor = PPHTMPredictor(b, categories=cats)
+    predictor.initialize()
+    predict_s = 0.0
+    start = time.time()
+    for i in range(steps):
+        b.process_sparse(inputs[b.t % len(inputs)], learning=True)
+        predictor.read(data[(b.t - 1) % len(inputs)])
+        clock = time.time()
+        predictor.predict_distribution(horizon=PREDICT_HORIZON)
+        predict_s += time.time() - clock
+    elapsed = time.time() - start
+    result["learn_predict_steps_per_s"] = steps / elapsed if elapsed else None
+    result["predict_ms"] = predict_s * 1000. / steps
+    result["snapshot_rebuilds"] = b.engine.n_rebuilds
+    result["kernel_backend"] = b.kernels.name
+    report = b.memory_report()
+    result["memory"] = {
+        "total_bytes": report["total_bytes"],
+        "synapses": report["synapses"],
+        "bytes_per_synapse": report["total_bytes"] / float(report["synapses"]) if report["synapses"] else None,
+        "kinds": report["kinds"]
+    }
+    result["peak_rss_mb"] = peak_rss_mb()
+    return result
+
+
+def _run_in_child(conn, dataset, params, steps, seed):
+    try:
+        conn.send(("ok", run_benchmark(dataset, params, steps=steps, seed=seed)))
+    except Exception as e:
+        conn.send(("error", repr(e)))
+    conn.close()
+
+
+def run_isolated(dataset, params, steps=200, seed=SEED):
+    '''
+    run_benchmark in a fresh process (so peak RSS is that of this run only)
+    '''
+    parent, child = multiprocessing.Pipe(duplex=False)
+    p = multiprocessing.Process(target=_run_in_child, args=(child, dataset, params, steps, seed))
+    p.start()
+    status, result = parent.recv()
+    p.join()
+    if status != "ok":
+        raise RuntimeError("Benchmark %s %s failed: %s" % (dataset, params, result))
+    return result
+
+
+def environment():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=path.dirname(DATA_DIR)).strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "commit": commit,
+        "date": util.sdatetime(datetime.now()),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform()
+    }
+
+
+def log(message, level=1):
+    if VERBOSITY >= level:
+        print message
+
+
+def main(argv):
+    HELP = 'bench_pphtm.py -g <grid: %s> -s <steps> -d <dataset,...> -o <output.json> [--inline]' % ", ".join(sorted(GRIDS.keys()))
+    try:
+        opts, args = getopt.getopt(argv,"hg:s:d:o:",["grid=","steps=","datasets=","output=","inline"])
+    except getopt.GetoptError:
+        print HELP
+        sys.exit(2)
+    # Defaults
+    grid = "quick"
+    steps = 200
+    datasets = sorted(DATASETS.keys())
+    output = "bench_pphtm.json"
+    run = run_isolated
+    for opt, arg in opts:
+        if opt == '-h':
+            print HELP
+            sys.exit()
+        elif opt in ("-g", "--grid"):
+            grid = arg
+        elif opt in ("-s", "--steps"):
+            steps = int(arg)
+        elif opt in ("-d", "--datasets"):
+            datasets = arg.split(",")
+        elif opt in ("-o", "--output"):
+            output = arg
+        elif opt == "--inline":
+            run = run_benchmark
+    configs = grid_configs(GRIDS[grid])
+    results = []
+    for dataset in datasets:
+        for i, params in enumerate(configs):
+            log("[%s %d/%d] %s" % (dataset, i + 1, len(configs), params))
+            result = run(dataset, params, steps=steps)
+            log("  init %.2fs, learn %.1f steps/s, infer %.1f steps/s, peak RSS %.0f MB (brain %.1f MB)" % (result["init_s"], result["learn_steps_per_s"], result["infer_steps_per_s"], result["peak_rss_mb"], result["memory"]["total_bytes"] / (1024. * 1024.)))
+            results.append(result)
+    with open(output, "w") as f:
+        json.dump({"environment": environment(), "grid": grid, "results": results}, f, indent=2, sort_keys=True)
+    log("Wrote %d results to %s" % (len(results), output))
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
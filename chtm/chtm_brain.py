@@ -4,11 +4,14 @@ import numpy as np
 import random
 import math
 import util
+import tracing
+from tracing import lazy
 from util import printarray
+from permanence_stats import PermanenceStats
 
 # Settings
 
-VERBOSITY = 1
+VERBOSITY = 1  # Initial level of the "chtm" tracer (see tracing.set_level)
 PROXIMAL_ACTIVATION_THRESHHOLD = 2 # Activation threshold for a segment. If the number of active connected synapses in a segment is greater than activationThreshold, the segment is said to be active.
 DISTAL_ACTIVATION_THRESHOLD = 2
 DEF_MIN_OVERLAP = 2
@@ -38,9 +41,8 @@ PROX_SEGMENTS = 2
 SYNAPSE_DECAY = 0.0005
 BOOST_DISTAL = False
 
-def log(message, level=1):
-    if VERBOSITY >= level:
-        print message
+tracer = tracing.get_tracer("chtm", level=VERBOSITY)
+log = tracer.log
 
 class Segment(object):
     '''
@@ -94,8 +96,7 @@ class Segment(object):
                 add_synapse = random.random() < chance_of_synapse
                 if add_synapse:
                     self.add_synapse(index, permanence=0.15)
-        log_message = "Initialized %s" % self
-        log(log_message)
+        log("Initialized %s", self)
 
     def proximal(self):
         return self.type == self.PROXIMAL
@@ -105,6 +106,7 @@ class Segment(object):
             permanence = CONNECTED_PERM + INIT_PERMANENCE_JITTER*(random.random()-0.5)
         self.syn_sources.append(source_index)
         self.syn_permanences.append(permanence)
+        self.region.permanence_stats.add(self.type, permanence)
         self.syn_last_change.append(0)
         self.syn_last_contribution.append(0)
 
@@ -128,7 +130,11 @@ class Segment(object):
         pass
 
     def decay_permanences(self, factor=SYNAPSE_DECAY):
-        self.syn_permanences = [max(p - factor, 0.0) for p in self.syn_permanences]
+        decayed = [max(p - factor, 0.0) for p in self.syn_permanences]
+        for old, new in zip(self.syn_permanences, decayed):
+            if new != old:
+                self.region.permanence_stats.change(self.type, old, new)
+        self.syn_permanences = decayed
 
     def distance_from(self, coords_xy, index=0):
         source_xy = util.coords_from_index(self.syn_sources[index], self.region._input_side_len())
@@ -217,7 +223,7 @@ class Cell(object):
             distal = Segment(self, i, self.region, type=Segment.DISTAL)
             distal.initialize() # Creates synapses
             self.distal_segments.append(distal)
-        log("Initialized %s" % self)
+        log("Initialized %s", self)
 
     def active_segments(self, type=Segment.PROXIMAL):
         segs = self.proximal_segments if type == Segment.PROXIMAL else self.distal_segments
@@ -295,6 +301,7 @@ class Region(object):
         self.active_duty_cycle = np.zeros((self.n_cells))  # Sliding average: how often column c has been active after inhibition (e.g. over the last 1000 iterations).
         self.overlap_duty_cycle = np.zeros((self.n_cells))  # Sliding average: how often column c has had significant overlap (> min_overlap)
         self.last_activation = None  # Hold last step in state for rendering
+        self.permanence_stats = PermanenceStats(CONNECTED_PERM, {Segment.PROXIMAL: "proximal", Segment.DISTAL: "distal"})  # Running synapse aggregates
 
         # Helper constants
         self.diagonal = 1.414*2*math.sqrt(n_cells)
@@ -313,7 +320,7 @@ class Region(object):
             c = Cell(region=self, index=i)
             c.initialize()
             self.cells.append(c)
-        print "Initialized %s" % self
+        log("Initialized %s", self)
 
     def _input_side_len(self):
         return math.sqrt(self.n_inputs)
@@ -384,6 +391,7 @@ class Region(object):
                     source_cell = seg.source_cell(i)
                     if source_cell.excitatory or not excitatory_only:
                         seg.syn_permanences[i] = min([perm+increase, 1.0])
+                        self.permanence_stats.change(seg.type, perm, seg.syn_permanences[i])
 
         if type == "distal" and BOOST_DISTAL:
             # Try also increasing distal segments
@@ -392,6 +400,7 @@ class Region(object):
                     source_cell = seg.source_cell(i)
                     if source_cell.excitatory or not excitatory_only:
                         seg.syn_permanences[i] = min([perm+increase, 1.0])
+                        self.permanence_stats.change(seg.type, perm, seg.syn_permanences[i])
 
     def calculate_distal_biases(self):
         '''
@@ -449,16 +458,17 @@ class Region(object):
             contributor = contribution >= SYNAPSE_ACTIVATION_LEARN_THRESHHOLD
             seg.syn_last_contribution[i] = contribution
             increase_permanence = (is_activating and cell_excitatory and contributor) or (not is_activating and not cell_excitatory and contributor)
-            if increase_permanence and seg.syn_permanences[i] < 1.0:
+            perm = seg.syn_permanences[i]
+            if increase_permanence and perm < 1.0:
                 n_inc += 1
-                seg.syn_permanences[i] += self.permanence_inc
-                seg.syn_permanences[i] = min(1.0, seg.syn_permanences[i])
+                seg.syn_permanences[i] = min(1.0, perm + self.permanence_inc)
                 seg.syn_last_change[i] += 1
-            elif not increase_permanence and seg.syn_permanences[i] > 0.0:
+                self.permanence_stats.change(seg.type, perm, seg.syn_permanences[i])
+            elif not increase_permanence and perm > 0.0:
                 n_dec +=1
-                seg.syn_permanences[i] -= self.permanence_dec
-                seg.syn_permanences[i] = max(0.0, seg.syn_permanences[i])
+                seg.syn_permanences[i] = max(0.0, perm - self.permanence_dec)
                 seg.syn_last_change[i] -= 1
+                self.permanence_stats.change(seg.type, perm, seg.syn_permanences[i])
             connection_changed = was_connected != seg.connected(i)
             if connection_changed:
                 connected = not was_connected
@@ -506,7 +516,7 @@ class Region(object):
                     seg.syn_last_change = [0 for x in seg.syn_last_change]
 
 
-        log("Distal: +%d/-%d (%d connected, %d disconnected)" % (n_increased_dist, n_decreased_dist, n_conn_dist, n_discon_dist))
+        log("Distal: +%d/-%d (%d connected, %d disconnected)", n_increased_dist, n_decreased_dist, n_conn_dist, n_discon_dist)
 
         n_boosted = 0
         all_field_sizes = []
@@ -530,7 +540,7 @@ class Region(object):
             all_field_sizes.append(self.cells[i].connected_receptive_field_size())
 
         if n_boosted:
-            log("Boosting %d due to low overlap duty cycle" % n_boosted)
+            log("Boosting %d due to low overlap duty cycle", n_boosted)
 
         # Update inhibition radius (based on updated active connections in each column)
         self.inhibition_radius = util.average(all_field_sizes) * INHIBITION_RADIUS_DISCOUNT
@@ -548,20 +558,20 @@ class Region(object):
 
         # Phase 1: Calculate Distal Biases (TM?)
         self.bias = self.calculate_distal_biases()
-        log("%s << Bias" % printarray(self.bias, continuous=True), level=2)
+        log("%s << Bias", lazy(printarray, self.bias, continuous=True), level=2)
 
         # Phase 2: Overlap
         self.overlap = self.do_overlap()
-        log("%s << Overlap (normalized)" % printarray(self.overlap, continuous=True), level=2)
+        log("%s << Overlap (normalized)", lazy(printarray, self.overlap, continuous=True), level=2)
 
         # Phase 3: Inhibition
         activating = self.do_inhibition()
-        log("%s << Activating (inhibited)" % printarray(activating, continuous=True), level=2)
+        log("%s << Activating (inhibited)", lazy(printarray, activating, continuous=True), level=2)
 
         # Phase 4: Learning
         if learning_enabled:
-            log("%s << Active Duty Cycle" % printarray(self.active_duty_cycle, continuous=True), level=2)
-            log("%s << Overlap Duty Cycle" % printarray(self.overlap_duty_cycle, continuous=True), level=2)
+            log("%s << Active Duty Cycle", lazy(printarray, self.active_duty_cycle, continuous=True), level=2)
+            log("%s << Overlap Duty Cycle", lazy(printarray, self.overlap_duty_cycle, continuous=True), level=2)
             self.do_learning(activating)
 
         # Update activations
@@ -574,20 +584,12 @@ class Region(object):
             if cell.activation < 0:
                 cell.activation = 0.0
 
-        log("%s << Activations" % self.print_cells(), level=2)
+        log("%s << Activations", lazy(self.print_cells), level=2)
 
-        if VERBOSITY >= 1:
-            # Log average synapse permanence in region
-            permanences = []
-            n_connected = 0
-            n_synapses = 0
-            for cell in self.cells:
-                for seg in cell.distal_segments:
-                    permanences.append(util.average(seg.syn_permanences))
-                    n_synapses += seg.n_synapses()
-                    n_connected += len(filter(lambda x : x > CONNECTED_PERM, seg.syn_permanences))
-            ave_permanence = util.average(permanences)
-            log("R%d - average distal synapse permanence: %.1f (%.1f%% connected of %d)" % (self.index, ave_permanence, (n_connected/float(n_synapses))*100., n_synapses), level=1)
+        if tracer.enabled(1):
+            # Log average synapse permanence in region (running aggregates, see permanence_stats)
+            permanence_stats = self.permanence_stats
+            log("R%d - average distal synapse permanence: %.1f (%.1f%% connected of %d)", self.index, permanence_stats.mean_permanence(Segment.DISTAL), permanence_stats.connected_fraction(Segment.DISTAL)*100., permanence_stats.n_synapses[Segment.DISTAL], level=1)
 
 
 
@@ -614,6 +616,7 @@ class CHTMBrain(object):
         self.n_inputs = r1_inputs
         self.min_overlap = min_overlap # A minimum number of inputs that must be active for a column to be considered during the inhibition step
         self.inputs = None
+        self.profiler = None  # profiling.Profiler wrapping every Nth process() call
 
     def __repr__(self):
         return "<HTMBrain regions=%d>" % len(self.regions)
@@ -625,18 +628,29 @@ class CHTMBrain(object):
             r.initialize()
             n_inputs = cpr  # Next region will have 1 input for each output cell
             self.regions.append(r)
-        print "Initialized %s" % self
+        log("Initialized %s", self)
+
+    def permanence_report(self):
+        '''
+        Returns list (one per region) of synapse aggregates by segment type (see Region.permanence_stats)
+        '''
+        return [r.permanence_stats.summary() for r in self.regions]
 
     def process(self, readings, learning=False):
         '''
         Step through all regions inputting output of each into next
         Returns output of last region
         '''
-        print "~~~~~~~~~~~~~~~~~ Processing inputs at T%d" % self.t
+        if self.profiler is not None:
+            return self.profiler.call(self._process, readings, learning=learning)
+        return self._process(readings, learning=learning)
+
+    def _process(self, readings, learning=False):
+        log("~~~~~~~~~~~~~~~~~ Processing inputs at T%d", self.t)
         self.inputs = readings
         _in = self.inputs
         for i, r in enumerate(self.regions):
-            log("Step processing for region %d\n%s << Input" % (i, printarray(_in, continuous=True)), level=2)
+            log("Step processing for region %d\n%s << Input", i, lazy(printarray, _in, continuous=True), level=2)
             out = r.step(_in, learning_enabled=learning)
             _in = out
         self.t += 1 # Move time forward one step
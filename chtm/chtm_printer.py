@@ -557,7 +557,7 @@ class PredictorWindow(CanvasWindow):
 
     def overlap_draw_fn(self, raw_input, index):
         region = self.predictor.region
-        last_overlap_for_input = self.predictor.overlap_lookup.get(raw_input)
+        last_overlap_for_input = self.predictor.overlap_for(raw_input)
         value = 0
         if last_overlap_for_input is not None:
             value = last_overlap_for_input[index]
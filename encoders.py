@@ -13,3 +13,10 @@ class SimpleFullWidthEncoder(object):
         inputs[offset:offset+self.n_cats] = 1
         return inputs
 
+    def encode_sparse(self, i):
+        '''
+        Sorted indexes of active inputs (same bits as encode)
+        '''
+        offset = self.n_cats*i
+        return np.arange(offset, offset+self.n_cats)
+
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+# Golden traces: per-step region state of a seeded brain (htm, chtm, pphtm)
+# saved to a compressed .npz file, and replay of a (new) engine against it
+# reporting the first step / region / phase where the two diverge.
+#
+#   brain = make_seeded_brain()
+#   golden_trace.record(brain, inputs, "pphtm_small.npz", learning=True)
+#   ...change engine...
+#   divergence = golden_trace.replay("pphtm_small.npz", make_seeded_brain(), inputs)
+#   if divergence: print divergence  # None if equivalent
+#
+# Fields are compared in the phase order of the recording engine's step, so the
+# reported phase is the first that diverged. Exact mode (default) requires
+# identical values, tolerance mode (atol / rtol) uses np.allclose.
+#
+# testing/golden/ holds traces recorded from the baseline engine, which the
+# optimised engines (and configurations) are replayed against.
+
+import json
+import numpy as np
+
+# Traced fields per engine in step (phase) order, with the phase producing them.
+# permanences is a checksum: synapse count, sum, position-weighted sum
+FIELDS = {
+    "htm": [
+        ("overlap", "overlap"),
+        ("activation", "inhibition"),  # Active columns
+        ("permanences", "segment_learning"),
+        ("boost", "duty_boost"),
+        ("inhibition_radius", "radius")
+    ],
+    "chtm": [
+        ("bias", "bias"),
+        ("overlap", "overlap"),
+        ("pre_activation", "inhibition"),
+        ("permanences", "segment_learning"),
+        ("boost", "duty_boost"),
+        ("inhibition_radius", "radius"),
+        ("activation", "activation")
+    ],
+    "pphtm": [
+        ("overlap", "overlap"),
+        ("pre_activation", "inhibition"),
+        ("permanences", "segment_learning"),
+        ("boost", "duty_boost"),
+        ("inhibition_radius", "radius"),
+        ("activation", "activation"),
+        ("bias", "bias")
+    ]
+}
+
+
+def engine_name(brain):
+    '''
+    Returns "htm", "chtm" or "pphtm" (package of the brain's class)
+    '''
+    return type(brain).__module__.split(".")[0]
+
+
+class Divergence(object):
+    '''
+    First point where a replayed brain differs from a golden trace
+    '''
+
+    def __init__(self, step, region, field, expected, actual, engine="pphtm"):
+        self.step = step
+        self.region = region
+        self.field = field
+        self.phase = dict(FIELDS[engine])[field]
+        self.expected = expected
+        self.actual = actual
+
+    def max_diff(self):
+        if np.shape(self.expected) != np.shape(self.actual):
+            return None
+        return float(np.max(np.abs(np.asarray(self.expected, dtype=float) - np.asarray(self.actual, dtype=float))))
+
+    def __str__(self):
+        return "Diverged at step %d, R%d %s (phase %s, max diff %s)" % (self.step, self.region, self.field, self.phase, self.max_diff())
+
+
+def _segments(region):
+    if hasattr(region, "columns"):
+        # htm: proximal column segments and distal cell segments (Synapse objects)
+        for col in region.columns:
+            yield col.segment
+            for cell in col.cells:
+                for seg in cell.segments:
+                    yield seg
+    else:
+        for cell in region.cells:
+            if hasattr(cell, "all_segments"):
+                for seg in cell.all_segments():
+                    yield seg
+            else:
+                for seg in cell.proximal_segments + cell.distal_segments:
+                    yield seg
+
+
+def _segment_permanences(seg):
+    if hasattr(seg, "synapse_arrays"):
+        return seg.synapse_arrays()[1]  # pphtm, without materializing implicit pools
+    if hasattr(seg, "potential_synapses"):
+        return [s.permanence for s in seg.potential_synapses]
+    return seg.syn_permanences
+
+
+def permanence_checksum(region):
+    '''
+    Returns [n synapses, sum of permanences, position-weighted sum] over all
+    segments of region (order sensitive, so moved synapses also diverge)
+    '''
+    permanences = [np.asarray(_segment_permanences(seg), dtype=float) for seg in _segments(region)]
+    flat = np.concatenate(permanences) if permanences else np.zeros(0)
+    weights = np.arange(len(flat)) % 97 + 1
+    return np.array([len(flat), flat.sum(), np.dot(flat, weights)])
+
+
+def _activation(region):
+    if hasattr(region, "cells"):
+        if isinstance(getattr(region, "activation", None), np.ndarray):
+            return region.activation  # pphtm
+        return [c.activation for c in region.cells]  # chtm
+    if len(region.active_columns):
+        return region.active_columns[-1]  # htm
+    return np.zeros(region.n_columns)
+
+
+def region_state(region, engine="pphtm"):
+    '''
+    Returns dict of field -> np.array for the engine's fields the region has
+    '''
+    state = {}
+    for field, phase in FIELDS[engine]:
+        if field == "permanences":
+            value = permanence_checksum(region)
+        elif field == "activation":
+            value = _activation(region)
+        else:
+            value = getattr(region, field, None)
+        if value is not None:
+            state[field] = np.array(value, dtype=float)
+    return state
+
+
+def _key(region, field):
+    return "r%d_%s" % (region, field)
+
+
+class GoldenTrace(object):
+    '''
+    Per-step region states: fields[(region, field)] is an array with one row per step
+    '''
+
+    def __init__(self, meta=None):
+        self.meta = meta or {}
+        self.steps = []  # List (per step) of list (per region) of region_state() dicts
+
+    def engine(self):
+        return self.meta.get("engine", "pphtm")
+
+    def capture(self, brain):
+        self.steps.append([region_state(r, engine=self.engine()) for r in brain.regions])
+
+    def n_steps(self):
+        return len(self.steps)
+
+    def state(self, step, region):
+        return self.steps[step][region]
+
+    def save(self, path):
+        '''
+        Write compressed .npz with one (steps x values) array per region field
+        '''
+        arrays = {}
+        n_regions = len(self.steps[0]) if self.steps else 0
+        for r in range(n_regions):
+            for field in self.steps[0][r]:
+                arrays[_key(r, field)] = np.array([step[r][field] for step in self.steps])
+        meta = dict(self.meta)
+        meta.update({"n_steps": len(self.steps), "n_regions": n_regions})
+        arrays["meta"] = np.array(json.dumps(meta, sort_keys=True))
+        np.savez_compressed(path, **arrays)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as data:
+            meta = json.loads(str(data["meta"]))
+            trace = GoldenTrace(meta=meta)
+            fields = {}
+            for key in data.files:
+                if key != "meta":
+                    region, field = key[1:].split("_", 1)
+                    fields[(int(region), field)] = data[key]
+        for step in range(meta["n_steps"]):
+            trace.steps.append([dict((field, values[step]) for (region, field), values in fields.items() if region == r) for r in range(meta["n_regions"])])
+        return trace
+
+
+def compare_state(expected, actual, atol=0.0, rtol=0.0, engine="pphtm"):
+    '''
+    Returns first field (in the engine's phase order) whose values differ, or None
+    '''
+    for field, phase in FIELDS[engine]:
+        if field not in expected:
+            continue
+        a, b = expected[field], actual.get(field)
+        if b is None or np.shape(a) != np.shape(b):
+            return field
+        if atol or rtol:
+            same = np.allclose(a, b, atol=atol, rtol=rtol)
+        else:
+            same = np.array_equal(a, b)
+        if not same:
+            return field
+    return None
+
+
+def record(brain, inputs, path=None, learning=True, meta=None):
+    '''
+    Process inputs with brain, capturing region states after every step
+
+    Returns:
+        GoldenTrace (also saved to path if given)
+    '''
+    meta = dict(meta or {})
+    meta["engine"] = engine_name(brain)
+    trace = GoldenTrace(meta=meta)
+    for reading in inputs:
+        brain.process(reading, learning=learning)
+        trace.capture(brain)
+    if path:
+        trace.save(path)
+    return trace
+
+
+def replay(golden, brain, inputs, learning=True, atol=0.0, rtol=0.0):
+    '''
+    Process inputs with brain, comparing region states with golden trace
+    (GoldenTrace or path) after each step, and stopping at first divergence
+
+    Returns:
+        Divergence, or None if brain matched the trace for all steps
+    '''
+    if not isinstance(golden, GoldenTrace):
+        golden = GoldenTrace.load(golden)
+    engine = golden.engine()
+    for step, reading in enumerate(inputs):
+        if step >= golden.n_steps():
+            break
+        brain.process(reading, learning=learning)
+        for r, region in enumerate(brain.regions):
+            expected = golden.state(step, r)
+            actual = region_state(region, engine=engine)
+            field = compare_state(expected, actual, atol=atol, rtol=rtol, engine=engine)
+            if field:
+                return Divergence(step, r, field, expected[field], actual.get(field), engine=engine)
+    return None
@@ -8,10 +8,12 @@
 import numpy as np
 import random
 import util
+import tracing
+from tracing import lazy
 
 # Settings
 
-VERBOSITY = 3
+VERBOSITY = 3  # Initial level of the "htm" tracer (see tracing.set_level)
 DEF_ACTIVATION_THRESHHOLD = 1 # Activation threshold for a segment. If the number of active connected synapses in a segment is greater than activationThreshold, the segment is said to be active. 
 CONNECTED_PERM = 0.2  # If the permanence value for a synapse is greater than this value, it is said to be connected.
 DUTY_HISTORY = 1000
@@ -23,9 +25,8 @@ NEW_SYNAPSE_COUNT = 5
 
 RETAIN_STEPS = 3
 
-def log(message, level=1):
-    if VERBOSITY >= level:
-        print message
+tracer = tracing.get_tracer("htm", level=VERBOSITY)
+log = tracer.log
 
 def printarray(array, coerce_to_int=True):
     if type(array[0]) is int or coerce_to_int:
@@ -127,10 +128,7 @@ class Segment(object):
                     perm = CONNECTED_PERM + INIT_PERMANENCE_JITTER*(random.random()-0.5)
                     s = Synapse(self.region, source, perm)
                     self.potential_synapses.append(s)
-        log_message = "Initialized %s" % self
-        if column:
-            log_message += " for %s" % column
-        log(log_message)
+        log("Initialized %s%s", self, " for %s" % column if column else "")
 
     def active(self, tMinus, state='active'):  # state in ['active','learn']
         '''
@@ -235,7 +233,7 @@ class Cell(object):
         return (best_seg_index, most_active_synapses)
 
     def adapt_segments(self, positive_reinforcement=True):
-        log("Adapting segments for %s - %d segment updates" % (self, len(self.segment_update_list)), level=4)
+        log("Adapting segments for %s - %d segment updates", self, len(self.segment_update_list), level=4)
         # Prepare update dictionary
         update_active_synapses_by_segment = {}  # segment_index -> list of synapse sources (c, i)
         # TODO: Do active_synapses need column index?
@@ -420,7 +418,7 @@ class Region(object):
             col.initialize()
             self.columns.append(col)
         self.neighbors = [self._neighbors_of(c) for c in self.columns]  # List of lists (column neighbors list for each column neighbors[c])
-        print "Initialized %s" % self
+        log("Initialized %s", self)
         
     def _get_input(self, j, tMinus=0):
         '''
@@ -509,7 +507,7 @@ class Region(object):
                 overlaps[c] = 0
             else:
                 overlaps[c] = overlaps[c] * self.boost[c]
-        log("%s << Overlap" % printarray(overlaps), level=3)
+        log("%s << Overlap", lazy(printarray, overlaps), level=3)
         return overlaps
 
     def do_inhibition(self):
@@ -661,7 +659,8 @@ class Region(object):
         # Phase 2: Predictive state    
         out = self.do_predictive_state()
 
-        self.print_columns()
+        if tracer.enabled(1):
+            self.print_columns()
 
         # Phase 3: Learning
         if learning_enabled:
@@ -683,9 +682,9 @@ class Region(object):
         self.learn_state = np.dstack((self.active_state, np.zeros((self.n_columns, self.cells_per_column))))                
         
         self.spatial_pooling(learning_enabled=learning_enabled)  # Calculates active columns
-        log("%s << Active columns" % printarray(self.active_columns[-1]))
+        log("%s << Active columns", lazy(printarray, self.active_columns[-1]))
         out = self.temporal_pooling(learning_enabled=learning_enabled)
-        log("%s << Output (active or predictive?)" % printarray(out))
+        log("%s << Output (active or predictive?)", lazy(printarray, out))
         return out
 
 
@@ -708,16 +707,16 @@ class HTMBrain(object):
             r.initialize()
             n_inputs = cpr  # Next region will have 1 input for each output column
             self.regions.append(r)
-        print "Initialized %s" % self
+        log("Initialized %s", self)
 
     def process(self, readings, learning=False):
         '''
         Step through all regions inputting output of each into next
         '''
-        print "~~~~~~~~~~~~~~~~~ Processing inputs at T%d" % self.t
+        log("~~~~~~~~~~~~~~~~~ Processing inputs at T%d", self.t)
         _in = readings
         for i, r in enumerate(self.regions):
-            log("Step processing for region %d\n%s << Input" % (i, printarray(_in)))
+            log("Step processing for region %d\n%s << Input", i, lazy(printarray, _in))
             out = r.step(_in, learning_enabled=learning)
             _in = out
         self.t += 1 # Move time forward one step
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# Running synapse aggregates of a region (chtm, pphtm)
+#
+# Sum of permanences, connected count and synapse count per segment type,
+# updated by every site that adds, removes or changes a permanence, so that
+# reporting is O(1) instead of a scan over all synapses.
+#
+#   stats = PermanenceStats(CONNECTED_PERM, {Segment.PROXIMAL: "proximal", ...})
+#   stats.add(seg.type, permanence)         # New synapse
+#   stats.change(seg.type, old, new)        # Learning / boosting / decay
+#   stats.remove(seg.type, permanence)      # Pruned synapse
+#   stats.recount(segments)                 # Exact rebuild (after load etc)
+
+
+class PermanenceStats(object):
+    '''
+    Running permanence sum, connected count (permanence > connected_perm,
+    as Segment.connected) and synapse count per segment type
+    '''
+
+    def __init__(self, connected_perm, type_names):
+        self.connected_perm = connected_perm
+        self.type_names = type_names  # Segment type -> name used in summary()
+        self.reset()
+
+    def reset(self):
+        self.perm_sum = dict((type, 0.0) for type in self.type_names)
+        self.n_connected = dict((type, 0) for type in self.type_names)
+        self.n_synapses = dict((type, 0) for type in self.type_names)
+
+    def add(self, type, permanence):
+        self.perm_sum[type] += permanence
+        self.n_synapses[type] += 1
+        if permanence > self.connected_perm:
+            self.n_connected[type] += 1
+
+    def remove(self, type, permanence):
+        self.perm_sum[type] -= permanence
+        self.n_synapses[type] -= 1
+        if permanence > self.connected_perm:
+            self.n_connected[type] -= 1
+
+    def change(self, type, old, new):
+        self.perm_sum[type] += new - old
+        connected = new > self.connected_perm
+        if connected != (old > self.connected_perm):
+            self.n_connected[type] += 1 if connected else -1
+
+    def recount(self, segments):
+        '''
+        Rebuild all aggregates from (type, permanences) pairs, one per segment
+        (also clears drift of the running sums)
+        '''
+        self.reset()
+        for type, permanences in segments:
+            for permanence in permanences:
+                self.add(type, permanence)
+
+    def mean_permanence(self, type):
+        n = self.n_synapses[type]
+        return self.perm_sum[type] / n if n else 0.0
+
+    def connected_fraction(self, type):
+        n = self.n_synapses[type]
+        return self.n_connected[type] / float(n) if n else 0.0
+
+    def summary(self):
+        '''
+        Returns dict of segment type name -> synapses, connected, mean_permanence
+        '''
+        return dict((name, {
+            "synapses": self.n_synapses[type],
+            "connected": self.n_connected[type],
+            "mean_permanence": self.mean_permanence(type)
+        }) for type, name in self.type_names.items())
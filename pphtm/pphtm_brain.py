@@ -3,12 +3,20 @@
 import numpy as np
 import random
 import math
+import time
 import util
+import tracing
+from tracing import lazy
 from util import printarray
+import pphtm_pools
+import pphtm_kernels
+from collections import OrderedDict
+from pphtm_stats import StepStats, LatencyHistogram
+from permanence_stats import PermanenceStats
 
 # Settings (global vars, other vars set in brain.__init__)
 
-VERBOSITY = 0
+VERBOSITY = 0  # Initial level of the "pphtm" tracer (see tracing.set_level)
 DEF_MIN_OVERLAP = 2
 CONNECTED_PERM = 0.2  # If the permanence value for a synapse is greater than this value, it is said to be connected.
 DUTY_HISTORY = 40
@@ -21,9 +29,48 @@ BIAS_DUTY_CUTOFF = 1.0
 PROXIMITY_WEIGHTING = 1 # (bool) For proximal connection init.
 LIMIT_BIAS_DUTY_CYCLE = 0.6 # If biased > 60% of recent history
 
-def log(message, level=1):
-    if VERBOSITY >= level:
-        print message
+tracer = tracing.get_tracer("pphtm", level=VERBOSITY)
+log = tracer.log
+
+class SparseInput(object):
+    '''
+    Input vector of length n stored as sorted active indexes and their values
+    (values default to 1.0, as for binary encoder inputs)
+    '''
+
+    def __init__(self, indices, values=None, n=0):
+        self.indices = np.asarray(indices, dtype=int)
+        self.values = np.ones(len(self.indices)) if values is None else np.asarray(values, dtype=float)
+        self.n = n
+
+    def __repr__(self):
+        return "<SparseInput active=%d n=%d>" % (len(self.indices), self.n)
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, j):
+        i = np.searchsorted(self.indices, j)
+        if i < len(self.indices) and self.indices[i] == j:
+            return self.values[i]
+        return 0.0
+
+    def dense(self):
+        array = np.zeros(self.n)
+        array[self.indices] = self.values
+        return array
+
+    @staticmethod
+    def from_dense(array):
+        array = np.asarray(array, dtype=float)
+        indices = np.flatnonzero(array)
+        return SparseInput(indices, array[indices], n=len(array))
+
+def dense_input(input):
+    '''Dense np.array for a dense or SparseInput input'''
+    if isinstance(input, SparseInput):
+        return input.dense()
+    return np.asarray(input, dtype=float)
 
 class Segment(object):
     '''
@@ -33,6 +80,7 @@ class Segment(object):
     PROXIMAL = 1
     DISTAL = 2
     TOPDOWN = 3 # prediction
+    SYNAPSE_LISTS = ["syn_sources", "syn_permanences", "syn_change", "syn_prestep_contribution", "syn_contribution"]
 
     def __init__(self, cell, index, region, type=None):
         self.index = index
@@ -47,14 +95,35 @@ class Segment(object):
         self.syn_prestep_contribution = [] # (after step)
         self.syn_contribution = [] # (after step)
 
+        # Implicit pool (IMPLICIT_POOLS), see release()
+        self.pool_slots = None  # Pool slot of each synapse (-1 if grown), while materialized
+        self.pool_overlay = None  # Pool slot -> permanence, for permanences diverged from initial
+        self.pool_removed = None  # Pruned pool slots
+        self.pool_extra = None  # (source, permanence) of grown synapses
+
         # State
         self.active_before_learning = False
+        self.prune_candidates = {}  # Source index -> t first seen below PRUNE_FLOOR
 
     def __repr__(self):
         t = self.region.brain.t
         return "<Segment type=%s index=%d potential=%d connected=%d>" % (self.print_type(), self.index, self.n_synapses(), len(self.connected_synapses()))
 
+    def __getattr__(self, name):
+        # Synapse lists of released implicit-pool segments are regenerated on access
+        if name in Segment.SYNAPSE_LISTS and self.__dict__.get("pool_overlay") is not None:
+            self.materialize()
+            return self.__dict__[name]
+        raise AttributeError(name)
+
     def initialize(self):
+        if self.region.brain.config("IMPLICIT_POOLS"):
+            # Potential synapses are generated from the pool seed on access
+            self.pool_overlay, self.pool_removed, self.pool_extra = {}, set(), []
+            for name in Segment.SYNAPSE_LISTS:
+                delattr(self, name)
+            log("Initialized implicit %s segment %d", self.print_type(), self.index, level=2)
+            return
         if self.proximal():
             # Setup initial potential synapses for proximal segments
             n_inputs = self.region.n_inputs
@@ -69,24 +138,105 @@ class Segment(object):
                 if add_synapse:
                     self.add_synapse(source)
         elif self.distal():
-            cell_index = self.cell.index
-            for index in range(self.region.n_cells):
-                if index == cell_index:
+            self._initialize_lateral(self.region.n_cells, self.region.brain.config("DISTAL_SYNAPSE_CHANCE"))
+        else:
+            # Top down connections
+            self._initialize_lateral(self.region.n_cells_above, self.region.brain.config("TOPDOWN_SYNAPSE_CHANCE"))
+        log("Initialized %s", self)
+
+    def _initialize_lateral(self, n_sources, chance_of_synapse):
+        '''
+        Setup initial potential synapses for distal (cells in region) or top-down
+        (cells in region above) segments, according to DISTAL_CONNECTIVITY:
+
+            random: each source with chance_of_synapse
+            radius: sources within DISTAL_RADIUS with chance_of_synapse
+            gaussian: chance_of_synapse falls off with distance (sigma DISTAL_RADIUS)
+            grow: none, synapses are added to active cells during learning
+
+        At most MAX_DISTAL_SYNAPSES (if set) are kept.
+        '''
+        mode = self.region.brain.config("DISTAL_CONNECTIVITY")
+        if mode == "grow":
+            return
+        max_synapses = self.region.brain.config("MAX_DISTAL_SYNAPSES")
+        sources = []  # Only collected if capped, otherwise synapses are added as drawn (keeps the random stream)
+        if mode in ["radius", "gaussian"]:
+            radius = self.region.brain.config("DISTAL_RADIUS")
+            window = radius if mode == "radius" else 3 * radius
+            for index, dist in self._sources_near(n_sources, window):
+                chance = chance_of_synapse
+                if mode == "gaussian":
+                    chance *= math.exp(-(dist ** 2) / (2 * radius ** 2))
+                if random.random() < chance:
+                    if max_synapses:
+                        sources.append(index)
+                    else:
+                        self.add_synapse(index)
+        else:
+            for index in range(n_sources):
+                if self.distal() and index == self.cell.index:
                     # Avoid creating synapse with self
                     continue
-                chance_of_synapse = self.region.brain.config("DISTAL_SYNAPSE_CHANCE")
                 add_synapse = random.random() < chance_of_synapse
                 if add_synapse:
-                    self.add_synapse(index)
+                    if max_synapses:
+                        sources.append(index)
+                    else:
+                        self.add_synapse(index)
+        if max_synapses and len(sources) > max_synapses:
+            sources = sorted(random.sample(sources, max_synapses))
+        for index in sources:
+            self.add_synapse(index)
+
+    def _sources_near(self, n_sources, radius):
+        '''
+        Yields (index, distance) of source cells within radius of this segment's cell
+        Source grid (own region or region above) is scaled onto own grid
+        '''
+        own_side_len = self.region._cell_side_len()
+        source_side_len = int(round(math.sqrt(n_sources)))
+        scale = source_side_len / own_side_len if own_side_len else 1.0
+        x0, y0 = [v * scale for v in self.cell.coords]
+        for y in range(max(0, int(math.floor(y0 - radius))), min(source_side_len, int(math.ceil(y0 + radius)) + 1)):
+            for x in range(max(0, int(math.floor(x0 - radius))), min(source_side_len, int(math.ceil(x0 + radius)) + 1)):
+                index = util.index_from_coords(x, y, source_side_len)
+                if self.distal() and index == self.cell.index:
+                    continue
+                dist = util.distance((x0, y0), (x, y))
+                if dist <= radius and index < n_sources:
+                    yield (index, dist)
+
+    def grow_synapses(self, n_new=0):
+        '''
+        Add up to n_new synapses to currently active, excitatory source cells not
+        yet connected to this segment (distal or top-down, see DISTAL_CONNECTIVITY = grow)
+
+        Returns:
+            int: number of synapses added
+        '''
+        if self.distal():
+            source_region = self.region
         else:
-            # Top down connections
-            for index in range(self.region.n_cells_above):
-                chance_of_synapse = self.region.brain.config("TOPDOWN_SYNAPSE_CHANCE")
-                add_synapse = random.random() < chance_of_synapse
-                if add_synapse:
-                    self.add_synapse(index)
-        log_message = "Initialized %s" % self
-        log(log_message)
+            source_region = self.region.region_above()
+        if not source_region:
+            return 0
+        max_synapses = self.region.brain.config("MAX_DISTAL_SYNAPSES")
+        if max_synapses:
+            n_new = min(n_new, max_synapses - self.n_synapses())
+        if n_new <= 0:
+            return 0
+        learn_threshold = self.region.brain.config("DIST_SYNAPSE_ACTIVATION_LEARN_THRESHHOLD")
+        active = (source_region.activation >= learn_threshold) & (source_region.excitatory_activation_mult > 0)
+        active[self.syn_sources] = False
+        if self.distal():
+            active[self.cell.index] = False
+        candidates = list(np.flatnonzero(active))
+        if len(candidates) > n_new:
+            candidates = random.sample(candidates, n_new)
+        for index in sorted(candidates):
+            self.add_synapse(int(index), permanence=INIT_PERMANENCE)
+        return len(candidates)
 
     def proximal(self):
         return self.type == self.PROXIMAL
@@ -97,22 +247,168 @@ class Segment(object):
     def topdown(self):
         return self.type == self.TOPDOWN
 
+    def materialized(self):
+        return "syn_sources" in self.__dict__
+
+    def materialize(self):
+        '''
+        Build synapse lists of an implicit-pool segment from its pool and overlay
+        '''
+        sources, permanences = pphtm_pools.segment_pool(self)
+        slots = [i for i in range(len(sources)) if i not in self.pool_removed]
+        self.syn_sources = [int(sources[i]) for i in slots]
+        self.syn_permanences = [self.pool_overlay.get(i, float(permanences[i])) for i in slots]
+        self.pool_slots = slots
+        for source, permanence in self.pool_extra:
+            self.syn_sources.append(source)
+            self.syn_permanences.append(permanence)
+            self.pool_slots.append(-1)
+        n = len(self.syn_sources)
+        self.syn_change = [0] * n
+        self.syn_prestep_contribution = [0] * n
+        self.syn_contribution = [0] * n
+
+    def release(self):
+        '''
+        Drop synapse lists of an implicit-pool segment, keeping only permanences
+        that diverged from their initial value, pruned slots and grown synapses
+        '''
+        if self.pool_overlay is None or not self.materialized():
+            return
+        sources, permanences = pphtm_pools.segment_pool(self)
+        overlay, extra = {}, []
+        kept = set()
+        for i, slot in enumerate(self.pool_slots):
+            permanence = self.syn_permanences[i]
+            if slot < 0:
+                extra.append((self.syn_sources[i], permanence))
+            else:
+                kept.add(slot)
+                if permanence != permanences[slot]:
+                    overlay[slot] = permanence
+        self.pool_overlay = overlay
+        self.pool_extra = extra
+        self.pool_removed = set(range(len(sources))) - kept
+        self.pool_slots = None
+        for name in Segment.SYNAPSE_LISTS:
+            delattr(self, name)
+
+    def synapse_arrays(self):
+        '''
+        Returns:
+            (sources, permanences) np.arrays, without materializing released segments
+        '''
+        if self.pool_overlay is None or self.materialized():
+            return (np.asarray(self.syn_sources, dtype=int), np.asarray(self.syn_permanences, dtype=float))
+        sources, permanences = pphtm_pools.segment_pool(self)
+        for slot, permanence in self.pool_overlay.items():
+            permanences[slot] = permanence
+        keep = np.ones(len(sources), dtype=bool)
+        keep[list(self.pool_removed)] = False
+        sources, permanences = sources[keep], permanences[keep]
+        if self.pool_extra:
+            extra_sources, extra_permanences = zip(*self.pool_extra)
+            sources = np.concatenate([sources, extra_sources]).astype(int)
+            permanences = np.concatenate([permanences, extra_permanences])
+        return (sources, permanences)
+
     def add_synapse(self, source_index=0, permanence=None):
         if permanence is None:
             permanence = CONNECTED_PERM + INIT_PERMANENCE_JITTER*(random.random()-0.5)
+        if self.pool_slots is not None:
+            self.pool_slots.append(-1)
         self.syn_sources.append(source_index)
         self.syn_permanences.append(permanence)
+        self.region.permanence_stats.add(self.type, permanence)
+        self.region.structure_version += 1
+        self.region.connectivity_changes.add(self)
         self.syn_change.append(0)
         self.syn_prestep_contribution.append(0)
         self.syn_contribution.append(0)
 
+    def prune(self, floor=0.0, grace=0):
+        '''
+        Remove synapses whose permanence has been below floor for at least grace
+        steps (as seen by earlier prune calls), and compact synapse lists
+
+        Returns:
+            int: number of synapses removed
+        '''
+        if self.pool_overlay is not None and not self.materialized() and floor <= CONNECTED_PERM - INIT_PERMANENCE_JITTER / 2:
+            return self._prune_released(floor, grace)
+        t = self.region.brain.t
+        keep = []
+        for i, perm in enumerate(self.syn_permanences):
+            source = self.syn_sources[i]
+            if perm < floor:
+                since = self.prune_candidates.setdefault(source, t)
+                if t - since >= grace:
+                    del self.prune_candidates[source]
+                    self.region.permanence_stats.remove(self.type, perm)
+                    continue
+            elif source in self.prune_candidates:
+                del self.prune_candidates[source]
+            keep.append(i)
+        n_pruned = self.n_synapses() - len(keep)
+        if n_pruned:
+            self.region.structure_version += 1
+            self.region.connectivity_changes.add(self)
+            if self.pool_slots is not None:
+                self.pool_slots = [self.pool_slots[i] for i in keep]
+            self.syn_sources = [self.syn_sources[i] for i in keep]
+            self.syn_permanences = [self.syn_permanences[i] for i in keep]
+            self.syn_change = [self.syn_change[i] for i in keep]
+            self.syn_prestep_contribution = [self.syn_prestep_contribution[i] for i in keep]
+            self.syn_contribution = [self.syn_contribution[i] for i in keep]
+        return n_pruned
+
+    def _prune_released(self, floor=0.0, grace=0):
+        '''
+        prune() of a released implicit-pool segment, which stays released. Pool
+        synapses start at or above floor, so only permanences in the overlay and
+        grown synapses can be below it.
+        '''
+        low_slots = [slot for slot, perm in self.pool_overlay.items() if perm < floor]
+        low_extra = [i for i, (source, perm) in enumerate(self.pool_extra) if perm < floor]
+        if not (low_slots or low_extra or self.prune_candidates):
+            return 0
+        t = self.region.brain.t
+        sources = pphtm_pools.segment_pool(self)[0] if low_slots else []
+        below = {}  # Source -> (pool slot, None) or (None, index in pool_extra)
+        for slot in low_slots:
+            below[int(sources[slot])] = (slot, None)
+        for i in low_extra:
+            below[self.pool_extra[i][0]] = (None, i)
+        for source in list(self.prune_candidates):
+            if source not in below:
+                del self.prune_candidates[source]
+        n_pruned = 0
+        removed_extra = set()
+        for source, (slot, extra) in below.items():
+            since = self.prune_candidates.setdefault(source, t)
+            if t - since >= grace:
+                del self.prune_candidates[source]
+                if slot is not None:
+                    self.region.permanence_stats.remove(self.type, self.pool_overlay.pop(slot))
+                    self.pool_removed.add(slot)
+                else:
+                    self.region.permanence_stats.remove(self.type, self.pool_extra[extra][1])
+                    removed_extra.add(extra)
+                n_pruned += 1
+        if removed_extra:
+            self.pool_extra = [e for i, e in enumerate(self.pool_extra) if i not in removed_extra]
+        if n_pruned:
+            self.region.structure_version += 1
+            self.region.connectivity_changes.add(self)
+        return n_pruned
+
     def synapse_state(self, index=0):
         '''
         index is index in region
         '''
         last_change = permanence = contribution = None
         if index in self.syn_sources:
-            syn_index = self.syn_sources.index(index)
+            syn_index = list(self.syn_sources).index(index)
             last_change = self.syn_change[syn_index]
             permanence = self.syn_permanences[syn_index]
             contribution = self.syn_contribution[syn_index]
@@ -147,8 +443,11 @@ class Segment(object):
         prox_decay = self.region.brain.config("SYNAPSE_DECAY_PROX")
         distal_decay = self.region.brain.config("SYNAPSE_DECAY_DIST")
         decay = prox_decay if self.proximal() else distal_decay
+        self.region.changed_segments.add(self)
         for syn in self.connected_synapses():
-            self.syn_permanences[syn] -= decay
+            perm = self.syn_permanences[syn]
+            self.syn_permanences[syn] = perm - decay
+            self.region.permanence_changed(self, perm, perm - decay)
 
     def distance_from(self, coords_xy, index=0):
         source_xy = util.coords_from_index(self.syn_sources[index], self.region._input_side_len())
@@ -190,7 +489,7 @@ class Segment(object):
 
         Return: double (not bounded)
         '''
-        connected_syn_sources = np.take(np.asarray(self.syn_sources, dtype='int32'), self.connected_synapses())
+        connected_syn_sources = np.take(np.asarray(self.syn_sources, dtype='int32'), np.asarray(self.connected_synapses(), dtype='int32'))
         if self.proximal():
             region_below = self.region.region_below()
             excitatory_activation_mult = region_below.excitatory_activation_mult if region_below else np.ones(self.region.n_inputs)
@@ -203,7 +502,6 @@ class Segment(object):
             # top down
             region_above = self.region.region_above()
             if region_above:
-                connected_syn_sources = np.take(self.syn_sources, self.connected_synapses())
                 return sum(np.take(region_above.activation * region_above.excitatory_activation_mult, connected_syn_sources))
             else:
                 return 0.0
@@ -260,6 +558,15 @@ class Cell(object):
     def __repr__(self):
         return "<Cell index=%d activation=%.1f bias=%s overlap=%s />" % (self.index, self.activation, self.region.bias[self.index], self.region.overlap[self.index])
 
+    @property
+    def activation(self):
+        '''Activation [0.0, 1.0], stored in region.activation'''
+        return self.region.activation[self.index]
+
+    @activation.setter
+    def activation(self, value):
+        self.region.activation[self.index] = value
+
     def initialize(self):
         for i in range(self.n_proximal_segments):
             proximal = Segment(self, i, self.region, type=Segment.PROXIMAL)
@@ -273,7 +580,7 @@ class Cell(object):
             topdown = Segment(self, i, self.region, type=Segment.TOPDOWN)
             topdown.initialize() # Creates synapses
             self.topdown_segments.append(topdown)
-        log("Initialized %s" % self)
+        log("Initialized %s", self)
 
     def all_segments(self):
         return self.proximal_segments + self.distal_segments + self.topdown_segments
@@ -360,7 +667,8 @@ class Region(object):
         self.cells = []
 
         # State (historical)
-        self.input = None  # Inputs at time t - input[t, j] is double [0.0, 1.0]
+        self._input = None  # Inputs at time t - input[t, j] is double [0.0, 1.0] (see input property)
+        self._sparse_input = None  # SparseInput, if input was given as active indexes
 
         # State
         self.overlap = np.zeros(self.n_cells)  # Overlap for each cell. overlap[c] is double
@@ -374,7 +682,34 @@ class Region(object):
         self.bias_duty_cycle = np.zeros((self.n_cells))  # Sliding average: how often column c has been biased (distal or topdown)
         self.last_activation = None  # Hold last step in state for rendering
 
+        # Temporal subsampling (see step())
+        self.step_every = 1  # Step on every k-th input
+        self.step_change_threshold = 0.0  # If > 0, step only when input changes (L1) by more than this
+        self.input_integration = "hold"  # How inputs are combined between steps: hold, max or mean
+        self.integrated_input = None  # Input accumulated since last step
+        self.n_integrated = 0
+        self.last_stepped_input = None  # Input used on last step (only kept under a change threshold)
+        self.n_steps = 0  # Steps actually run (t counts all inputs)
+        self.n_skipped = 0
+        self.inference_segment_activity = None  # Set by inference engine, applied before next learning step
+
+        # Pruning (see prune_synapses)
+        self.n_pruned = 0
+        self.n_synapses = 0  # Remaining after initialization / last prune
+        self.structure_version = 0  # Incremented whenever synapses are added or removed (not on permanence changes)
+
+        # Memory-mapped synapse storage (see pphtm_checkpoint.load)
+        self.synapse_storage = {}  # Synapse list name -> region-wide np.memmap (segment lists are views)
+        self.changed_segments = set()  # Segments whose synapse values changed since last checkpoint
+        self.connectivity_changes = set()  # Segments whose connected synapses changed since the inference snapshot read them
+
+        # Instrumentation
+        self.stats = StepStats(size=brain.config("STATS_HISTORY"))  # Per-step phase timings and counters
+        self.permanence_stats = PermanenceStats(CONNECTED_PERM, {Segment.PROXIMAL: "proximal", Segment.DISTAL: "distal", Segment.TOPDOWN: "topdown"})
+
         # Helpers
+        self._neighbor_mask = None  # See neighbor_mask()
+        self._neighbor_mask_radius = None
         self.diagonal = 1.414*2*math.sqrt(n_cells)
         self.excitatory_activation_mult = np.ones(self.n_cells)  # Matrix of 1 or -1 for each cell (after initialization)
 
@@ -382,11 +717,33 @@ class Region(object):
     def __str__(self):
         return "<Region inputs=%d cells=%d />" % (self.n_inputs, len(self.cells))
 
+    @property
+    def input(self):
+        '''Dense input at time t (built from sparse input on first access)'''
+        if self._input is None and self._sparse_input is not None:
+            self._input = self._sparse_input.dense()
+        return self._input
+
+    @input.setter
+    def input(self, value):
+        if isinstance(value, SparseInput):
+            self._sparse_input, self._input = value, None
+        else:
+            self._sparse_input, self._input = None, value
+
+    @property
+    def sparse_input(self):
+        '''SparseInput at time t, or None if input was given dense'''
+        return self._sparse_input
+
     def print_cells(self):
         activations = [cell.activation for cell in self.cells]
         return printarray(activations, continuous=True)
 
     def initialize(self):
+        self.step_every = self.brain.region_config("REGION_STEP_EVERY", self.index)
+        self.step_change_threshold = self.brain.region_config("REGION_STEP_CHANGE_THRESHOLD", self.index)
+        self.input_integration = self.brain.region_config("REGION_INPUT_INTEGRATION", self.index)
         # Create cells
         for i in range(self.n_cells):
             c = Cell(region=self, index=i)
@@ -394,7 +751,15 @@ class Region(object):
             if not c.excitatory:
                 self.excitatory_activation_mult[i] = -1
             self.cells.append(c)
-        log("Initialized %s" % self)
+        self.recount_permanences()
+        self.n_synapses = sum(self.permanence_stats.n_synapses.values())
+        log("Initialized %s", self)
+
+    def recount_permanences(self):
+        '''
+        Rebuild permanence_stats from all synapses (without materializing implicit pools)
+        '''
+        self.permanence_stats.recount((seg.type, seg.synapse_arrays()[1]) for cell in self.cells for seg in cell.all_segments())
 
     def region_above(self):
         if self.index < len(self.brain.regions) - 1:
@@ -457,6 +822,23 @@ class Region(object):
         # log("Got %d neighbors. Overlaps: %s" % (len(_neighbors), [self.overlap[n.index] for n in _neighbors]))
         return _neighbors
 
+    def neighbor_mask(self):
+        '''
+        Boolean (n_cells, n_cells) mask of cells within inhibition radius (excluding self)
+        Cached until inhibition radius changes
+        '''
+        if self._neighbor_mask is None or self._neighbor_mask_radius != self.inhibition_radius:
+            side_len = self._cell_side_len()
+            index = np.arange(self.n_cells)
+            x = index % side_len
+            y = np.floor(index / side_len)
+            dist = np.sqrt((x[:, None] - x[None, :]) ** 2 + (y[:, None] - y[None, :]) ** 2)
+            mask = dist <= self.inhibition_radius
+            np.fill_diagonal(mask, False)
+            self._neighbor_mask = mask
+            self._neighbor_mask_radius = self.inhibition_radius
+        return self._neighbor_mask
+
     def _boost_function(self, c, min_duty_cycle):
         if self.active_duty_cycle[c] >= min_duty_cycle:
             b = 1.0
@@ -478,24 +860,75 @@ class Region(object):
         cell = self.cells[c]
         if type == "proximal":
             for seg in self.cells[c].proximal_segments:
+                self.changed_segments.add(seg)
                 for i, perm in enumerate(seg.syn_permanences):
                     source_cell = seg.source_cell(i)
                     if (source_cell and source_cell.excitatory == excitatory):
                         seg.syn_permanences[i] = min([perm+increase, 1.0])
+                        self.permanence_changed(seg, perm, seg.syn_permanences[i])
 
         elif type == "distal":
             for seg in self.cells[c].distal_segments:
+                self.changed_segments.add(seg)
                 for i, perm in enumerate(seg.syn_permanences):
                     source_cell = seg.source_cell(i)
                     if source_cell.excitatory == excitatory:
                         seg.syn_permanences[i] = min([perm+increase, 1.0])
+                        self.permanence_changed(seg, perm, seg.syn_permanences[i])
 
         elif type == "topdown":
             for seg in self.cells[c].topdown_segments:
+                self.changed_segments.add(seg)
                 for i, perm in enumerate(seg.syn_permanences):
                     source_cell = seg.source_cell(i)
                     if source_cell.excitatory == excitatory:
                         seg.syn_permanences[i] = min([perm+increase, 1.0])
+                        self.permanence_changed(seg, perm, seg.syn_permanences[i])
+
+    def permanence_changed(self, seg, old, new):
+        '''
+        Record a synapse permanence change of seg in the running aggregates, and
+        seg in connectivity_changes if the synapse crossed CONNECTED_PERM
+        '''
+        self.permanence_stats.change(seg.type, old, new)
+        if (old >= CONNECTED_PERM) != (new >= CONNECTED_PERM):
+            self.connectivity_changes.add(seg)
+
+    def prune_synapses(self):
+        '''
+        Drop synapses that stayed below PRUNE_FLOOR for PRUNE_GRACE steps and
+        compact segment synapse lists
+
+        Returns:
+            int: number of synapses pruned
+        '''
+        if self.synapse_storage:
+            raise ValueError("Can't prune memory-mapped synapses of R%d" % self.index)
+        floor = self.brain.config("PRUNE_FLOOR")
+        grace = self.brain.config("PRUNE_GRACE")
+        n_pruned = 0
+        for cell in self.cells:
+            for seg in cell.all_segments():
+                n_pruned += seg.prune(floor=floor, grace=grace)
+        n_synapses = sum(self.permanence_stats.n_synapses.values())  # Without materializing released pools
+        self.n_pruned += n_pruned
+        self.n_synapses = n_synapses
+        log("R%d - pruned %d synapses (%d remaining)", self.index, n_pruned, n_synapses)
+        return n_pruned
+
+    def _grow_cell_segments(self, cell, segments, any_active):
+        '''
+        Grow synapses to active cells on the active segments of an activating cell,
+        or if none are active, on its least populated segment
+        '''
+        if not segments:
+            return 0
+        if any_active:
+            growing = [seg for seg in segments if seg.active_before_learning]
+        else:
+            growing = [min(segments, key=lambda seg : seg.n_synapses())]
+        n_new = self.brain.config("NEW_SYNAPSE_COUNT")
+        return sum([seg.grow_synapses(n_new) for seg in growing])
 
     def calculate_biases(self):
         '''
@@ -544,14 +977,8 @@ class Region(object):
         '''
         self.pre_activation = (self.brain.config("OVERLAP_WEIGHT") * self.overlap) * (1 + (self.brain.config("BIAS_WEIGHT") * self.bias))
         # self.pre_activation = (self.brain.config("OVERLAP_WEIGHT") * self.overlap) + (self.brain.config("BIAS_WEIGHT") * self.bias)
-        active = np.zeros(len(self.cells))
-        for c in self.cells:
-            pa = self.pre_activation[c.index]
-            neighbors = self._neighbors_of(c)
-            kth_score = self._kth_score(neighbors, self.pre_activation, k=self.brain.config("DESIRED_LOCAL_ACTIVITY"))
-            if pa > 0 and pa >= kth_score:
-                active[c.index] = True
-        return active
+        winners = self.brain.kernels.local_winners(self.pre_activation[None, :], self.neighbor_mask(), self.brain.config("DESIRED_LOCAL_ACTIVITY"))
+        return winners[0].astype(float)
 
     def learn_segment(self, seg, is_activating=False, is_biased=False):
         '''Update synapse permanences for this segment.
@@ -568,6 +995,7 @@ class Region(object):
         '''
         n_inc = n_dec = n_conn = n_discon = 0
         active = seg.active_before_learning
+        self.changed_segments.add(seg)
         for i in range(seg.n_synapses()):
             seg.syn_change[i] = 0
             was_connected = seg.connected(i)
@@ -589,16 +1017,17 @@ class Region(object):
                 else:
                     increase_permanence = is_activating
                     decrease_permanence = not is_activating and is_biased
-                if increase_permanence and seg.syn_permanences[i] < 1.0:
+                perm = seg.syn_permanences[i]
+                if increase_permanence and perm < 1.0:
                     n_inc += 1
-                    seg.syn_permanences[i] += self.brain.config("PERM_LEARN_INC")
-                    seg.syn_permanences[i] = min(1.0, seg.syn_permanences[i])
+                    seg.syn_permanences[i] = min(1.0, perm + self.brain.config("PERM_LEARN_INC"))
                     seg.syn_change[i] += 1
-                elif decrease_permanence and seg.syn_permanences[i] > 0.0:
+                    self.permanence_changed(seg, perm, seg.syn_permanences[i])
+                elif decrease_permanence and perm > 0.0:
                     n_dec +=1
-                    seg.syn_permanences[i] -= self.brain.config("PERM_LEARN_DEC")
-                    seg.syn_permanences[i] = max(0.0, seg.syn_permanences[i])
+                    seg.syn_permanences[i] = max(0.0, perm - self.brain.config("PERM_LEARN_DEC"))
                     seg.syn_change[i] -= 1
+                    self.permanence_changed(seg, perm, seg.syn_permanences[i])
                 connection_changed = was_connected != seg.connected(i)
                 if connection_changed:
                     connected = not was_connected
@@ -608,7 +1037,7 @@ class Region(object):
                         n_discon += 1
         return (n_inc, n_dec, n_conn, n_discon)
 
-    def do_learning(self, activating):
+    def learn_segments(self, activating):
         '''Update permanences for each segment according to learning rules.
 
         Proximal:
@@ -622,51 +1051,180 @@ class Region(object):
             activating (np.array - bool): Activation in this step after inhibition
         '''
         n_increased_prox = n_decreased_prox = n_increased_dist = n_decreased_dist = n_conn_prox = n_discon_prox = n_conn_dist = n_discon_dist = 0
+        grow = self.brain.config("DISTAL_CONNECTIVITY") == "grow"
+        n_grown = n_learned = n_touched = n_evaluated = 0
+        kernels = self.brain.kernels
+        is_activating = np.asarray(activating, dtype=bool)
+        is_biased = self.bias != 0
+        distal_active = np.array([[seg.active_before_learning for seg in cell.distal_segments] for cell in self.cells], dtype=bool).reshape(self.n_cells, -1)
+        topdown_active = np.array([[seg.active_before_learning for seg in cell.topdown_segments] for cell in self.cells], dtype=bool).reshape(self.n_cells, -1)
+        stats = self.stats
+        clock = time.time()
+        distal_learns = kernels.segment_learning(is_activating, is_biased, distal_active)
+        topdown_learns = kernels.segment_learning(is_activating, is_biased, topdown_active)
         for i, cell_is_activating in enumerate(activating):
             cell = self.cells[i]
             cell_biased = self.bias[i] # Thresh?
-            any_distal_active = any([seg.active_before_learning for seg in cell.distal_segments])
-            any_topdown_active = any([seg.active_before_learning for seg in cell.topdown_segments])
+            if grow and cell_is_activating:
+                n_grown += self._grow_cell_segments(cell, cell.distal_segments, distal_active[i].any())
+                n_grown += self._grow_cell_segments(cell, cell.topdown_segments, topdown_active[i].any())
             for seg in cell.all_segments():
-                seg_active = seg.active_before_learning
-                segment_learns = False
+                n_evaluated += 1
                 if seg.proximal():
                     segment_learns = cell_is_activating
                 elif seg.distal():
-                    segment_learns = (cell_is_activating and (seg_active or not any_distal_active)) or \
-                        (cell_biased and not cell_is_activating and seg_active)
-                elif seg.topdown():
-                    segment_learns = (cell_is_activating and (seg_active or not any_topdown_active)) or \
-                        (cell_biased and not cell_is_activating and seg_active)
+                    segment_learns = distal_learns[i, seg.index]
+                else:
+                    segment_learns = topdown_learns[i, seg.index]
 
                 if segment_learns:
                     ni, nd, nc, ndc = self.learn_segment(seg, is_activating=cell_is_activating, is_biased=cell_biased)
-                    n_increased_prox += ni
-                    n_decreased_prox += nd
-                    n_conn_prox += nc
-                    n_discon_prox += ndc
+                    if seg.proximal():
+                        n_increased_prox += ni
+                        n_decreased_prox += nd
+                        n_conn_prox += nc
+                        n_discon_prox += ndc
+                    else:
+                        n_increased_dist += ni
+                        n_decreased_dist += nd
+                        n_conn_dist += nc
+                        n_discon_dist += ndc
+                    n_learned += 1
+                    n_touched += seg.n_synapses()
                 else:
                     # Re-initialize change state
                     seg.decay_permanences()
-                    seg.syn_change = [0 for x in seg.syn_change]
+                    seg.syn_change[:] = [0] * len(seg.syn_change)  # In place, may be a view of mapped storage
+
+        log("Distal/Topdown: +%d/-%d (%d connected, %d disconnected)", n_increased_dist, n_decreased_dist, n_conn_dist, n_discon_dist)
+        if n_grown:
+            log("Grew %d distal/topdown synapses", n_grown)
+        stats.count("segments_evaluated", n_evaluated)
+        stats.count("segments_learned", n_learned)
+        stats.count("synapses_touched", n_touched)
+        stats.count("synapses_increased", n_increased_prox + n_increased_dist)
+        stats.count("synapses_decreased", n_decreased_prox + n_decreased_dist)
+        stats.count("connections_made", n_conn_prox + n_conn_dist)
+        stats.count("connections_broken", n_discon_prox + n_discon_dist)
+        stats.count("synapses_grown", n_grown)
+        stats.lap("segment_learning", clock)
+
+    def learning_state(self):
+        '''
+        Returns copy of the state learn_segments reads besides synapses: input,
+        bias, activations of this region and the region above (distal / top-down
+        sources) and active_before_learning of each segment
+        '''
+        region_above = self.region_above()
+        return {
+            "input": np.array(dense_input(self.input), dtype=float),
+            "bias": np.copy(self.bias),
+            "activation": np.copy(self.activation),
+            "activation_above": np.copy(region_above.activation) if region_above else None,
+            "active_before_learning": [seg.active_before_learning for cell in self.cells for seg in cell.all_segments()]
+        }
 
-        log("Distal/Topdown: +%d/-%d (%d connected, %d disconnected)" % (n_increased_dist, n_decreased_dist, n_conn_dist, n_discon_dist))
+    def _swap_learning_state(self, state):
+        '''
+        Put state (see learning_state) in place, returning the state it replaced
+        '''
+        region_above = self.region_above()
+        segments = [seg for cell in self.cells for seg in cell.all_segments()]
+        replaced = {
+            "input": self.input,
+            "bias": self.bias,
+            "activation": np.copy(self.activation),
+            "activation_above": np.copy(region_above.activation) if region_above else None,
+            "active_before_learning": [seg.active_before_learning for seg in segments]
+        }
+        self.input = state["input"]
+        self.bias = state["bias"]
+        self.activation[:] = state["activation"]
+        if region_above:
+            region_above.activation[:] = state["activation_above"]
+        for seg, active in zip(segments, state["active_before_learning"]):
+            seg.active_before_learning = active
+        return replaced
+
+    def replay_learning(self, activating, state):
+        '''
+        Run learn_segments for an earlier step, from its activating cells and
+        learning_state(), leaving current state unchanged
+        '''
+        current = self._swap_learning_state(state)
+        try:
+            self.learn_segments(activating)
+        finally:
+            self._swap_learning_state(current)
 
-        n_boosted = 0
-        all_field_sizes = []
+    def do_learning(self, activating):
+        '''Learn segments (see learn_segments), then update duty cycles, boosts
+        and inhibition radius.
+
+        Over the step latency budget segment learning is deferred to
+        PPHTMBrain.catch_up with a copy of the state it reads (replayed in step
+        order, see replay_learning), or skipped with STEP_BUDGET_SKIP_LEARNING.
+        Boost / radius updates are deferred too. Duty cycles are always updated.
+
+        Args:
+            activating (np.array - bool): Activation in this step after inhibition
+        '''
+        stats = self.stats
+        brain = self.brain
+        if brain.config("STEP_BUDGET_SKIP_LEARNING") and brain.over_budget():
+            brain.record_degraded("learning_skipped")
+            log("R%d skipping segment learning at T%d (over step latency budget)", self.index, brain.t)
+        else:
+            # Earlier deferred learning of this region must run first
+            brain.catch_up(deadline=brain.step_deadline, region=self, task="learning")
+            if brain.over_budget() or brain.pending(self, "learning"):
+                brain.defer(self, "learning", np.copy(activating), self.learning_state())
+            else:
+                self.learn_segments(activating)
+        clock = time.time()
+
+        prior_active_duty_cycle = np.copy(self.active_duty_cycle)
         for i, cell in enumerate(self.cells):
-            neighbors = self._neighbors_of(cell)
-            min_duty_cycle = 0.01 * self._max_duty_cycle(neighbors) # Based on active duty
             cell_active = activating[i]
             sufficient_overlap = self.overlap[i] > self.brain.min_overlap
             biased = self.bias[i] > BIAS_DUTY_CUTOFF
             cell.update_duty_cycles(active=cell_active, overlap=sufficient_overlap, bias=biased)
+        stats.lap("duty_boost", clock)
+
+        # Boost and radius updates only depend on current duty cycles / connections,
+        # so over the step latency budget they are queued (see PPHTMBrain.catch_up)
+        if self.brain.over_budget():
+            self.brain.defer(self, "boost", prior_active_duty_cycle)
+        else:
+            self.update_boosts(prior_active_duty_cycle)
+        if self.brain.over_budget():
+            self.brain.defer(self, "radius")
+        else:
+            self.update_inhibition_radius()
+
+    def update_boosts(self, prior_active_duty_cycle):
+        '''
+        Update boosts from active duty cycles (min duty cycle among neighbors),
+        and boost permanences of cells with low overlap / bias duty cycles
+
+        Args:
+            prior_active_duty_cycle (np.array): active duty cycles before last update
+        '''
+        stats = self.stats
+        clock = time.time()
+        kernels = self.brain.kernels
+        n_boosted = 0
+        # Based on active duty
+        min_duty_cycles = kernels.min_duty_cycles(prior_active_duty_cycle, self.active_duty_cycle, self.neighbor_mask())
+        boosts = kernels.boosts(self.active_duty_cycle, min_duty_cycles, self.brain.config("BOOST_MULTIPLIER"))
+        for i, cell in enumerate(self.cells):
+            min_duty_cycle = min_duty_cycles[i]
             boost_inhibitory = self.bias_duty_cycle[i] > LIMIT_BIAS_DUTY_CYCLE
             if boost_inhibitory:
                 self._increase_cell_permanences(i, self.brain.config("DISTAL_BOOST_MULT") * CONNECTED_PERM, type="distal", excitatory=False)
                 self._increase_cell_permanences(i, self.brain.config("DISTAL_BOOST_MULT") * CONNECTED_PERM, type="topdown", excitatory=False)
             if T_START_PROXIMAL_BOOSTING != -1 and self.brain.t > T_START_PROXIMAL_BOOSTING:
-                self.boost[i] = self._boost_function(i, min_duty_cycle)  # Updates boost value for cell (higher if below min)
+                self.boost[i] = boosts[i]  # Updates boost value for cell (higher if below min)
 
                 # Check if overlap duty cycle less than minimum (note: min is calculated from max *active* not overlap)
                 if self.overlap_duty_cycle[i] < min_duty_cycle:
@@ -680,17 +1238,25 @@ class Region(object):
                     self._increase_cell_permanences(i, self.brain.config("DISTAL_BOOST_MULT") * CONNECTED_PERM, type="distal")
                     self._increase_cell_permanences(i, self.brain.config("DISTAL_BOOST_MULT") * CONNECTED_PERM, type="topdown")
                     n_boosted += 1
-            all_field_sizes.append(self.cells[i].connected_receptive_field_size())
-
+        stats.count("cells_boosted", n_boosted)
+        stats.lap("duty_boost", clock)
         if n_boosted:
-            log("Boosting %d due to low overlap duty cycle" % n_boosted)
+            log("Boosting %d due to low overlap duty cycle", n_boosted)
 
-        # Update inhibition radius (based on updated active connections in each column)
+    def update_inhibition_radius(self):
+        '''
+        Update inhibition radius (based on updated active connections in each column)
+        '''
+        clock = time.time()
+        all_field_sizes = []
+        for cell in self.cells:
+            all_field_sizes.append(cell.connected_receptive_field_size())
         self.inhibition_radius = util.average(all_field_sizes) * self.brain.config("INHIBITION_RADIUS_DISCOUNT")
         min_positive_radius = 1.0
         if self.inhibition_radius and self.inhibition_radius < min_positive_radius:
             self.inhibition_radius = min_positive_radius
-        log("Setting inhibition radius to %s" % self.inhibition_radius)
+        log("Setting inhibition radius to %s", self.inhibition_radius)
+        self.stats.lap("radius", clock)
 
     def tempero_spatial_pooling(self, learning_enabled=True):
         '''
@@ -701,20 +1267,27 @@ class Region(object):
         (same region and regions above -- top-down predictions)
         '''
 
+        stats = self.stats
+        clock = time.time()
+
         # Phase 1: Overlap
         self.overlap = self.do_overlap()
-        if VERBOSITY >= 2: log("%s << Overlap (normalized)" % printarray(self.overlap, continuous=True), level=2)
+        clock = stats.lap("overlap", clock)
+        log("%s << Overlap (normalized)", lazy(printarray, self.overlap, continuous=True), level=2)
 
         # Phase 2: Inhibition
         activating = self.do_inhibition()
-        if VERBOSITY >= 2: log("%s << Activating (inhibited)" % printarray(activating, continuous=True), level=2)
+        stats.count("active_cells", int(np.count_nonzero(activating)))
+        clock = stats.lap("inhibition", clock)
+        log("%s << Activating (inhibited)", lazy(printarray, activating, continuous=True), level=2)
 
 
         # Phase 3: Learning
         if learning_enabled:
-            if VERBOSITY >= 2: log("%s << Active Duty Cycle" % printarray(self.active_duty_cycle, continuous=True), level=2)
-            if VERBOSITY >= 2: log("%s << Overlap Duty Cycle" % printarray(self.overlap_duty_cycle, continuous=True), level=2)
+            log("%s << Active Duty Cycle", lazy(printarray, self.active_duty_cycle, continuous=True), level=2)
+            log("%s << Overlap Duty Cycle", lazy(printarray, self.overlap_duty_cycle, continuous=True), level=2)
             self.do_learning(activating)
+            clock = time.time()
 
 
         # Phase 4: Calculate new activations
@@ -728,30 +1301,63 @@ class Region(object):
                 cell.activation -= cell.fade_rate
             if cell.activation < 0:
                 cell.activation = 0.0
-            self.activation[i] = cell.activation
-        if VERBOSITY >= 2: log("%s << Activations" % self.print_cells(), level=2)
+        clock = stats.lap("activation", clock)
+        log("%s << Activations", lazy(self.print_cells), level=2)
 
 
         # Phase 5: Calculate Distal Biases (TM?)
         self.pre_bias = np.copy(self.bias)
         self.bias = self.calculate_biases()
-        if VERBOSITY >= 2: log("%s << Bias" % printarray(self.bias, continuous=True), level=2)
+        stats.lap("bias", clock)
+        log("%s << Bias", lazy(printarray, self.bias, continuous=True), level=2)
 
-        if VERBOSITY >= 1:
-            # Log average synapse permanence in region
-            permanences = []
-            n_connected = 0
-            n_synapses = 0
-            for cell in self.cells:
-                for seg in cell.distal_segments:
-                    permanences.append(util.average(seg.syn_permanences))
-                    n_synapses += seg.n_synapses()
-                    n_connected += len(filter(lambda x : x > CONNECTED_PERM, seg.syn_permanences))
-            ave_permanence = util.average(permanences)
-            log("R%d - average distal synapse permanence: %.1f (%.1f%% connected of %d)" % (self.index, ave_permanence, (n_connected/float(n_synapses))*100., n_synapses), level=1)
+        if tracer.enabled(1):
+            # Log average synapse permanence in region (running aggregates, see permanence_stats)
+            permanence_stats = self.permanence_stats
+            log("R%d - average distal synapse permanence: %.1f (%.1f%% connected of %d)", self.index, permanence_stats.mean_permanence(Segment.DISTAL), permanence_stats.connected_fraction(Segment.DISTAL)*100., permanence_stats.n_synapses[Segment.DISTAL], level=1)
 
 
 
+    ##################
+    # Temporal Subsampling
+    ##################
+
+    def _integrate_input(self, input):
+        '''
+        Accumulate input received since the last step according to input_integration
+
+        Held inputs are kept as given (sparse inputs stay sparse), and only
+        copied if a change threshold will compare them to later inputs
+        '''
+        hold = self.input_integration == "hold"
+        if hold and (isinstance(input, SparseInput) or not self.step_change_threshold):
+            self.integrated_input = input if isinstance(input, SparseInput) else dense_input(input)
+            self.n_integrated += 1
+            return
+        input = dense_input(input)
+        if self.integrated_input is None or hold:
+            self.integrated_input = np.copy(input)
+        elif self.input_integration == "max":
+            self.integrated_input = np.maximum(self.integrated_input, input)
+        elif self.input_integration == "mean":
+            self.integrated_input = self.integrated_input + (input - self.integrated_input) / (self.n_integrated + 1)
+        self.n_integrated += 1
+
+    def _step_due(self):
+        '''
+        Decide whether this region runs on the current input (brain.t)
+
+        If a change threshold is set, step only when the integrated input differs
+        from the input of the last step by more than the threshold (L1), otherwise
+        step on every step_every-th input
+        '''
+        if not self.n_steps:
+            return True
+        if self.step_change_threshold:
+            change = np.sum(np.abs(dense_input(self.integrated_input) - dense_input(self.last_stepped_input)))
+            return change > self.step_change_threshold
+        return self.brain.t % self.step_every == 0
+
     ##################
     # Primary Step Function
     ##################
@@ -765,12 +1371,43 @@ class Region(object):
             * self.last_activation is an array of activations before new input
             * self.pre_bias is an array of biases before new input
             * cell.activation for each cell is updated
-        '''
-        self.input = input
 
-        self.tempero_spatial_pooling(learning_enabled=learning_enabled)  # Calculates active cells
+        Regions with a step rate (REGION_STEP_EVERY) or change threshold
+        (REGION_STEP_CHANGE_THRESHOLD) hold their state between steps. Held
+        regions return their last activations, so regions below keep using
+        the last top-down activation.
+
+        Args:
+            input (np.array or SparseInput)
 
-        return [c.activation for c in self.cells]
+        Returns:
+            SparseInput of cell activations (input to the region above)
+        '''
+        self._integrate_input(input)
+        if not self._step_due():
+            self.n_skipped += 1
+            log("R%d holding at T%d (%d inputs integrated)", self.index, self.brain.t, self.n_integrated, level=2)
+            return SparseInput.from_dense(self.activation)
+
+        self.input = self.integrated_input
+        if self.step_change_threshold:
+            self.last_stepped_input = self.integrated_input
+        self.integrated_input = None
+        self.n_integrated = 0
+        self.n_steps += 1
+
+        clock = self.stats.begin_step(self.brain.t)
+        if not learning_enabled and self.brain.config("FAST_INFERENCE"):
+            self.brain.inference_engine().step(self)
+            self.stats.count("active_cells", int(np.count_nonzero(self.activation == 1.0)))
+            self.stats.lap("inference", clock)
+        else:
+            if self.brain.engine:
+                self.brain.engine.apply_segment_activity(self)
+            self.tempero_spatial_pooling(learning_enabled=learning_enabled)  # Calculates active cells
+        self.stats.end_step()
+
+        return SparseInput.from_dense(self.activation)
 
 
 
@@ -784,6 +1421,20 @@ class PPHTMBrain(object):
         self.t = 0
         self.active_behaviors = []
         self.inputs = None
+        self.synapse_version = 0  # Incremented when all synapses are replaced (connectivity changes are tracked per region)
+        self.engine = None  # PPHTMInferenceEngine, see inference_engine()
+        self.kernels = pphtm_kernels.NumpyKernels()  # See pphtm_kernels.get_kernels()
+        self.storage_path = None  # Checkpoint directory backing memory-mapped synapses
+        self.memory_history = []  # Samples of memory footprint every MEMORY_SAMPLE_INTERVAL steps
+
+        # Step latency (see latency_report) and budget (STEP_LATENCY_BUDGET)
+        self.latency = {"learn": LatencyHistogram(), "infer": LatencyHistogram()}
+        self.step_deadline = None  # time.time() by which the current step should finish
+        self.catch_up_queue = OrderedDict()  # (region index, task, t or None) -> args of deferred updates
+        self.degraded = dict((kind, 0) for kind in ["degraded_steps", "learning_deferred", "learning_skipped", "boost_deferred", "radius_deferred", "caught_up"])
+        self._step_degraded = False
+
+        self.profiler = None  # profiling.Profiler wrapping every Nth process() call
 
         # Brain config
         self.n_inputs = r1_inputs
@@ -815,7 +1466,33 @@ class PPHTMBrain(object):
             "DIST_SYNAPSE_ACTIVATION_LEARN_THRESHHOLD": 1.0,
             "PROX_SYNAPSE_ACTIVATION_LEARN_THRESHHOLD": 0.5,
             "DISTAL_BOOST_MULT": 0.01,
-            "INHIBITION_RADIUS_DISCOUNT": 0.8
+            "INHIBITION_RADIUS_DISCOUNT": 0.8,
+            # Temporal subsampling (int/float or list with one value per region)
+            "REGION_STEP_EVERY": 1,
+            "REGION_STEP_CHANGE_THRESHOLD": 0.0,
+            "REGION_INPUT_INTEGRATION": "hold", # hold, max or mean
+            "FAST_INFERENCE": True, # Use frozen inference engine when learning is disabled
+            "BINARY_ENGINE": False, # Inference engine scores binary-source segments with bitsets
+            # Distal / top-down connectivity
+            "DISTAL_CONNECTIVITY": "random", # random, radius, gaussian or grow
+            "DISTAL_RADIUS": 3.0, # Radius (radius) or sigma (gaussian) in cells
+            "MAX_DISTAL_SYNAPSES": 0, # Max synapses per distal / top-down segment (0: no cap)
+            "NEW_SYNAPSE_COUNT": 5, # Synapses added per learning step (grow)
+            # Pruning
+            "PRUNE_INTERVAL": 0, # Steps between prune passes (0: no pruning)
+            "PRUNE_FLOOR": 0.01, # Synapses with permanence below floor are pruned...
+            "PRUNE_GRACE": 100, # ...once they stay below it for this many steps
+            # Implicit (procedural) potential pools
+            "IMPLICIT_POOLS": False, # Generate potential synapses from POOL_SEED instead of storing them
+            "POOL_SEED": 0,
+            "POOL_RELEASE_INTERVAL": 100, # Learning steps between releasing materialized pools (0: never)
+            "KERNEL_BACKEND": "auto", # numpy, numba, or auto (numba if installed)
+            "STATS_HISTORY": 256, # Steps of phase timings / counters kept per region (see stats())
+            "PERMANENCE_REPORT_INTERVAL": 0, # Steps between "permanences" trace events (0: never)
+            "MEMORY_SAMPLE_INTERVAL": 0, # Steps between memory_history samples (0: never)
+            "STEP_LATENCY_BUDGET": 0.0, # Seconds per process() call; over it learning and boost / radius updates are deferred (0: no budget)
+            "STEP_BUDGET_MAX_DEFERRED_LEARNING": 16, # Deferred learning steps kept per region, the oldest is skipped past this
+            "STEP_BUDGET_SKIP_LEARNING": False # Skip (instead of defer) segment learning over the budget
         }
 
 
@@ -825,11 +1502,22 @@ class PPHTMBrain(object):
     def config(self, key):
         return self.CONFIG.get(key)
 
+    def region_config(self, key, region_index=0):
+        '''
+        Config value for a region. List values hold one entry per region
+        (the last entry is used for any regions beyond the list).
+        '''
+        value = self.config(key)
+        if type(value) in [list, tuple]:
+            return value[min(region_index, len(value) - 1)]
+        return value
+
     def initialize(self, n_inputs=None, **params):
         self.CONFIG.update(params)
 
         if n_inputs is not None:
             self.n_inputs = n_inputs
+        self.kernels = pphtm_kernels.get_kernels(self.config("KERNEL_BACKEND"))
 
         n_inputs = self.n_inputs
 
@@ -843,19 +1531,234 @@ class PPHTMBrain(object):
             n_inputs = cpr  # Next region will have 1 input for each output cell
             self.regions.append(r)
         self.t = 0
-        log("Initialized %s" % self)
+        self.synapse_version += 1
+        self.memory_history = []
+        self.catch_up_queue.clear()
+        log("Initialized %s (%s kernels)", self, self.kernels.name)
+
+    def inference_engine(self):
+        '''
+        Returns PPHTMInferenceEngine with connectivity snapshot of current synapses
+        '''
+        if self.engine is None:
+            from pphtm_inference import PPHTMInferenceEngine
+            self.engine = PPHTMInferenceEngine(self)
+        self.engine.refresh()
+        return self.engine
+
+    def prune(self):
+        '''
+        Run a prune / compaction pass on all regions (see Region.prune_synapses)
+        '''
+        for r in self.regions:
+            r.prune_synapses()
+
+    def release_pools(self):
+        '''
+        Release synapse lists of all implicit-pool segments (see Segment.release)
+        '''
+        for r in self.regions:
+            for cell in r.cells:
+                for seg in cell.all_segments():
+                    seg.release()
+
+    def pruning_report(self):
+        '''
+        Returns:
+            list (one per region) of dicts with pruned (total) and remaining (current) synapse counts
+        '''
+        return [{"region": r.index, "pruned": r.n_pruned, "remaining": sum(r.permanence_stats.n_synapses.values())} for r in self.regions]
+
+    def save(self, path):
+        '''
+        Write checkpoint directory (see pphtm_checkpoint)
+        '''
+        import pphtm_checkpoint
+        pphtm_checkpoint.save(self, path)
+
+    @staticmethod
+    def load(path, mmap_mode=None):
+        '''
+        Returns PPHTMBrain restored from checkpoint directory (see pphtm_checkpoint)
+        With mmap_mode ("r+", "r" or "c") synapses stay in the mapped checkpoint files
+        '''
+        import pphtm_checkpoint
+        return pphtm_checkpoint.load(path, mmap_mode=mmap_mode)
+
+    def flush(self):
+        '''
+        Write in-place changes of memory-mapped synapses to the storage files
+        '''
+        for r in self.regions:
+            for flat in r.synapse_storage.values():
+                if isinstance(flat, np.memmap):
+                    flat.flush()
+
+    def stats(self):
+        '''
+        Returns dict with per-region step instrumentation (see pphtm_stats.StepStats.summary)
+        and synapse aggregates (permanences, see Region.permanence_stats), and
+        step latency (see latency_report)
+        '''
+        summaries = []
+        for r in self.regions:
+            summary = r.stats.summary()
+            summary["permanences"] = r.permanence_stats.summary()
+            summaries.append(summary)
+        return {
+            "t": self.t,
+            "regions": summaries,
+            "latency": self.latency_report()
+        }
+
+    def over_budget(self):
+        '''
+        True if the current step has passed its STEP_LATENCY_BUDGET deadline
+        '''
+        return self.step_deadline is not None and time.time() > self.step_deadline
+
+    def record_degraded(self, kind):
+        self.degraded[kind] += 1
+        self._step_degraded = True
+
+    def _pending_keys(self, region=None, task=None):
+        return [key for key in self.catch_up_queue if (region is None or key[0] == region.index) and (task is None or key[1] == task)]
+
+    def pending(self, region=None, task=None):
+        '''
+        Number of deferred updates queued (of region and / or task if given)
+        '''
+        return len(self._pending_keys(region=region, task=task))
+
+    def defer(self, region, task, *args):
+        '''
+        Queue a region update for catch_up(). "learning" updates (args:
+        activating, learning_state) are kept per step, up to
+        STEP_BUDGET_MAX_DEFERRED_LEARNING per region. "boost" or "radius"
+        updates replace any pending update of the same task (and move behind
+        pending learning)
+        '''
+        if task == "learning":
+            key = (region.index, task, self.t)
+            pending = self._pending_keys(region=region, task=task)
+            if len(pending) >= self.config("STEP_BUDGET_MAX_DEFERRED_LEARNING"):
+                del self.catch_up_queue[pending[0]]
+                self.record_degraded("learning_skipped")
+                log("R%d skipping deferred learning of T%d (too many deferred steps)", region.index, pending[0][2])
+        else:
+            key = (region.index, task, None)
+            self.catch_up_queue.pop(key, None)
+        self.catch_up_queue[key] = args
+        self.record_degraded("%s_deferred" % task)
+        log("R%d deferring %s update at T%d (over step latency budget)", region.index, task, self.t)
+
+    def catch_up(self, deadline=None, region=None, task=None):
+        '''
+        Run deferred region updates (of region and / or task if given) in order
+        until none are left or deadline (time.time()) passes
+
+        Returns:
+            int: number of updates run
+        '''
+        n_run = 0
+        for key in self._pending_keys(region=region, task=task):
+            if deadline is not None and time.time() >= deadline:
+                break
+            region_index, key_task, t = key
+            args = self.catch_up_queue.pop(key)
+            if key_task == "learning":
+                self.regions[region_index].replay_learning(*args)
+            elif key_task == "boost":
+                self.regions[region_index].update_boosts(*args)
+            else:
+                self.regions[region_index].update_inhibition_radius()
+            n_run += 1
+        if n_run:
+            self.degraded["caught_up"] += n_run
+        return n_run
+
+    def latency_report(self):
+        '''
+        Returns dict with step latency summaries (see pphtm_stats.LatencyHistogram)
+        of learning and inference steps, degraded mode counts and pending updates
+        '''
+        return {
+            "learn": self.latency["learn"].summary(),
+            "infer": self.latency["infer"].summary(),
+            "degraded": dict(self.degraded),
+            "pending": len(self.catch_up_queue)
+        }
+
+    def memory_report(self, predictor=None, forks=()):
+        '''
+        Returns dict with estimated bytes by region, object kind and segment
+        type (see pphtm_memory), including predictor lookup tables and fork
+        buffers if given
+        '''
+        import pphtm_memory
+        return pphtm_memory.memory_report(self, predictor=predictor, forks=forks)
+
+    def fork(self, n_branches=1):
+        '''
+        Returns BrainFork sharing this brain's synapses read-only, with n_branches
+        copies of the current per-step state (for lookahead prediction)
+        '''
+        from pphtm_inference import BrainFork
+        return BrainFork(self, n_branches=n_branches)
 
     def process(self, readings, learning=False):
         '''
         Step through all regions inputting output of each into next
+        Regions hand off active cells (SparseInput) to the region above
+
+        Args:
+            readings (np.array or SparseInput): input to region 0
+
         Returns output of last region
         '''
-        log("~~~~~~~~~~~~~~~~~ Processing inputs at T%d" % self.t, level=1)
+        if self.profiler is not None:
+            return self.profiler.call(self._process, readings, learning=learning)
+        return self._process(readings, learning=learning)
+
+    def _process(self, readings, learning=False):
+        log("~~~~~~~~~~~~~~~~~ Processing inputs at T%d", self.t, level=1)
+        start = time.time()
+        budget = self.config("STEP_LATENCY_BUDGET")
+        self.step_deadline = start + budget if budget else None
+        self._step_degraded = False
         self.inputs = readings
         _in = self.inputs
         for i, r in enumerate(self.regions):
-            log("Step processing for region %d\n%s << Input" % (i, printarray(_in, continuous=True)), level=2)
-            out = r.step(_in, learning_enabled=learning)
-            _in = out
+            log("Step processing for region %d\n%s << Input", i, lazy(lambda: printarray(dense_input(_in), continuous=True)), level=2)
+            _in = r.step(_in, learning_enabled=learning)
+        if learning:
+            prune_interval = self.config("PRUNE_INTERVAL")
+            if prune_interval and self.t % prune_interval == 0:
+                self.prune()
+            release_interval = self.config("POOL_RELEASE_INTERVAL")
+            if self.config("IMPLICIT_POOLS") and release_interval and self.t % release_interval == 0:
+                self.release_pools()
+        report_interval = self.config("PERMANENCE_REPORT_INTERVAL")
+        if report_interval and self.t % report_interval == 0:
+            for r in self.regions:
+                tracer.event("permanences", t=self.t, region=r.index, **r.permanence_stats.summary())
+        sample_interval = self.config("MEMORY_SAMPLE_INTERVAL")
+        if sample_interval and self.t % sample_interval == 0:
+            import pphtm_memory
+            self.memory_history.append(pphtm_memory.memory_sample(self))
+        if self.catch_up_queue and not self._step_degraded:
+            # Use time left in this step's budget for deferred updates
+            self.catch_up(deadline=self.step_deadline)
+        if self._step_degraded:
+            self.degraded["degraded_steps"] += 1
+        self.step_deadline = None
+        self.latency["learn" if learning else "infer"].record(time.time() - start)
         self.t += 1 # Move time forward one step
-        return out
+        return list(self.regions[-1].activation)
+
+    def process_sparse(self, active, values=None, learning=False):
+        '''
+        Process input given as sorted active input indexes (and optional values,
+        default 1.0) without building a dense input vector
+        '''
+        return self.process(SparseInput(active, values=values, n=self.n_inputs), learning=learning)
@@ -0,0 +1,792 @@
+#!/usr/bin/env python
+
+import os
+import glob
+import json
+import time
+import random
+import threading
+import Queue
+from collections import deque
+import numpy as np
+import pphtm_brain
+from pphtm_brain import log
+
+# Brain checkpoints
+# A checkpoint is a directory holding manifest.json (format version, config,
+# scalar state, RNG state) and one .npy file per array. Each base snapshot
+# writes its arrays to new files (name.bN.npy for base N) and switches the
+# manifest last, so a crash mid-write leaves the previous base intact; files
+# no longer listed in the manifest are removed afterwards. Synapses of each
+# region are stored CSR-style: per-segment counts plus flat arrays, with
+# segments ordered by cell, then type (proximal, distal, top-down), then index.
+#
+# load(path, mmap_mode) can map the flat synapse arrays instead of reading
+# them: segment synapse lists become views into region-wide np.memmap arrays.
+# With "r+" permanence updates are written in place to the checkpoint files;
+# with "r" the mapping is read-only and can be shared by inference processes.
+# Mapped storage needs a fixed synapse structure (no grow, prune or implicit pools).
+#
+# DeltaCheckpointer appends compressed deltas (delta_NNNNNN.npz) to a base
+# checkpoint: changed synapse values as (segment, slot, value) plus the small
+# per-step state. load() replays deltas of the current base in order; with
+# mmap_mode "r+" the replayed values land in the mapped base files, so load()
+# then writes a new base referencing them and drops the deltas (deltas left
+# behind would later be replayed over files the brain keeps changing).
+#
+# Writing is split into capture (copy state into memory, in the step loop) and
+# write (serialize to disk), so AsyncCheckpointWriter can write on a thread.
+# Only save() points the manifest at a brain's live mapped synapse files;
+# captured bases copy them, as the brain keeps changing the files in place.
+
+FORMAT_VERSION = 1
+MANIFEST = "manifest.json"
+
+SEGMENT_TYPES = [pphtm_brain.Segment.PROXIMAL, pphtm_brain.Segment.DISTAL, pphtm_brain.Segment.TOPDOWN]
+REGION_ARRAYS = ["overlap", "pre_bias", "bias", "pre_activation", "activation", "boost",
+                 "overlap_duty_cycle", "active_duty_cycle", "bias_duty_cycle", "excitatory_activation_mult"]
+REGION_SCALARS = ["index", "n_cells", "n_inputs", "n_cells_above", "inhibition_radius", "step_every",
+                  "step_change_threshold", "input_integration", "n_integrated", "n_steps", "n_skipped",
+                  "n_pruned", "n_synapses"]
+SYNAPSE_DTYPES = {
+    "syn_sources": np.int32,
+    "syn_permanences": np.float64,
+    "syn_change": np.int32,
+    "syn_prestep_contribution": np.float64,
+    "syn_contribution": np.float64
+}
+DELTA_LISTS = ["syn_permanences", "syn_change", "syn_contribution"]  # Synapse lists changed in place by learning
+DUTY_HISTORIES = ["recent_active_duty", "recent_overlap_duty", "recent_bias_duty"]
+DELTA_PATTERN = "delta_*.npz"
+TIMING_HISTORY = 1000  # Checkpoint timings kept by AsyncCheckpointWriter
+
+
+class CheckpointError(Exception):
+    pass
+
+
+def _pack(lists, dtype):
+    '''
+    Returns:
+        (counts, flat) np.arrays for a list of lists
+    '''
+    counts = np.array([len(l) for l in lists], dtype=np.int64)
+    flat = np.zeros(0, dtype=dtype) if not counts.sum() else np.concatenate([np.asarray(l, dtype=dtype) for l in lists if len(l)])
+    return (counts, flat)
+
+
+def _unpack(counts, flat):
+    '''
+    Inverse of _pack, returns list of python lists
+    '''
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    return [flat[s:e].tolist() for s, e in zip(starts, ends)]
+
+
+def _fsync_dir(path):
+    '''
+    Make renames / new files in directory path durable
+    '''
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _replace_file(filename, write, fsync=False):
+    '''
+    Write through write(f) to a temp file, then rename it over filename
+    (arrays mapped from an existing file stay valid)
+    '''
+    with open(filename + ".tmp", "wb") as f:
+        write(f)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.rename(filename + ".tmp", filename)
+
+
+class _Writer(object):
+
+    def __init__(self, path, mapped=None, fsync=False, base_id=None):
+        self.path = path
+        self.mapped = mapped if mapped is not None else {}  # Name -> np.memmap already backed by a file in path
+        self.fsync = fsync
+        self.base_id = base_id  # Arrays of a base go to files of their own (see filename)
+        self.files = {}  # Array name -> file in path
+
+    def filename(self, name):
+        return name + ".npy" if self.base_id is None else "%s.b%d.npy" % (name, self.base_id)
+
+    def array(self, name, value):
+        filename = self.filename(name)
+        _replace_file(os.path.join(self.path, filename), lambda f: np.save(f, np.asarray(value)), fsync=self.fsync)
+        self.files[name] = filename
+
+    def packed(self, name, lists, dtype):
+        counts, flat = _pack(lists, dtype)
+        self.array(name + "_counts", counts)
+        if name in self.mapped:
+            # Synapse structure is fixed while mapped, only flush changes to the mapped file
+            self.mapped[name].flush()
+            self.files[name] = os.path.basename(self.mapped[name].filename)
+            return
+        self.array(name, flat)
+
+    def input(self, name, value):
+        '''
+        Store region / brain input (None, dense array or SparseInput), returns kind
+        '''
+        if value is None:
+            return None
+        if isinstance(value, pphtm_brain.SparseInput):
+            self.array(name + "_indices", value.indices)
+            self.array(name + "_values", value.values)
+            return {"kind": "sparse", "n": int(value.n)}
+        self.array(name, value)
+        return {"kind": "dense"}
+
+
+class _MemoryWriter(_Writer):
+    '''
+    Captures copies of arrays in memory, to be written later
+    '''
+
+    def __init__(self, path=None, mapped=None, base_id=None):
+        _Writer.__init__(self, path, mapped=mapped, base_id=base_id)
+        self.arrays = {}
+
+    def array(self, name, value):
+        self.arrays[name] = np.array(value)
+        self.files[name] = self.filename(name)
+
+    def write_npz(self, filename, fsync=False):
+        _replace_file(filename, lambda f: np.savez_compressed(f, **self.arrays), fsync=fsync)
+
+
+class _Reader(object):
+
+    def __init__(self, path, mmap_mode=None, files=None):
+        self.path = path
+        self.mmap_mode = mmap_mode
+        self.files = files or {}  # Array name -> file (see manifest "files"), default name.npy
+
+    def array(self, name, mmap_mode=None):
+        return np.load(os.path.join(self.path, self.files.get(name, name + ".npy")), mmap_mode=mmap_mode)
+
+    def packed(self, name):
+        return _unpack(self.array(name + "_counts"), self.array(name))
+
+    def mapped(self, name):
+        '''
+        Returns (flat np.memmap, list of per-segment views into it)
+        '''
+        counts = self.array(name + "_counts")
+        if not counts.sum():
+            # Empty files can't be mapped
+            flat = self.array(name)
+        else:
+            flat = self.array(name, mmap_mode=self.mmap_mode)
+        ends = np.cumsum(counts)
+        return (flat, [flat[s:e] for s, e in zip(ends - counts, ends)])
+
+    def input(self, name, spec):
+        if spec is None:
+            return None
+        if spec["kind"] == "sparse":
+            return pphtm_brain.SparseInput(self.array(name + "_indices"), values=self.array(name + "_values"), n=spec["n"])
+        return np.array(self.array(name))
+
+
+class _NpzReader(_Reader):
+
+    def __init__(self, npz):
+        _Reader.__init__(self, None)
+        self.npz = npz  # Loaded .npz or dict of arrays
+
+    def array(self, name, mmap_mode=None):
+        return self.npz[name]
+
+
+def _segments(region):
+    return [seg for cell in region.cells for seg in cell.all_segments()]
+
+
+def _pending_segment_activity(region):
+    '''
+    Segment activity for the next learning step (see PPHTMInferenceEngine.apply_segment_activity)
+    '''
+    activity = region.inference_segment_activity
+    active = []
+    for i, cell in enumerate(region.cells):
+        for seg in cell.all_segments():
+            if activity is not None and seg.distal():
+                active.append(bool(activity[0][i, seg.index]))
+            elif activity is not None and seg.topdown():
+                active.append(bool(activity[1][i, seg.index]))
+            else:
+                active.append(bool(seg.active_before_learning))
+    return active
+
+
+def _mapped_storage(brain, path):
+    '''
+    Synapse memmaps of brain that are backed by files in path (see load)
+    '''
+    if brain.storage_path is None or os.path.realpath(brain.storage_path) != os.path.realpath(path):
+        return {}
+    mapped = {}
+    for r in brain.regions:
+        for name, flat in r.synapse_storage.items():
+            # Copy-on-write ("c") changes never reach the files
+            if isinstance(flat, np.memmap) and flat.mode in ["r+", "r"]:
+                mapped["r%d_%s" % (r.index, name)] = flat
+    return mapped
+
+
+def _save_region_state(writer, region):
+    '''
+    Write per-step state of region (everything but synapses and structure)
+
+    Returns:
+        dict of scalars for the manifest
+    '''
+    prefix = "r%d_" % region.index
+    segments = _segments(region)
+    for name in REGION_ARRAYS:
+        writer.array(prefix + name, getattr(region, name))
+    for name in DUTY_HISTORIES:
+        writer.packed(prefix + name, [getattr(cell, name) for cell in region.cells], np.int8)
+    writer.array(prefix + "segment_active", _pending_segment_activity(region))
+    writer.packed(prefix + "prune_sources", [sorted(seg.prune_candidates.keys()) for seg in segments], np.int64)
+    writer.packed(prefix + "prune_t", [[seg.prune_candidates[k] for k in sorted(seg.prune_candidates.keys())] for seg in segments], np.int64)
+    if region.last_activation is not None:
+        writer.array(prefix + "last_activation", region.last_activation)
+    spec = dict((name, getattr(region, name)) for name in REGION_SCALARS)
+    spec["last_activation"] = region.last_activation is not None
+    spec["input"] = writer.input(prefix + "input", region.sparse_input if region.sparse_input is not None else region._input)
+    spec["integrated_input"] = writer.input(prefix + "integrated_input", region.integrated_input)
+    spec["last_stepped_input"] = writer.input(prefix + "last_stepped_input", region.last_stepped_input)
+    return spec
+
+
+def _save_region(writer, region):
+    prefix = "r%d_" % region.index
+    spec = _save_region_state(writer, region)
+    writer.array(prefix + "excitatory", [cell.excitatory for cell in region.cells])
+    writer.array(prefix + "segment_counts", [[len(cell.proximal_segments), len(cell.distal_segments), len(cell.topdown_segments)] for cell in region.cells])
+    segments = _segments(region)
+    implicit = [seg.pool_overlay is not None for seg in segments]
+    materialized = [seg.materialized() for seg in segments]
+    writer.array(prefix + "segment_materialized", materialized)
+    for name, dtype in SYNAPSE_DTYPES.items():
+        writer.packed(prefix + name, [getattr(seg, name) if m else [] for seg, m in zip(segments, materialized)], dtype)
+    spec["implicit"] = any(implicit)
+    if any(implicit):
+        released = [imp and not m for imp, m in zip(implicit, materialized)]
+        writer.packed(prefix + "pool_slots", [seg.pool_slots if imp and m else [] for seg, imp, m in zip(segments, implicit, materialized)], np.int64)
+        writer.packed(prefix + "pool_overlay_slots", [sorted(seg.pool_overlay.keys()) if r else [] for seg, r in zip(segments, released)], np.int64)
+        writer.packed(prefix + "pool_overlay_permanences", [[seg.pool_overlay[k] for k in sorted(seg.pool_overlay.keys())] if r else [] for seg, r in zip(segments, released)], np.float64)
+        writer.packed(prefix + "pool_removed", [sorted(seg.pool_removed) if r else [] for seg, r in zip(segments, released)], np.int64)
+        writer.packed(prefix + "pool_extra_sources", [[s for s, p in seg.pool_extra] if r else [] for seg, r in zip(segments, released)], np.int64)
+        writer.packed(prefix + "pool_extra_permanences", [[p for s, p in seg.pool_extra] if r else [] for seg, r in zip(segments, released)], np.float64)
+    return spec
+
+
+def _save_brain_state(writer, brain):
+    '''
+    Write brain-level state (t, config, RNG, inputs), returns manifest dict
+    '''
+    rng_version, rng_internal, rng_gauss = random.getstate()
+    np_state = np.random.get_state()
+    writer.array("np_random_keys", np_state[1])
+    return {
+        "format_version": FORMAT_VERSION,
+        "t": brain.t,
+        "n_inputs": brain.n_inputs,
+        "min_overlap": brain.min_overlap,
+        "synapse_version": brain.synapse_version,
+        "config": brain.CONFIG,
+        "random_state": [rng_version, list(rng_internal), rng_gauss],
+        "np_random_state": [np_state[0], int(np_state[2]), int(np_state[3]), float(np_state[4])],
+        "inputs": writer.input("inputs", brain.inputs)
+    }
+
+
+def _read_manifest(path):
+    manifest_path = os.path.join(path, MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def snapshot(brain, path, base_id=None, copy_mapped=False):
+    '''
+    Capture a full checkpoint of brain in memory (see write_snapshot)
+
+    Args:
+        base_id (int): id of the new base (default: one more than base in path)
+        copy_mapped (bool): copy synapses mapped from files in path, instead of
+            flushing the files and listing them in the manifest (which is only
+            consistent if the brain doesn't step before the manifest is written)
+
+    Returns:
+        (manifest dict, dict of array name -> np.array copy)
+    '''
+    if base_id is None:
+        prior = _read_manifest(path)
+        base_id = prior.get("base_id", 0) + 1 if prior else 0
+    writer = _MemoryWriter(path, mapped={} if copy_mapped else _mapped_storage(brain, path), base_id=base_id)
+    manifest = _save_brain_state(writer, brain)
+    manifest["base_id"] = base_id
+    manifest["regions"] = [_save_region(writer, r) for r in brain.regions]
+    manifest["files"] = writer.files
+    return (manifest, writer.arrays)
+
+
+def write_snapshot(path, manifest, arrays, fsync=False, keep=()):
+    '''
+    Write a captured snapshot to directory path, then switch the manifest to
+    it and drop files (other than those in keep) and deltas of earlier bases
+    '''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    files = manifest["files"]
+    for name, value in arrays.items():
+        _replace_file(os.path.join(path, files[name]), lambda f: np.save(f, value), fsync=fsync)
+    if fsync:
+        _fsync_dir(path)
+    _replace_file(os.path.join(path, MANIFEST), lambda f: json.dump(manifest, f, indent=1, default=_json_default), fsync=fsync)
+    if fsync:
+        _fsync_dir(path)
+    current = set(files.values()) | set(keep)
+    for filename in glob.glob(os.path.join(path, "*.npy")):
+        if os.path.basename(filename) not in current:
+            os.remove(filename)
+    for filename in glob.glob(os.path.join(path, DELTA_PATTERN)):
+        os.remove(filename)
+
+
+def save(brain, path, fsync=True):
+    '''
+    Write checkpoint of brain (synapses, per-step state, config, t and RNG state) to directory path,
+    fsyncing files and directory unless fsync is False
+
+    Returns:
+        int: base id of the checkpoint (deltas of earlier bases are dropped)
+    '''
+    manifest, arrays = snapshot(brain, path)
+    write_snapshot(path, manifest, arrays, fsync=fsync)
+    log("Saved %s checkpoint to %s", brain, path)
+    return manifest["base_id"]
+
+
+def _json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(repr(value))
+
+
+def _str(value):
+    # json gives unicode strings under python 2
+    if isinstance(value, basestring):
+        return str(value)
+    if isinstance(value, list):
+        return [_str(v) for v in value]
+    return value
+
+
+def _load_region_state(reader, region, spec):
+    '''
+    Restore per-step state written by _save_region_state
+    '''
+    prefix = "r%d_" % region.index
+    for name in REGION_SCALARS:
+        setattr(region, name, _str(spec[name]))
+    for name in REGION_ARRAYS:
+        setattr(region, name, np.array(reader.array(prefix + name)))
+    for name in DUTY_HISTORIES:
+        for cell, history in zip(region.cells, reader.packed(prefix + name)):
+            setattr(cell, name, history)
+    active = reader.array(prefix + "segment_active")
+    prune_sources = reader.packed(prefix + "prune_sources")
+    prune_t = reader.packed(prefix + "prune_t")
+    for k, seg in enumerate(_segments(region)):
+        seg.active_before_learning = bool(active[k])
+        seg.prune_candidates = dict(zip(prune_sources[k], prune_t[k]))
+    region.inference_segment_activity = None
+    region.last_activation = reader.array(prefix + "last_activation").tolist() if spec["last_activation"] else None
+    region.input = reader.input(prefix + "input", spec["input"])
+    region.integrated_input = reader.input(prefix + "integrated_input", spec["integrated_input"])
+    region.last_stepped_input = reader.input(prefix + "last_stepped_input", spec["last_stepped_input"])
+
+
+def _load_region(reader, brain, spec):
+    i = spec["index"]
+    prefix = "r%d_" % i
+    region = pphtm_brain.Region(brain, i, n_cells=spec["n_cells"], n_inputs=spec["n_inputs"], n_cells_above=spec["n_cells_above"])
+    excitatory = reader.array(prefix + "excitatory")
+    segment_counts = reader.array(prefix + "segment_counts")
+    brain.regions.append(region)
+    for c in range(region.n_cells):
+        cell = pphtm_brain.Cell(region=region, index=c)
+        cell.excitatory = bool(excitatory[c])
+        for type, segments, n in zip(SEGMENT_TYPES, [cell.proximal_segments, cell.distal_segments, cell.topdown_segments], segment_counts[c]):
+            for j in range(n):
+                segments.append(pphtm_brain.Segment(cell, j, region, type=type))
+        cell.n_proximal_segments, cell.n_distal_segments, cell.n_topdown_segments = [int(n) for n in segment_counts[c]]
+        region.cells.append(cell)
+    segments = _segments(region)
+    materialized = reader.array(prefix + "segment_materialized")
+    if reader.mmap_mode:
+        synapses = {}
+        for name in SYNAPSE_DTYPES:
+            region.synapse_storage[name], synapses[name] = reader.mapped(prefix + name)
+    else:
+        synapses = dict((name, reader.packed(prefix + name)) for name in SYNAPSE_DTYPES)
+    if spec["implicit"]:
+        pool = dict((name, reader.packed(prefix + name)) for name in ["pool_slots", "pool_overlay_slots", "pool_overlay_permanences", "pool_removed", "pool_extra_sources", "pool_extra_permanences"])
+    for k, seg in enumerate(segments):
+        if spec["implicit"]:
+            seg.pool_overlay = dict(zip(pool["pool_overlay_slots"][k], pool["pool_overlay_permanences"][k]))
+            seg.pool_removed = set(pool["pool_removed"][k])
+            seg.pool_extra = zip(pool["pool_extra_sources"][k], pool["pool_extra_permanences"][k])
+            if materialized[k]:
+                seg.pool_slots = pool["pool_slots"][k]
+        if materialized[k]:
+            for name in SYNAPSE_DTYPES:
+                setattr(seg, name, synapses[name][k])
+        else:
+            for name in pphtm_brain.Segment.SYNAPSE_LISTS:
+                delattr(seg, name)
+    # After creating cells (Cell() resets its activation)
+    _load_region_state(reader, region, spec)
+    return region
+
+
+def _load_brain_state(reader, brain, manifest):
+    brain.t = manifest["t"]
+    brain.synapse_version = manifest["synapse_version"]
+    brain.CONFIG.update(dict((str(k), _str(v)) for k, v in manifest["config"].items()))
+    brain.inputs = reader.input("inputs", manifest["inputs"])
+    rng_version, rng_internal, rng_gauss = manifest["random_state"]
+    random.setstate((rng_version, tuple(rng_internal), rng_gauss))
+    np_name, np_pos, np_has_gauss, np_gauss = manifest["np_random_state"]
+    np.random.set_state((str(np_name), np.array(reader.array("np_random_keys")), np_pos, np_has_gauss, np_gauss))
+
+
+def _deltas(path, base_id):
+    '''
+    Returns list of (header, npz) of deltas of base base_id, in order
+    '''
+    deltas = []
+    for filename in sorted(glob.glob(os.path.join(path, DELTA_PATTERN))):
+        npz = np.load(filename)
+        header = json.loads(str(npz["header"]))
+        if header["base_id"] == base_id:
+            deltas.append((header, npz))
+    deltas.sort(key=lambda delta: delta[0]["seq"])
+    for i, (header, npz) in enumerate(deltas):
+        if header["seq"] != i + 1:
+            log("Delta sequence gap at %d, ignoring later deltas", i + 1)
+            return deltas[:i]
+    return deltas
+
+
+def _replay(brain, deltas):
+    '''
+    Apply synapse changes of all deltas, then per-step state of the last one
+    '''
+    for header, npz in deltas:
+        for r in brain.regions:
+            segments = _segments(r)
+            prefix = "r%d_" % r.index
+            for name in DELTA_LISTS:
+                changed_segments = npz[prefix + name + "_delta_segments"]
+                slots = npz[prefix + name + "_delta_slots"]
+                values = npz[prefix + name + "_delta_values"].tolist()
+                for k, slot, value in zip(changed_segments, slots, values):
+                    getattr(segments[k], name)[slot] = value
+    header, npz = deltas[-1]
+    reader = _NpzReader(npz)
+    for r, spec in zip(brain.regions, header["regions"]):
+        _load_region_state(reader, r, spec)
+    _load_brain_state(reader, brain, header)
+
+
+def load(path, mmap_mode=None):
+    '''
+    Returns PPHTMBrain restored from checkpoint directory path
+
+    Args:
+        mmap_mode (str): None to read synapses into lists, or "r+", "r" or "c"
+            to map them from the checkpoint files (see np.memmap)
+    '''
+    manifest = _read_manifest(path)
+    if manifest is None:
+        raise CheckpointError("No checkpoint manifest at %s" % path)
+    if manifest["format_version"] != FORMAT_VERSION:
+        raise CheckpointError("Unsupported checkpoint format version %s (expected %d)" % (manifest["format_version"], FORMAT_VERSION))
+    files = manifest["files"] if isinstance(manifest["files"], dict) else None  # Older checkpoints: name.npy
+    reader = _Reader(path, mmap_mode=mmap_mode, files=files)
+    brain = pphtm_brain.PPHTMBrain(min_overlap=manifest["min_overlap"], r1_inputs=manifest["n_inputs"])
+    brain.CONFIG.update(dict((str(k), _str(v)) for k, v in manifest["config"].items()))
+    if mmap_mode:
+        if brain.config("IMPLICIT_POOLS") or brain.config("PRUNE_INTERVAL") or brain.config("DISTAL_CONNECTIVITY") == "grow":
+            raise CheckpointError("Memory-mapped synapses need a fixed synapse structure (no implicit pools, pruning or grow connectivity)")
+        brain.storage_path = path
+    brain.kernels = pphtm_brain.pphtm_kernels.get_kernels(brain.config("KERNEL_BACKEND"))
+    for spec in manifest["regions"]:
+        _load_region(reader, brain, spec)
+    # Restore RNG state last (building cells draws from random)
+    _load_brain_state(reader, brain, manifest)
+    deltas = _deltas(path, manifest.get("base_id", 0))
+    if deltas:
+        if mmap_mode == "r":
+            raise CheckpointError("Can't replay %d deltas onto read-only mapped synapses, compact checkpoint first" % len(deltas))
+        _replay(brain, deltas)
+    for r in brain.regions:
+        r.changed_segments.clear()
+        r.recount_permanences()
+    if deltas and mmap_mode == "r+":
+        save(brain, path)
+    log("Loaded %s checkpoint from %s%s (%d deltas)", brain, path, " (mapped %s)" % mmap_mode if mmap_mode else "", len(deltas))
+    return brain
+
+
+class DeltaCheckpointer(object):
+    '''
+    Incremental checkpoints of a brain into a checkpoint directory
+
+    checkpoint() writes a full base snapshot the first time, after any change
+    of synapse structure (grow, prune, implicit pools) and every compact_every
+    deltas. Otherwise it appends a compressed delta with the synapse values
+    changed since the previous checkpoint (found by diffing the segments in
+    region.changed_segments against a copy of their last written values).
+    '''
+
+    def __init__(self, brain, path, compact_every=20):
+        self.brain = brain
+        self.path = path
+        self.compact_every = compact_every
+        self.base_id = None
+        self.n_deltas = 0
+        self.shadow = None  # Region index -> synapse list name -> flat array as last written
+        self.offsets = None  # Region index -> segment -> (segment index, start of its synapses)
+        self.counts = None  # Region index -> synapses per segment
+        self.written_t = None  # Brain t of the last checkpoint written
+
+    def _structure_changed(self):
+        if self.shadow is None or self.brain.config("IMPLICIT_POOLS"):
+            return True
+        for r in self.brain.regions:
+            counts = [seg.n_synapses() for seg in _segments(r)]
+            if counts != self.counts[r.index]:
+                return True
+        return False
+
+    def compact(self):
+        '''
+        Write a full base snapshot, dropping all deltas
+        '''
+        t = self.brain.t
+        filename = self.write(self.capture_base())
+        self.written_t = t
+        return filename
+
+    def checkpoint(self):
+        '''
+        Returns filename written (delta or base manifest)
+        '''
+        t = self.brain.t
+        filename = self.write(self.capture())
+        self.written_t = t
+        return filename
+
+    def write(self, job, fsync=False):
+        '''
+        Write a captured base or delta (see capture), returns filename
+        '''
+        kind, filename, content = job
+        if kind == "base":
+            manifest, arrays, keep = content
+            write_snapshot(self.path, manifest, arrays, fsync=fsync, keep=keep)
+            log("Saved checkpoint base %d to %s", manifest["base_id"], self.path)
+        else:
+            content.write_npz(filename, fsync=fsync)
+            if fsync:
+                _fsync_dir(self.path)
+            log("Wrote checkpoint delta %s", filename)
+        return filename
+
+    def capture_base(self):
+        '''
+        Capture a full base snapshot in memory. Synapses mapped from files in
+        path are copied, and their files kept for the brain.
+
+        Returns:
+            ("base", manifest filename, (manifest, arrays, files to keep))
+        '''
+        base_id = self.base_id + 1 if self.base_id is not None else None
+        manifest, arrays = snapshot(self.brain, self.path, base_id=base_id, copy_mapped=True)
+        keep = [os.path.basename(flat.filename) for flat in _mapped_storage(self.brain, self.path).values()]
+        self.base_id = manifest["base_id"]
+        self.n_deltas = 0
+        self.shadow, self.offsets, self.counts = {}, {}, {}
+        if self.brain.config("IMPLICIT_POOLS"):
+            self.shadow = None
+        for r in self.brain.regions:
+            r.changed_segments.clear()
+            if self.shadow is None:
+                continue
+            segments = _segments(r)
+            self.counts[r.index] = [seg.n_synapses() for seg in segments]
+            starts = np.cumsum([0] + self.counts[r.index])
+            self.offsets[r.index] = dict((seg, (k, starts[k])) for k, seg in enumerate(segments))
+            self.shadow[r.index] = dict((name, _pack([getattr(seg, name) for seg in segments], SYNAPSE_DTYPES[name])[1]) for name in DELTA_LISTS)
+        return ("base", os.path.join(self.path, MANIFEST), (manifest, arrays, keep))
+
+    def capture(self):
+        '''
+        Capture the next checkpoint (a delta, or a base when due) in memory
+
+        Returns:
+            (kind, filename, content) to pass to write()
+        '''
+        if self.n_deltas >= self.compact_every or self._structure_changed():
+            return self.capture_base()
+        writer = _MemoryWriter()
+        header = _save_brain_state(writer, self.brain)
+        header["base_id"] = self.base_id
+        header["seq"] = self.n_deltas + 1
+        header["regions"] = [_save_region_state(writer, r) for r in self.brain.regions]
+        n_changed = 0
+        for r in self.brain.regions:
+            prefix = "r%d_" % r.index
+            changed = sorted([self.offsets[r.index][seg] + (seg,) for seg in r.changed_segments])
+            for name in DELTA_LISTS:
+                dtype = SYNAPSE_DTYPES[name]
+                shadow = self.shadow[r.index][name]
+                changed_segments, slots, values = [], [], []
+                for k, start, seg in changed:
+                    current = np.asarray(getattr(seg, name), dtype=dtype)
+                    end = start + len(current)
+                    diff = np.flatnonzero(current != shadow[start:end])
+                    changed_segments.append(np.repeat(k, len(diff)))
+                    slots.append(diff)
+                    values.append(current[diff])
+                    shadow[start:end] = current
+                writer.array(prefix + name + "_delta_segments", np.concatenate(changed_segments).astype(np.int64) if changed else np.zeros(0, dtype=np.int64))
+                writer.array(prefix + name + "_delta_slots", np.concatenate(slots).astype(np.int64) if changed else np.zeros(0, dtype=np.int64))
+                writer.array(prefix + name + "_delta_values", np.concatenate(values) if changed else np.zeros(0, dtype=dtype))
+                if name == "syn_permanences":
+                    n_changed += sum([len(s) for s in slots])
+            r.changed_segments.clear()
+        writer.array("header", json.dumps(header, default=_json_default))
+        self.n_deltas += 1
+        log("Captured checkpoint delta %d (%d permanences changed)", header["seq"], n_changed, level=2)
+        return ("delta", os.path.join(self.path, "delta_%06d.npz" % header["seq"]), writer)
+
+
+class AsyncCheckpointWriter(object):
+    '''
+    Checkpoints a brain on a background thread
+
+    checkpoint() captures state into memory in the calling (step) loop, then
+    queues it for a writer thread which serializes and fsyncs it. With the
+    default max_pending of 1 one checkpoint is written while the next is
+    captured (double buffer); when the queue is full checkpoint() blocks, or
+    skips the checkpoint if block is False.
+    '''
+
+    def __init__(self, brain, path, delta=True, compact_every=20, max_pending=1, fsync=True):
+        self.checkpointer = DeltaCheckpointer(brain, path, compact_every=compact_every if delta else 0)
+        self.fsync = fsync
+        self.queue = Queue.Queue(maxsize=max_pending)
+        self.error = None
+        self.n_written = 0
+        self.n_skipped = 0
+        self.written_t = None  # Brain t of the last checkpoint written
+        self.capture_times = deque(maxlen=TIMING_HISTORY)  # Seconds, per checkpoint
+        self.write_times = deque(maxlen=TIMING_HISTORY)  # Seconds, per written checkpoint
+        self.latencies = deque(maxlen=TIMING_HISTORY)  # Seconds from capture to written
+        self.thread = threading.Thread(target=self._run, name="pphtm-checkpoint")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                job, captured, t = item
+                start = time.time()
+                self.checkpointer.write(job, fsync=self.fsync)
+                end = time.time()
+                self.write_times.append(end - start)
+                self.latencies.append(end - captured)
+                self.n_written += 1
+                self.written_t = t
+            except Exception as e:
+                self.error = e
+                log("Checkpoint write failed: %s", e)
+            finally:
+                self.queue.task_done()
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise CheckpointError("Background checkpoint write failed: %s" % error)
+
+    def checkpoint(self, block=True):
+        '''
+        Capture a checkpoint and queue it for writing
+
+        Returns:
+            bool: False if skipped (queue full and not block)
+        '''
+        self._raise_error()
+        if not block and self.queue.full():
+            self.n_skipped += 1
+            return False
+        start = time.time()
+        t = self.checkpointer.brain.t
+        job = self.checkpointer.capture()
+        self.capture_times.append(time.time() - start)
+        self.queue.put((job, start, t))
+        return True
+
+    def wait(self):
+        '''
+        Block until all queued checkpoints are written
+        '''
+        self.queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        self.queue.put(None)
+        self.thread.join()
+
+    def stats(self):
+        '''
+        Returns dict of counts, brain t of the last written checkpoint and
+        capture / write / end-to-end latency (ms)
+        '''
+        def summary(times):
+            if not times:
+                return {"last": None, "mean": None, "max": None}
+            return {"last": times[-1] * 1000., "mean": sum(times) / len(times) * 1000., "max": max(times) * 1000.}
+        return {
+            "written": self.n_written,
+            "skipped": self.n_skipped,
+            "pending": self.queue.qsize(),
+            "written_t": self.written_t,
+            "capture_ms": summary(self.capture_times),
+            "write_ms": summary(self.write_times),
+            "latency_ms": summary(self.latencies)
+        }
@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pphtm_brain
+from pphtm_brain import log
+
+DISTAL_FLOOR = 0.8  # Matches Segment.total_activation()
+POPCOUNT_8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+POPCOUNT_16 = (POPCOUNT_8[:, None] + POPCOUNT_8[None, :]).ravel()  # Set bits of each uint16
+
+
+def pack_bits(bool_array):
+    '''
+    Pack last axis of a boolean array into uint64 words (bit i -> word i / 64)
+    '''
+    bool_array = np.asarray(bool_array, dtype=bool)
+    n_words = (bool_array.shape[-1] + 63) // 64
+    padded = np.zeros(bool_array.shape[:-1] + (n_words * 64,), dtype=bool)
+    padded[..., :bool_array.shape[-1]] = bool_array
+    return np.ascontiguousarray(np.packbits(padded, axis=-1)).view(np.uint64)
+
+
+def popcount(words):
+    '''
+    Number of set bits over last axis of a uint64 array, as uint16 (uint32
+    past 65535 bits). Counts are looked up per 16 bit half word as uint8, so
+    the temporary is half the size of words.
+    '''
+    dtype = np.uint16 if words.shape[-1] * 64 < 2**16 else np.uint32
+    return POPCOUNT_16[words.view(np.uint16)].sum(axis=-1, dtype=dtype)
+
+
+class SignedSegments(object):
+    '''
+    Connected synapses of segments as a compressed sparse row matrix
+
+    Row r holds sources indices[indptr[r]:indptr[r + 1]] with their signs
+    (1 for excitatory, -1 for inhibitory sources), so segment activation is
+    a sum over each row's slice of signed source activity.
+    '''
+
+    def __init__(self, rows, n_sources):
+        self.shape = (len(rows), n_sources)
+        self.indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+        self.indices = np.zeros(0, dtype=np.int32)
+        self.signs = np.zeros(0, dtype=np.int8)
+        self.set_rows(dict(enumerate(rows)))
+
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes + self.signs.nbytes
+
+    def set_rows(self, changes):
+        '''
+        Replace rows, changes is a dict of row -> (sources, signs)
+        '''
+        lengths = np.diff(self.indptr)
+        changed = np.zeros(self.shape[0], dtype=bool)
+        for r, (sources, signs) in changes.items():
+            lengths[r] = len(sources)
+            changed[r] = True
+        indptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        # Entries of unchanged rows keep their offset within the row
+        row_of = np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+        keep = np.flatnonzero(~changed[row_of])
+        kept_rows = row_of[keep]
+        position = indptr[kept_rows] + (keep - self.indptr[kept_rows])
+        indices = np.zeros(indptr[-1], dtype=np.int32)
+        signs = np.zeros(indptr[-1], dtype=np.int8)
+        indices[position] = self.indices[keep]
+        signs[position] = self.signs[keep]
+        for r, (row_sources, row_signs) in changes.items():
+            indices[indptr[r]:indptr[r + 1]] = row_sources
+            signs[indptr[r]:indptr[r + 1]] = row_signs
+        self.indptr, self.indices, self.signs = indptr, indices, signs
+
+    def activation(self, activity):
+        '''
+        Args:
+            activity (np.array): (n_branches, n_sources) source activity
+
+        Returns:
+            (n_branches, n_segments) segment activation
+        '''
+        result = np.zeros((activity.shape[0], self.shape[0]))
+        if not len(self.indices):
+            return result
+        starts = np.minimum(self.indptr[:-1], len(self.indices) - 1)
+        empty = self.indptr[:-1] == self.indptr[1:]
+        for b in range(activity.shape[0]):
+            # One branch at a time, so temporaries stay the size of the matrix
+            result[b] = np.add.reduceat(activity[b].take(self.indices) * self.signs, starts)
+        result[:, empty] = 0.0  # reduceat returns the entry at start for empty rows
+        return result
+
+
+class BitSegments(object):
+    '''
+    Connected synapses of segments with binary sources, as packed bitsets
+
+    Excitatory and inhibitory sources are kept as two (n_segments, n_words)
+    masks. Segment activation for binary source activity is
+    popcount(excitatory & active) - popcount(inhibitory & active).
+    '''
+
+    def __init__(self, rows, n_sources):
+        self.shape = (len(rows), n_sources)
+        n_words = (n_sources + 63) // 64
+        self.excitatory = np.zeros((len(rows), n_words), dtype=np.uint64)
+        self.inhibitory = np.zeros((len(rows), n_words), dtype=np.uint64)
+        self.set_rows(dict(enumerate(rows)))
+
+    def nbytes(self):
+        return self.excitatory.nbytes + self.inhibitory.nbytes
+
+    def set_rows(self, changes):
+        '''
+        Replace rows, changes is a dict of row -> (sources, signs)
+        '''
+        rows = sorted(changes)
+        excitatory = np.zeros((len(rows), self.shape[1]), dtype=bool)
+        inhibitory = np.zeros((len(rows), self.shape[1]), dtype=bool)
+        for i, r in enumerate(rows):
+            sources, signs = changes[r]
+            excitatory[i, sources[signs > 0]] = True
+            inhibitory[i, sources[signs < 0]] = True
+        self.excitatory[rows] = pack_bits(excitatory)
+        self.inhibitory[rows] = pack_bits(inhibitory)
+
+    def activation(self, active):
+        '''
+        Args:
+            active (np.array): (n_branches, n_sources) boolean source activity
+
+        Returns:
+            (n_branches, n_segments) segment activation
+        '''
+        packed = pack_bits(active)[:, None, :]
+        return popcount(self.excitatory[None, :, :] & packed).astype(np.int32) - popcount(self.inhibitory[None, :, :] & packed)
+
+
+class RegionSnapshot(object):
+    '''
+    Read-only connectivity of one region, kept in sync with the region's
+    connected synapses (permanence >= CONNECTED_PERM) by update()
+
+    Each segment type is stored as a SignedSegments matrix with one row per
+    segment. Rows are cell-major, so row r belongs to cell r / n_segments.
+
+    With binary=True, segments whose sources are binary (distal, and top-down
+    if activations never fade to intermediate values) are stored as
+    BitSegments instead.
+    '''
+
+    def __init__(self, region, binary=False):
+        self.index = region.index
+        self.n_cells = region.n_cells
+        region_below = region.region_below()
+        region_above = region.region_above()
+        Segment = pphtm_brain.Segment
+        self.source_mult = {
+            Segment.PROXIMAL: region_below.excitatory_activation_mult if region_below else np.ones(region.n_inputs),
+            Segment.DISTAL: region.excitatory_activation_mult,
+            Segment.TOPDOWN: region_above.excitatory_activation_mult if region_above else np.ones(region.n_cells_above)
+        }
+        binary_types = []
+        if binary:
+            binary_types.append(Segment.DISTAL)
+            if region.brain.config("FADE_RATE") >= 1.0:
+                # Activations are 0 or 1, so top-down sources are binary too
+                binary_types.append(Segment.TOPDOWN)
+        self.n_segments = {}
+        self.matrices = {}
+        for type, cell_segments in [(Segment.PROXIMAL, [c.proximal_segments for c in region.cells]),
+                                    (Segment.DISTAL, [c.distal_segments for c in region.cells]),
+                                    (Segment.TOPDOWN, [c.topdown_segments for c in region.cells])]:
+            self.n_segments[type] = len(cell_segments[0]) if cell_segments else 0
+            rows = [self._row(seg) for segs in cell_segments for seg in segs]
+            matrix_class = BitSegments if type in binary_types else SignedSegments
+            self.matrices[type] = matrix_class(rows, len(self.source_mult[type]))
+        self.proximal = self.matrices[Segment.PROXIMAL]
+        self.distal = self.matrices[Segment.DISTAL]
+        self.topdown = self.matrices[Segment.TOPDOWN]
+
+    def _row(self, seg):
+        sources, permanences = seg.synapse_arrays()
+        connected = np.unique(sources[permanences >= pphtm_brain.CONNECTED_PERM])
+        return (connected, self.source_mult[seg.type][connected].astype(np.int8))
+
+    def update(self, segments):
+        '''
+        Rebuild the rows of segments (of this region) from their synapses
+        '''
+        changes = {}
+        for seg in segments:
+            row = seg.cell.index * self.n_segments[seg.type] + seg.index
+            changes.setdefault(seg.type, {})[row] = self._row(seg)
+        for type, rows in changes.items():
+            self.matrices[type].set_rows(rows)
+
+    def nbytes(self):
+        return sum([matrix.nbytes() for matrix in self.matrices.values()])
+
+    def active_segments(self, matrix, source_activity, threshold):
+        '''
+        Args:
+            source_activity (np.array): (n_branches, n_sources), or a SparseInput
+                (single branch)
+
+        Returns:
+            Boolean (n_branches, n_cells, n_segments) array of segments whose
+            connected contribution reaches threshold
+        '''
+        if isinstance(source_activity, pphtm_brain.SparseInput):
+            source_activity = source_activity.dense()[None, :]
+        n_branches = source_activity.shape[0]
+        if not matrix.shape[0]:
+            return np.zeros((n_branches, self.n_cells, 0), dtype=bool)
+        if isinstance(matrix, BitSegments):
+            segment_activation = matrix.activation(source_activity > 0)
+        else:
+            segment_activation = matrix.activation(source_activity)
+        return (segment_activation >= threshold).reshape(n_branches, self.n_cells, -1)
+
+
+class PPHTMInferenceEngine(object):
+    '''
+    Frozen inference path for a PPHTMBrain (used when learning is disabled)
+
+    Snapshots connected synapses of each region into read-only matrices and runs
+    overlap -> inhibition -> fade -> bias as array operations. No learning
+    state (synapse change / contribution, duty histories) is touched. Segment
+    activity is only written back to Segment objects if a learning step follows
+    (see apply_segment_activity). Rows of segments whose connected synapses
+    changed (region.connectivity_changes) are updated on refresh, the whole
+    snapshot is rebuilt when brain.synapse_version changes.
+
+    All phases operate on state arrays with a leading branch dimension, so the
+    same snapshot steps a region of the brain (1 branch) or a batch of
+    BrainFork branches.
+    '''
+
+    def __init__(self, brain):
+        self.brain = brain
+        self.snapshots = []
+        self.version = None
+        self.n_rebuilds = 0  # Full snapshot rebuilds (forks and learning steps only update rows)
+
+    def stale(self):
+        return self.version != self.brain.synapse_version or len(self.snapshots) != len(self.brain.regions)
+
+    def refresh(self):
+        if self.stale():
+            binary = self.brain.config("BINARY_ENGINE")
+            self.snapshots = [RegionSnapshot(r, binary=binary) for r in self.brain.regions]
+            self.version = self.brain.synapse_version
+            self.n_rebuilds += 1
+            for r in self.brain.regions:
+                r.connectivity_changes.clear()
+            log("Inference snapshot rebuilt (synapse version %d)", self.version, level=2)
+            return
+        for r, snap in zip(self.brain.regions, self.snapshots):
+            if r.connectivity_changes:
+                snap.update(r.connectivity_changes)
+                log("R%d inference snapshot updated (%d segments)", r.index, len(r.connectivity_changes), level=2)
+                r.connectivity_changes.clear()
+
+    def overlap(self, snap, input, boost):
+        threshold = self.brain.config("PROXIMAL_ACTIVATION_THRESHHOLD")
+        return snap.active_segments(snap.proximal, input, threshold).sum(axis=2) * boost
+
+    def inhibition(self, snap, pre_activation):
+        '''
+        Local k-winners-take-all: cell activates if positive and at least the
+        kth highest pre-activation among its neighbors
+        '''
+        neighbors = self.brain.regions[snap.index].neighbor_mask()  # Follows inhibition radius updates
+        return self.brain.kernels.local_winners(pre_activation, neighbors, self.brain.config("DESIRED_LOCAL_ACTIVITY"))
+
+    def biases(self, snap, activation, activation_above=None):
+        '''
+        Returns:
+            (bias, distal_active, topdown_active)
+        '''
+        threshold = self.brain.config("DISTAL_ACTIVATION_THRESHOLD")
+        filtered_activation = (activation > DISTAL_FLOOR).astype(float)
+        distal_active = snap.active_segments(snap.distal, filtered_activation, threshold)
+        bias = distal_active.sum(axis=2).astype(float)
+        if activation_above is not None:
+            topdown_active = snap.active_segments(snap.topdown, activation_above, threshold)
+        else:
+            # Top region (topdown segments exist but have no sources)
+            topdown_active = np.zeros((activation.shape[0], snap.n_cells, snap.topdown.shape[0] // snap.n_cells), dtype=bool)
+        bias += self.brain.config("TOPDOWN_BIAS_WEIGHT") * topdown_active.sum(axis=2)
+        return (bias, distal_active, topdown_active)
+
+    def pool(self, index, input, boost, bias, activation, activation_above=None):
+        '''
+        Run one inference step of region index on (n_branches, n) state arrays
+
+        Returns:
+            dict of new state arrays (overlap, pre_activation, activating,
+            activation, bias) and segment activity (distal_active, topdown_active)
+        '''
+        self.refresh()
+        snap = self.snapshots[index]
+        overlap = self.overlap(snap, input, boost)
+        pre_activation = (self.brain.config("OVERLAP_WEIGHT") * overlap) * (1 + (self.brain.config("BIAS_WEIGHT") * bias))
+        activating = self.inhibition(snap, pre_activation)
+        faded = np.maximum(activation - self.brain.config("FADE_RATE"), 0.0)
+        new_activation = np.where(activating, 1.0, faded)
+        new_bias, distal_active, topdown_active = self.biases(snap, new_activation, activation_above)
+        return {
+            "overlap": overlap,
+            "pre_activation": pre_activation,
+            "activating": activating,
+            "activation": new_activation,
+            "bias": new_bias,
+            "distal_active": distal_active,
+            "topdown_active": topdown_active
+        }
+
+    def step(self, region):
+        '''
+        Equivalent of Region.tempero_spatial_pooling(learning_enabled=False)
+        on region.input
+        '''
+        region_above = region.region_above()
+        activation_above = region_above.activation[None, :] if region_above else None
+        input = region.sparse_input if region.sparse_input is not None else np.asarray(region.input, dtype=float)[None, :]
+        res = self.pool(region.index, input, region.boost,
+                        region.bias[None, :], region.activation[None, :], activation_above)
+        region.overlap = res["overlap"][0]
+        region.pre_activation = res["pre_activation"][0]
+        region.last_activation = list(region.activation)
+        region.activation[:] = res["activation"][0]
+        region.pre_bias = np.copy(region.bias)
+        region.bias = res["bias"][0]
+        region.inference_segment_activity = (res["distal_active"][0], res["topdown_active"][0])
+        return res["activating"][0]
+
+    def apply_segment_activity(self, region):
+        '''
+        Copy segment activity from the last inference bias onto Segment objects.
+        Called before a learning step, which relies on active_before_learning.
+        '''
+        activity = region.inference_segment_activity
+        if activity is not None:
+            distal_active, topdown_active = activity
+            for i, cell in enumerate(region.cells):
+                for j, seg in enumerate(cell.distal_segments):
+                    seg.active_before_learning = bool(distal_active[i, j])
+                for j, seg in enumerate(cell.topdown_segments):
+                    seg.active_before_learning = bool(topdown_active[i, j])
+            region.inference_segment_activity = None
+
+
+class BrainFork(object):
+    '''
+    Copy-on-write fork of a PPHTMBrain for lookahead prediction
+
+    Synapses are shared read-only through the brain's inference snapshot. Only
+    per-step state is copied, with a leading branch dimension: state[i][attr]
+    is an (n_branches, n) array for region i. Forks never learn and never
+    modify the brain.
+    '''
+
+    STATE = ["overlap", "pre_activation", "activation", "pre_bias", "bias", "boost",
+             "active_duty_cycle", "overlap_duty_cycle", "bias_duty_cycle"]
+
+    def __init__(self, brain, n_branches=1, state=None, t=None):
+        self.brain = brain
+        self.engine = brain.inference_engine()
+        self.n_branches = n_branches
+        self.t = brain.t if t is None else t
+        if state is None:
+            state = [self._copy_region_state(r) for r in brain.regions]
+        self.state = state
+
+    def __repr__(self):
+        return "<BrainFork branches=%d t=%d>" % (self.n_branches, self.t)
+
+    def _copy_region_state(self, region):
+        region_state = {}
+        for attr in self.STATE:
+            region_state[attr] = np.tile(np.asarray(getattr(region, attr), dtype=float), (self.n_branches, 1))
+        # Subsampling schedule (see Region.step)
+        for attr in ["integrated_input", "last_stepped_input"]:
+            value = getattr(region, attr)
+            region_state[attr] = np.tile(pphtm_brain.dense_input(value), (self.n_branches, 1)) if value is not None else None
+        region_state["n_integrated"] = np.repeat(region.n_integrated, self.n_branches)
+        region_state["stepped"] = np.repeat(region.n_steps > 0, self.n_branches)
+        return region_state
+
+    def branch(self, rows):
+        '''
+        Returns a new fork with one branch per entry in rows (indexes of branches in this fork)
+        '''
+        rows = np.asarray(rows, dtype=int)
+        state = []
+        for region_state in self.state:
+            state.append(dict((attr, value[rows] if value is not None else None) for attr, value in region_state.items()))
+        return BrainFork(self.brain, n_branches=len(rows), state=state, t=self.t)
+
+    def region_state(self, index=0, attr="bias"):
+        return self.state[index][attr]
+
+    def _integrate_input(self, region, region_state, input):
+        current = region_state["integrated_input"]
+        fresh = (region_state["n_integrated"] == 0)[:, None]
+        if region.input_integration == "hold":
+            current = input  # Not modified in place
+        elif current is None:
+            current = np.copy(input)
+        elif region.input_integration == "max":
+            current = np.where(fresh, input, np.maximum(current, input))
+        elif region.input_integration == "mean":
+            current = np.where(fresh, input, current + (input - current) / (region_state["n_integrated"][:, None] + 1))
+        region_state["integrated_input"] = current
+        region_state["n_integrated"] = region_state["n_integrated"] + 1
+
+    def _step_due(self, region, region_state):
+        if region.step_change_threshold:
+            last_input = region_state["last_stepped_input"]
+            if last_input is None:
+                return np.ones(self.n_branches, dtype=bool)
+            change = np.sum(np.abs(region_state["integrated_input"] - last_input), axis=1)
+            return change > region.step_change_threshold
+        return (self.t % region.step_every == 0) | ~region_state["stepped"]
+
+    def process(self, readings):
+        '''
+        Step all branches through all regions (same schedule as Region.step)
+
+        Args:
+            readings (np.array): (n_inputs,) for all branches, or (n_branches, n_inputs)
+
+        Returns:
+            (n_branches, n_cells) activation of last region
+        '''
+        readings = np.asarray(readings, dtype=float)
+        _in = np.tile(readings, (self.n_branches, 1)) if readings.ndim == 1 else readings
+        for i, region in enumerate(self.brain.regions):
+            region_state = self.state[i]
+            self._integrate_input(region, region_state, _in)
+            due = self._step_due(region, region_state)
+            if due.any():
+                above_state = self.state[i + 1] if i + 1 < len(self.state) else None
+                res = self.engine.pool(i, region_state["integrated_input"], region_state["boost"], region_state["bias"],
+                                       region_state["activation"], above_state["activation"] if above_state else None)
+                mask = due[:, None]
+                region_state["pre_bias"] = np.where(mask, region_state["bias"], region_state["pre_bias"])
+                for attr in ["overlap", "pre_activation", "activation", "bias"]:
+                    region_state[attr] = np.where(mask, res[attr], region_state[attr])
+                if region.step_change_threshold:
+                    if region_state["last_stepped_input"] is None:
+                        region_state["last_stepped_input"] = np.copy(region_state["integrated_input"])
+                    else:
+                        region_state["last_stepped_input"] = np.where(mask, region_state["integrated_input"], region_state["last_stepped_input"])
+                region_state["stepped"] = region_state["stepped"] | due
+                region_state["n_integrated"] = np.where(due, 0, region_state["n_integrated"])
+            _in = region_state["activation"]
+        self.t += 1
+        return _in
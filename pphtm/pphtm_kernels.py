@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# Kernel backends for the data-dependent per-cell / per-segment loops of a
+# Region step (local k-WTA, segment selection, boosting). NumpyKernels is the
+# reference implementation. NumbaKernels compiles the same loops when numba is
+# installed. Backend is chosen at PPHTMBrain.initialize (KERNEL_BACKEND).
+
+
+class NumpyKernels(object):
+    '''
+    Reference kernels (pure NumPy)
+    '''
+
+    name = "numpy"
+
+    def local_winners(self, values, neighbors, k):
+        '''
+        Local k-winners-take-all
+
+        Args:
+            values (np.array): (n_branches, n_cells) pre-activations
+            neighbors (np.array): boolean (n_cells, n_cells) neighbor mask (no self)
+            k (int): desired local activity
+
+        Returns:
+            boolean (n_branches, n_cells): cell is positive and at least the kth
+            highest value among its neighbors (kth is 0 for cells without neighbors)
+        '''
+        n_neighbors = neighbors.sum(axis=1)
+        neighbor_values = np.where(neighbors[None, :, :], values[:, None, :], -np.inf)
+        ranked = -np.sort(-neighbor_values, axis=2)  # Highest to lowest
+        kth_index = np.maximum(np.minimum(k, n_neighbors) - 1, 0)
+        kth_score = ranked[:, np.arange(neighbors.shape[0]), kth_index]
+        kth_score[:, n_neighbors == 0] = 0
+        return (values > 0) & (values >= kth_score)
+
+    def segment_learning(self, activating, biased, segment_active):
+        '''
+        Distal / top-down segment selection
+
+        A segment learns if its cell is activating and it is active (or no
+        segment of the cell is), or if its cell is biased but not activating
+        and it is active.
+
+        Args:
+            activating, biased (np.array): boolean (n_cells,)
+            segment_active (np.array): boolean (n_cells, n_segments)
+
+        Returns:
+            boolean (n_cells, n_segments)
+        '''
+        activating = activating[:, None]
+        biased = biased[:, None]
+        any_active = segment_active.any(axis=1)[:, None]
+        return (activating & (segment_active | ~any_active)) | (biased & ~activating & segment_active)
+
+    def min_duty_cycles(self, prior_duty, duty, neighbors):
+        '''
+        1% of max active duty cycle among neighbors of each cell. Cells are
+        updated in index order, so neighbors before a cell count with their
+        updated duty cycle and neighbors after it with their prior one.
+        '''
+        n = len(duty)
+        updated = np.arange(n)[None, :] < np.arange(n)[:, None]
+        values = np.where(updated, duty[None, :], prior_duty[None, :])
+        values = np.where(neighbors, values, -np.inf).max(axis=1)
+        return 0.01 * np.where(neighbors.any(axis=1), values, 0)
+
+    def boosts(self, duty, min_duty, multiplier):
+        '''
+        Boost of 1.0 for cells at or above min duty cycle, higher below it
+        '''
+        return np.where(duty >= min_duty, 1.0, 1 + (min_duty - duty) * multiplier)
+
+
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _local_winners(values, neighbors, k):
+        n_branches, n_cells = values.shape
+        out = np.zeros((n_branches, n_cells), dtype=np.bool_)
+        buf = np.empty(n_cells)
+        for b in range(n_branches):
+            for i in range(n_cells):
+                n = 0
+                for j in range(n_cells):
+                    if neighbors[i, j]:
+                        buf[n] = values[b, j]
+                        n += 1
+                kth = 0.0
+                if n > 0:
+                    ranked = np.sort(buf[:n])
+                    kth = ranked[n - min(k, n)]
+                out[b, i] = values[b, i] > 0 and values[b, i] >= kth
+        return out
+
+    @numba.njit(cache=True)
+    def _segment_learning(activating, biased, segment_active):
+        n_cells, n_segs = segment_active.shape
+        out = np.zeros((n_cells, n_segs), dtype=np.bool_)
+        for i in range(n_cells):
+            any_active = False
+            for j in range(n_segs):
+                any_active = any_active or segment_active[i, j]
+            for j in range(n_segs):
+                active = segment_active[i, j]
+                out[i, j] = (activating[i] and (active or not any_active)) or (biased[i] and not activating[i] and active)
+        return out
+
+    @numba.njit(cache=True)
+    def _min_duty_cycles(prior_duty, duty, neighbors):
+        n = duty.shape[0]
+        out = np.zeros(n)
+        for i in range(n):
+            found = False
+            best = 0.0
+            for j in range(n):
+                if neighbors[i, j]:
+                    value = duty[j] if j < i else prior_duty[j]
+                    if not found or value > best:
+                        best = value
+                        found = True
+            out[i] = 0.01 * best
+        return out
+
+    @numba.njit(cache=True)
+    def _boosts(duty, min_duty, multiplier):
+        n = duty.shape[0]
+        out = np.ones(n)
+        for i in range(n):
+            if duty[i] < min_duty[i]:
+                out[i] = 1 + (min_duty[i] - duty[i]) * multiplier
+        return out
+
+
+class NumbaKernels(NumpyKernels):
+    '''
+    Compiled kernels (requires numba)
+    '''
+
+    name = "numba"
+
+    def local_winners(self, values, neighbors, k):
+        return _local_winners(np.ascontiguousarray(values, dtype=np.float64), neighbors, int(k))
+
+    def segment_learning(self, activating, biased, segment_active):
+        return _segment_learning(activating.astype(np.bool_), biased.astype(np.bool_), segment_active.astype(np.bool_))
+
+    def min_duty_cycles(self, prior_duty, duty, neighbors):
+        return _min_duty_cycles(prior_duty, duty, neighbors)
+
+    def boosts(self, duty, min_duty, multiplier):
+        return _boosts(duty, min_duty, float(multiplier))
+
+
+def get_kernels(backend="auto"):
+    '''
+    Args:
+        backend (str): numpy, numba, or auto (numba if installed)
+
+    Returns:
+        kernels instance (falls back to NumpyKernels if numba is missing)
+    '''
+    if backend in ["auto", "numba"] and numba is not None:
+        return NumbaKernels()
+    return NumpyKernels()
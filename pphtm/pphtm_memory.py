@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+import mmap
+import sys
+import numpy as np
+import pphtm_brain
+
+# Memory footprint of a brain, by region, object kind and segment type.
+#
+# Sizes are estimates from sys.getsizeof of each object, its __dict__ and the
+# elements of its lists / dicts (shared singletons such as small ints, bools
+# and None are not counted), and nbytes of numpy arrays. Views are counted
+# through the array owning their data, once per report (the seen set threaded
+# through sizeof). Views into memory-mapped synapse storage are counted once,
+# as mapped_synapses.
+#
+# Kinds:
+#   cells           Cell objects (attributes and segment list containers)
+#   segments        Segment objects (attributes other than synapses)
+#   synapses        Synapse lists, or implicit-pool overlays of released segments
+#   history         Cell duty cycle histories (recent_*_duty lists)
+#   region_arrays   Per-cell numpy state of regions (overlap, bias, boost...)
+#   instrumentation Step stats ring buffers and checkpoint bookkeeping
+#   mapped_synapses Memory-mapped synapse storage (file backed, see pphtm_checkpoint)
+#   inference_engine Inference snapshot of the region (brain.engine) and the
+#                   region's state in BrainFork buffers passed to memory_report
+
+KINDS = ["cells", "segments", "synapses", "history", "region_arrays", "instrumentation", "mapped_synapses", "inference_engine"]
+SEGMENT_TYPE_NAMES = {pphtm_brain.Segment.PROXIMAL: "proximal", pphtm_brain.Segment.DISTAL: "distal", pphtm_brain.Segment.TOPDOWN: "topdown"}
+SYNAPSE_ATTRS = set(pphtm_brain.Segment.SYNAPSE_LISTS + ["pool_slots", "pool_overlay", "pool_removed", "pool_extra"])
+HISTORY_ATTRS = set(["recent_active_duty", "recent_overlap_duty", "recent_bias_duty"])
+INSTRUMENTATION_ATTRS = set(["stats", "permanence_stats", "changed_segments"])
+
+
+def _shared(value):
+    # Interned / singleton values not owned by any one container
+    return value is None or type(value) is bool or (type(value) is int and -5 <= value <= 256)
+
+
+def _array_owner(array):
+    # Array owning the data of a view (or the array itself), None if memory-mapped
+    while isinstance(array.base, np.ndarray):
+        if isinstance(array, np.memmap):
+            return None
+        array = array.base
+    if isinstance(array, np.memmap) or isinstance(array.base, mmap.mmap):
+        return None
+    return array
+
+
+def sizeof(value, seen=None):
+    '''
+    Estimated bytes held by value (containers include their elements, arrays
+    and views count the data of their owning array unless it is in seen, the
+    set of ids of owners already counted)
+    '''
+    if seen is None:
+        seen = set()
+    if isinstance(value, np.ndarray):
+        owner = _array_owner(value)
+        if owner is None or id(owner) in seen:
+            return 0
+        seen.add(id(owner))
+        return owner.nbytes
+    if _shared(value):
+        return 0
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        size += sum([sizeof(v, seen) for v in value if not _shared(v)])
+    elif isinstance(value, dict):
+        size += sum([sizeof(k, seen) + sizeof(v, seen) for k, v in value.items()])
+    return size
+
+
+def _object_size(obj):
+    return sys.getsizeof(obj) + sys.getsizeof(obj.__dict__)
+
+
+def _segment_report(region, seen):
+    '''
+    Returns (kind bytes, segment type -> dict) for the segments of region
+    '''
+    kinds = dict((kind, 0) for kind in ["segments", "synapses"])
+    types = dict((name, {"segments": 0, "bytes": 0}) for name in SEGMENT_TYPE_NAMES.values())
+    for cell in region.cells:
+        for seg in cell.all_segments():
+            segment_bytes = _object_size(seg)
+            synapse_bytes = 0
+            for name, value in seg.__dict__.items():
+                if name in SYNAPSE_ATTRS:
+                    synapse_bytes += sizeof(value, seen)
+                elif name not in ["cell", "region", "active_before_learning"]:
+                    segment_bytes += sizeof(value, seen)
+            kinds["segments"] += segment_bytes
+            kinds["synapses"] += synapse_bytes
+            type_report = types[SEGMENT_TYPE_NAMES[seg.type]]
+            type_report["segments"] += 1
+            type_report["bytes"] += segment_bytes + synapse_bytes
+    return (kinds, types)
+
+
+def region_report(region, forks=(), seen=None):
+    '''
+    Returns dict with bytes by kind, per segment type counts / bytes and totals of region
+
+    Args:
+        forks (list of BrainFork): Forks whose buffers for the region are counted
+        seen (set): Ids of arrays already counted (shared across regions of a report)
+    '''
+    if seen is None:
+        seen = set()
+    kinds = dict((kind, 0) for kind in KINDS)
+    for cell in region.cells:
+        kinds["cells"] += _object_size(cell)
+        for name, value in cell.__dict__.items():
+            if name in HISTORY_ATTRS:
+                kinds["history"] += sizeof(value, seen)
+            elif name in ["proximal_segments", "distal_segments", "topdown_segments"]:
+                kinds["cells"] += sys.getsizeof(value)  # Segments themselves counted below
+            elif name != "region":
+                kinds["cells"] += sizeof(value, seen)
+    segment_kinds, types = _segment_report(region, seen)
+    kinds.update(segment_kinds)
+    for name, value in region.__dict__.items():
+        if isinstance(value, np.ndarray):
+            kinds["region_arrays"] += sizeof(value, seen)
+        elif name in INSTRUMENTATION_ATTRS:
+            if hasattr(value, "__dict__"):
+                kinds["instrumentation"] += sum([sizeof(v, seen) for v in value.__dict__.values()])
+            else:
+                kinds["instrumentation"] += sys.getsizeof(value)  # Set of segments counted above
+    for flat in region.synapse_storage.values():
+        kinds["mapped_synapses"] += flat.nbytes
+    engine = region.brain.engine
+    if engine is not None:
+        for snap in engine.snapshots:
+            if snap.index == region.index:
+                kinds["inference_engine"] += snap.nbytes()
+    for fork in forks:
+        kinds["inference_engine"] += sum([sizeof(value, seen) for value in fork.state[region.index].values() if value is not None])
+    permanence_stats = region.permanence_stats
+    for type, name in SEGMENT_TYPE_NAMES.items():
+        n_synapses = permanence_stats.n_synapses[type]
+        types[name]["synapses"] = n_synapses
+        types[name]["connected"] = permanence_stats.n_connected[type]
+        types[name]["bytes_per_synapse"] = types[name]["bytes"] / float(n_synapses) if n_synapses else None
+    n_synapses = sum(permanence_stats.n_synapses.values())
+    total = sum(kinds.values())
+    return {
+        "region": region.index,
+        "n_cells": region.n_cells,
+        "total_bytes": total,
+        "synapses": n_synapses,
+        "connected": sum(permanence_stats.n_connected.values()),
+        "bytes_per_synapse": total / float(n_synapses) if n_synapses else None,
+        "kinds": kinds,
+        "segment_types": types
+    }
+
+
+def predictor_report(predictor, seen=None):
+    '''
+    Returns dict of bytes held by a PPHTMPredictor's lookup tables
+    '''
+    if seen is None:
+        seen = set()
+    return dict((name, sizeof(value, seen)) for name, value in predictor.__dict__.items() if name.endswith("_lookup"))
+
+
+def memory_report(brain, predictor=None, forks=()):
+    '''
+    Returns dict with total bytes and synapses, bytes by kind, per region
+    reports (see region_report), predictor lookup tables (if given) and
+    brain.memory_history samples
+    '''
+    seen = set()
+    regions = [region_report(r, forks=forks, seen=seen) for r in brain.regions]
+    report = {
+        "t": brain.t,
+        "total_bytes": sum([r["total_bytes"] for r in regions]),
+        "synapses": sum([r["synapses"] for r in regions]),
+        "kinds": dict((kind, sum([r["kinds"][kind] for r in regions])) for kind in KINDS),
+        "regions": regions,
+        "history": list(brain.memory_history)
+    }
+    if predictor is not None:
+        report["predictor"] = predictor_report(predictor, seen=seen)
+        report["total_bytes"] += sum(report["predictor"].values())
+    return report
+
+
+def memory_sample(brain):
+    '''
+    Compact sample for brain.memory_history (streaming growth)
+    '''
+    seen = set()
+    regions = [region_report(r, seen=seen) for r in brain.regions]
+    return {
+        "t": brain.t,
+        "total_bytes": sum([r["total_bytes"] for r in regions]),
+        "synapses": sum([r["synapses"] for r in regions])
+    }
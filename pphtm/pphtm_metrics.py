@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+import os
+import threading
+import time
+import BaseHTTPServer
+from pphtm_stats import PHASES, COUNTERS
+
+# Pull-style metrics of a running brain in Prometheus text exposition format,
+# served over HTTP from a background thread and / or periodically written to
+# a file (e.g. for node_exporter's textfile collector).
+#
+#   exporter = MetricsExporter(brain, predictor=predictor, checkpointer=writer)
+#   exporter.serve(port=9464)            # GET http://127.0.0.1:9464/metrics
+#   exporter.start_file_writer("pphtm.prom", interval=10.0)
+#   ... run ...
+#   exporter.close()
+#
+# Values are read from the brain without locking, so a scrape taken during a
+# step may mix values of consecutive steps.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, (int, long)):
+        return str(value)
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    pairs = ['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in sorted(labels.items())]
+    return "{%s}" % ",".join(pairs)
+
+
+class Metric(object):
+    '''
+    One metric family: name, type (counter / gauge / summary), help text and
+    samples as (suffix, labels, value)
+    '''
+
+    def __init__(self, name, type, help):
+        self.name = name
+        self.type = type
+        self.help = help
+        self.samples = []
+
+    def add(self, value, suffix="", **labels):
+        self.samples.append((suffix, labels, value))
+        return self
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+        for suffix, labels, value in self.samples:
+            lines.append("%s%s%s %s" % (self.name, suffix, _format_labels(labels), _format_value(value)))
+        return "\n".join(lines)
+
+
+class MetricsExporter(object):
+    '''
+    Collects metrics of brain (and optionally a PPHTMPredictor and a
+    DeltaCheckpointer / AsyncCheckpointWriter) on each scrape
+    '''
+
+    def __init__(self, brain, predictor=None, checkpointer=None, prefix="pphtm"):
+        self.brain = brain
+        self.predictor = predictor
+        self.checkpointer = checkpointer
+        self.prefix = prefix
+        self.n_steps = 0  # Steps processed since the exporter was created (across re-initializations)
+        self.last_t = 0
+        self.last_scrape = {}  # Consumer -> (time, n_steps) of its previous collect, for steps/sec
+        self.lock = threading.Lock()
+        self.server = None
+        self.server_thread = None
+        self.file_thread = None
+        self.file_path = None
+        self.stopping = threading.Event()
+
+    def _metric(self, name, type, help):
+        return Metric("%s_%s" % (self.prefix, name), type, help)
+
+    def _count_steps(self, now, consumer):
+        t = self.brain.t
+        self.n_steps += t - self.last_t if t >= self.last_t else t  # Brain re-initialized
+        self.last_t = t
+        rate = None
+        last = self.last_scrape.get(consumer)
+        if last is not None and now > last[0]:
+            rate = (self.n_steps - last[1]) / (now - last[0])
+        self.last_scrape[consumer] = (now, self.n_steps)
+        return rate
+
+    def _brain_metrics(self, now, consumer):
+        brain = self.brain
+        rate = self._count_steps(now, consumer)
+        metrics = [
+            self._metric("steps_total", "counter", "Brain steps processed").add(self.n_steps),
+            self._metric("steps_per_second", "gauge", "Brain steps per second since the previous scrape by the same consumer").add(rate),
+            self._metric("brain_t", "gauge", "Current brain time step").add(brain.t)
+        ]
+        latency = self._metric("step_latency_seconds", "summary", "Wall time of whole brain steps")
+        for mode, histogram in sorted(brain.latency.items()):
+            for q in QUANTILES:
+                value = histogram.percentile(q * 100)
+                latency.add(value, mode=mode, quantile=q)
+            latency.add(histogram.total, suffix="_sum", mode=mode)
+            latency.add(histogram.n, suffix="_count", mode=mode)
+        metrics.append(latency)
+        degraded = self._metric("degraded_total", "counter", "Degraded mode events (STEP_LATENCY_BUDGET)")
+        for kind, n in sorted(brain.degraded.items()):
+            degraded.add(n, kind=kind)
+        metrics.append(degraded)
+        metrics.append(self._metric("catch_up_pending", "gauge", "Deferred region updates awaiting catch up").add(len(brain.catch_up_queue)))
+        return metrics
+
+    def _region_metrics(self):
+        phase_mean = self._metric("phase_mean_seconds", "gauge", "Mean wall time of each step phase over the stats window")
+        phase_max = self._metric("phase_max_seconds", "gauge", "Max wall time of each step phase over the stats window")
+        events = self._metric("region_events_total", "counter", "Step counters (cells boosted, synapses grown...) over all steps")
+        synapses = self._metric("synapses", "gauge", "Synapses by region and segment type")
+        connected = self._metric("connected_fraction", "gauge", "Fraction of synapses at or above the connected permanence")
+        permanence = self._metric("mean_permanence", "gauge", "Mean synapse permanence")
+        for r in self.brain.regions:
+            phases = r.stats.summary()["phases"]
+            for phase in PHASES:
+                if phase in phases:
+                    phase_mean.add(phases[phase]["mean"] / 1000., region=r.index, phase=phase)
+                    phase_max.add(phases[phase]["max"] / 1000., region=r.index, phase=phase)
+            for counter, total in zip(COUNTERS, r.stats.totals):
+                events.add(int(total), region=r.index, counter=counter)
+            ps = r.permanence_stats
+            for type, name in sorted(ps.type_names.items()):
+                synapses.add(ps.n_synapses[type], region=r.index, segment_type=name)
+                connected.add(ps.connected_fraction(type), region=r.index, segment_type=name)
+                permanence.add(ps.mean_permanence(type), region=r.index, segment_type=name)
+        return [phase_mean, phase_max, events, synapses, connected, permanence]
+
+    def _predictor_metrics(self):
+        p = self.predictor
+        return [
+            self._metric("predictions_total", "counter", "Predictions scored against the next input").add(p.n_scored),
+            self._metric("predictions_correct_total", "counter", "Predictions matching the next input").add(p.n_correct),
+            self._metric("prediction_accuracy", "gauge", "Fraction of scored predictions that were correct").add(p.accuracy())
+        ]
+
+    def _checkpoint_metrics(self):
+        c = self.checkpointer
+        written_t = c.written_t
+        metrics = [
+            self._metric("checkpoint_lag_steps", "gauge", "Brain steps since the state in the last written checkpoint").add(self.brain.t - written_t if written_t is not None else None)
+        ]
+        if hasattr(c, "stats"):
+            stats = c.stats()
+            metrics.append(self._metric("checkpoints_written_total", "counter", "Checkpoints written").add(stats["written"]))
+            metrics.append(self._metric("checkpoints_skipped_total", "counter", "Checkpoints skipped (writer busy)").add(stats["skipped"]))
+            metrics.append(self._metric("checkpoints_pending", "gauge", "Checkpoints captured and awaiting write").add(stats["pending"]))
+            last = stats["latency_ms"]["last"]
+            metrics.append(self._metric("checkpoint_latency_seconds", "gauge", "Capture to written time of the last checkpoint").add(last / 1000. if last is not None else None))
+        return metrics
+
+    def collect(self, consumer="default"):
+        '''
+        Returns list of Metric. steps_per_second covers the time since the
+        previous collect by the same consumer (e.g. "http" or "file"), so
+        interleaved scrapes don't shorten each other's window
+        '''
+        with self.lock:
+            metrics = self._brain_metrics(time.time(), consumer)
+            metrics += self._region_metrics()
+            if self.predictor is not None:
+                metrics += self._predictor_metrics()
+            if self.checkpointer is not None:
+                metrics += self._checkpoint_metrics()
+        return metrics
+
+    def render(self, consumer="default"):
+        '''
+        Returns metrics in Prometheus text format
+        '''
+        return "\n".join([m.render() for m in self.collect(consumer=consumer)]) + "\n"
+
+    def write_file(self, path):
+        '''
+        Atomically (re)write metrics to path
+        '''
+        tmp = "%s.tmp" % path
+        with open(tmp, "w") as f:
+            f.write(self.render(consumer="file:%s" % path))
+        os.rename(tmp, path)
+        return path
+
+    def start_file_writer(self, path, interval=10.0):
+        '''
+        Rewrite path every interval seconds on a background thread (and a last
+        time on close)
+        '''
+        def run():
+            while not self.stopping.wait(interval):
+                self.write_file(path)
+        self.file_path = path
+        self.write_file(path)
+        self.file_thread = threading.Thread(target=run, name="pphtm-metrics-file")
+        self.file_thread.daemon = True
+        self.file_thread.start()
+
+    def serve(self, port=9464, host="127.0.0.1"):
+        '''
+        Serve metrics at http://host:port/metrics on a background thread,
+        returns the bound (host, port) (port 0 picks a free one)
+        '''
+        exporter = self
+
+        class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = exporter.render(consumer="http")
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = BaseHTTPServer.HTTPServer((host, port), Handler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever, name="pphtm-metrics-http")
+        self.server_thread.daemon = True
+        self.server_thread.start()
+        return self.server.server_address
+
+    def close(self):
+        self.stopping.set()
+        if self.file_thread is not None:
+            self.file_thread.join()
+            self.file_thread = None
+            self.write_file(self.file_path)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server_thread.join()
+            self.server = None
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pphtm_brain
+
+# Implicit (procedural) potential pools
+# A segment's potential synapses are regenerated on demand from
+# (POOL_SEED, region, cell, segment type, segment index) with a counter-based
+# hash RNG, so they never need to be stored.
+
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+STREAM_CHANCE = 1
+STREAM_PERMANENCE = 2
+STREAM_CAP = 3
+
+
+def _mix(x):
+    '''
+    splitmix64 finalizer on a uint64 array
+    '''
+    x = x ^ (x >> np.uint64(30))
+    x = x * np.uint64(0xBF58476D1CE4E5B9)
+    x = x ^ (x >> np.uint64(27))
+    x = x * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def hash_key(*ids):
+    key = np.zeros(1, dtype=np.uint64)
+    for i in ids:
+        key = _mix(key + np.array([i], dtype=np.uint64) + GOLDEN)
+    return key
+
+
+def uniform(key, stream, n):
+    '''
+    Counter-based uniform [0, 1) values for counters 0..n-1 of a stream
+    '''
+    counters = np.arange(n, dtype=np.uint64)
+    x = _mix(hash_key(stream) ^ key)
+    values = _mix(x + (counters + np.uint64(1)) * GOLDEN)
+    return (values >> np.uint64(11)).astype(float) * (2.0 ** -53)
+
+
+def _distances(x0, y0, n_sources, side_len):
+    index = np.arange(n_sources)
+    x = index % side_len
+    y = np.floor(index / side_len)
+    return np.sqrt((x - x0) ** 2 + (y - y0) ** 2)
+
+
+def segment_pool(seg):
+    '''
+    Potential synapses of a segment (see Segment.initialize for the
+    non-procedural equivalent)
+
+    Returns:
+        (sources, permanences) np.arrays, sources sorted
+    '''
+    region = seg.region
+    brain = region.brain
+    key = hash_key(brain.config("POOL_SEED"), region.index, seg.cell.index, seg.type, seg.index)
+    if seg.proximal():
+        n_sources = region.n_inputs
+        cell_x, cell_y = seg.cell.coords
+        dist = _distances(cell_x, cell_y, n_sources, region._input_side_len())
+        max_chance = brain.config("MAX_PROXIMAL_INIT_SYNAPSE_CHANCE")
+        min_chance = brain.config("MIN_PROXIMAL_INIT_SYNAPSE_CHANCE")
+        chance = ((max_chance - min_chance) * (1 - dist / region.diagonal)) + min_chance
+    else:
+        mode = brain.config("DISTAL_CONNECTIVITY")
+        if seg.distal():
+            n_sources = region.n_cells
+            chance = np.repeat(brain.config("DISTAL_SYNAPSE_CHANCE"), n_sources)
+            chance[seg.cell.index] = 0.0  # Avoid creating synapse with self
+        else:
+            n_sources = region.n_cells_above
+            chance = np.repeat(brain.config("TOPDOWN_SYNAPSE_CHANCE"), n_sources)
+        if mode == "grow":
+            chance[:] = 0.0
+        elif mode in ["radius", "gaussian"] and n_sources:
+            source_side_len = int(round(np.sqrt(n_sources)))
+            scale = source_side_len / region._cell_side_len()
+            cell_x, cell_y = seg.cell.coords
+            dist = _distances(cell_x * scale, cell_y * scale, n_sources, source_side_len)
+            radius = brain.config("DISTAL_RADIUS")
+            if mode == "radius":
+                chance[dist > radius] = 0.0
+            else:
+                chance *= np.exp(-(dist ** 2) / (2 * radius ** 2))
+    sources = np.flatnonzero(uniform(key, STREAM_CHANCE, n_sources) < chance)
+    if not seg.proximal():
+        max_synapses = brain.config("MAX_DISTAL_SYNAPSES")
+        if max_synapses and len(sources) > max_synapses:
+            order = np.argsort(uniform(key, STREAM_CAP, n_sources)[sources], kind='mergesort')
+            sources = np.sort(sources[order[:max_synapses]])
+    jitter = uniform(key, STREAM_PERMANENCE, n_sources)[sources]
+    permanences = pphtm_brain.CONNECTED_PERM + pphtm_brain.INIT_PERMANENCE_JITTER * (jitter - 0.5)
+    return (sources, permanences)
@@ -3,7 +3,6 @@
 import math
 import util
 import numpy as np
-import operator
 
 CONSIDERATION_THRESHOLD = 0.5
 from encoders import SimpleFullWidthEncoder
@@ -18,59 +17,256 @@ class PPHTMPredictor(object):
         self.brain = brain
         self.categories = categories
         self.region = None
-        self.overlap_lookup = {} # raw_input (e.g. letter) -> overlap np.array
+        self.category_index = dict((cat, i) for i, cat in enumerate(categories))
+        self.overlap_lookup = None # (n_categories, n_cells) last overlap read for each category
+        self.overlap_norms = None # (n_categories,) row sums of overlap_lookup
+        self.overlap_seen = None # (n_categories,) bool, category has been read
         self.activation_lookup = {} # sequence (e.g. "BA") -> activation np.array
         # Tallies counts number of 'votes' for each input based on proximal connections
         # of r0 biased cells
+        self.tallies = None
+        self._proximal_matrix = None # See proximal_matrix()
+        self._proximal_key = None
+        self._category_encodings = None # See category_encodings()
         self.encoder = SimpleFullWidthEncoder(n_inputs=self.brain.n_inputs, n_cats=len(categories))
+        self.last_prediction = None  # Last predict() result, scored by the next read()
+        self.n_scored = 0
+        self.n_correct = 0
 
     def initialize(self):
         self.region = self.brain.regions[0]
-        self.overlap_lookup = {}
+        self.overlap_lookup = np.zeros((len(self.categories), self.region.n_cells), dtype=self.region.overlap.dtype)
+        self.overlap_norms = np.zeros(len(self.categories))
+        self.overlap_seen = np.zeros(len(self.categories), dtype=bool)
         self.activation_lookup = {}
+        self.last_prediction = None
+        self.n_scored = 0
+        self.n_correct = 0
+
+    def overlap_for(self, raw_input):
+        '''
+        Last overlap read for raw_input (row of overlap_lookup), or None if not yet read
+        '''
+        i = self.category_index.get(raw_input)
+        if i is None or not self.overlap_seen[i]:
+            return None
+        return self.overlap_lookup[i]
+
+    def overlap_scores(self, bias=None):
+        '''
+        Overlap lookup score of each category against bias (default region bias):
+        bias . overlap / sum(overlap), -inf for categories not yet read
+        TODO: Should we consider both active and inactive matches?
+        '''
+        if bias is None:
+            bias = self.region.bias
+        dots = self.overlap_lookup.dot(bias)
+        norms = self.overlap_norms.reshape((-1,) + (1,) * (dots.ndim - 1))  # bias may be (n_cells, n_branches)
+        scores = np.where(norms > 0, dots / np.where(norms > 0, norms, 1), 0.0)
+        scores[~self.overlap_seen] = -np.inf
+        return scores
 
     def predict_via_overlap_lookup(self):
         '''
         Compare raw input -> overlap map to look for best match with bias
-        TODO: Should we consider both active and inactive matches?
         '''
-        scores = {}
-        for raw_input, overlap in self.overlap_lookup.items():
-            # score = util.bool_overlap(overlap, self.region.bias) / sum(overlap)
-            score = np.dot(overlap, self.region.bias) / sum(overlap)
-            scores[raw_input] = score
+        return self.categories[int(np.argmax(self.overlap_scores()))]
 
-        max_raw_input, max_score = max(scores.iteritems(), key=operator.itemgetter(1))
-        return max_raw_input
+    def predict_top_k(self, k=3):
+        '''
+        Returns list of (category, overlap lookup score) of the k best
+        categories read so far, best first
+        '''
+        scores = self.overlap_scores()
+        order = np.argsort(-scores, kind='mergesort')[:k]
+        return [(self.categories[i], scores[i]) for i in order if self.overlap_seen[i]]
 
 
+    def proximal_matrix(self):
+        '''
+        (n_cells, n_inputs) count of proximal synapses from each input to each
+        cell of the region, rebuilt when the region's synapses are added or removed
+        '''
+        key = (self.region, self.region.structure_version)
+        if self._proximal_key != key:
+            matrix = np.zeros((self.region.n_cells, self.region.n_inputs))
+            for i, cell in enumerate(self.region.cells):
+                for seg in cell.proximal_segments:
+                    np.add.at(matrix[i], seg.synapse_arrays()[0], 1)
+            self._proximal_matrix = matrix
+            self._proximal_key = key
+        return self._proximal_matrix
+
+    def category_encodings(self):
+        '''
+        (n_categories, n_inputs) bool, active input bits of each category's encoding
+        '''
+        if self._category_encodings is None or len(self._category_encodings) != len(self.categories):
+            self._category_encodings = np.array([self.encode(cat) != 0 for cat in self.categories])
+        return self._category_encodings
+
+    def reversal_scores(self, bias=None):
+        '''
+        Reverse biased cells (bias >= CONSIDERATION_THRESHOLD) down proximal segments,
+        tallying synapses per input, and count input bits of each category's
+        encoding that received any tally (util.bool_overlap of encoding and tallies)
+
+        Args:
+            bias (np.array): (n_cells,) or (n_branches, n_cells), default region bias
+
+        Returns:
+            scores (n_categories,) or (n_branches, n_categories)
+        '''
+        if bias is None:
+            bias = self.region.bias
+        self.tallies = (bias >= CONSIDERATION_THRESHOLD).astype(float).dot(self.proximal_matrix())
+        return (self.tallies != 0).astype(int).dot(self.category_encodings().T)
+
     def predict_via_proximal_reversal(self):
         '''
         Reverse biased cells down proximal segments and compare against encoded input options
         '''
-        self.tallies = np.zeros(self.region.n_inputs)
-        for i, bias in enumerate(self.region.bias):
-            if bias >= CONSIDERATION_THRESHOLD:
-                cell = self.region.cells[i]
-                for seg in cell.proximal_segments:
-                    for source_index in seg.syn_sources:
-                        self.tallies[source_index] += 1
+        return self.categories[int(np.argmax(self.reversal_scores()))]
+
+    def category_scores(self, bias):
+        '''
+        Overlap lookup score of each category (in order of self.categories)
+
+        Args:
+            bias (np.array): (n_cells,) or (n_branches, n_cells)
+
+        Returns:
+            (n_branches, n_categories) scores (0 for categories not yet read)
+        '''
+        scores = self.overlap_scores(np.atleast_2d(bias).T).T
+        scores[:, ~self.overlap_seen] = 0.0
+        return scores
+
+    def category_probabilities(self, bias):
+        '''
+        category_scores normalized over categories (negative scores clipped to 0,
+        uniform where no category scores)
+
+        Returns:
+            (n_branches, n_categories) rows summing to 1
+        '''
+        scores = np.clip(self.category_scores(bias), 0, None)
+        totals = scores.sum(axis=1)[:, None]
+        return np.where(totals > 0, scores / np.where(totals > 0, totals, 1), 1.0 / len(self.categories))
 
-        overlap_scores = []
-        for cat in self.categories:
-            i = ord(cat.upper()) - 65 # A == 0
-            encoded = self.encoder.encode(i)
-            overlap_scores.append(self.overlap(encoded, self.tallies))
+    def predict_k(self, k=2, branching=3):
+        '''
+        Beam search over the next k inputs, stepping forks of the brain
 
-        max_overlap_score = max(overlap_scores)
-        predicted_index = overlap_scores.index(max_overlap_score)
-        return self.categories[predicted_index]
+        Each step expands all beams by every category, keeps the best `branching`
+        sequences and steps their branches (as a batch) with the chosen inputs.
+        Step scores are overlap lookup scores normalized over categories.
+
+        Returns:
+            list of (sequence, score) for the best sequences, best first
+        '''
+        fork = self.brain.fork()
+        sequences = [""]
+        sequence_scores = np.ones(1)
+        for step in range(k):
+            probs = self.category_probabilities(fork.region_state(0, "bias"))
+            candidates = (sequence_scores[:, None] * probs).ravel()
+            best = np.argsort(-candidates, kind='mergesort')[:branching]
+            rows, cats = np.unravel_index(best, probs.shape)
+            sequences = [sequences[r] + self.categories[c] for r, c in zip(rows, cats)]
+            sequence_scores = candidates[best]
+            if step < k - 1:
+                fork = fork.branch(rows)
+                fork.process(np.array([self.encode(self.categories[c]) for c in cats]))
+        return zip(sequences, sequence_scores)
+
+    def predict_distribution(self, horizon=1):
+        '''
+        Distribution over categories for each of the next `horizon` inputs
+
+        Step 1 is category_probabilities of the current bias. For each further
+        step, a fork keeps one branch per category, holding the most likely path
+        ending with that category, and steps all branches as one batch. The next
+        distribution is the mix of the branches' distributions weighted by the
+        probability of their category (paths ending with the same category share
+        the state of the best one).
+
+        Returns:
+            (horizon, n_categories) np.array, rows summing to 1
+        '''
+        probs = self.category_probabilities(self.region.bias)[0]
+        distributions = [probs]
+        if horizon > 1:
+            fork = self.brain.fork()
+            inputs = np.array([self.encode(cat) for cat in self.categories])
+            parents = np.zeros(len(self.categories), dtype=int)
+            path_probs = probs
+            for step in range(1, horizon):
+                fork = fork.branch(parents)
+                fork.process(inputs)
+                transitions = self.category_probabilities(fork.region_state(0, "bias"))  # Branch (last category) -> next
+                distributions.append(distributions[-1].dot(transitions))
+                joint = path_probs[:, None] * transitions
+                parents = joint.argmax(axis=0)
+                path_probs = joint.max(axis=0)
+                path_probs /= path_probs.sum()  # Only relative path probabilities matter
+        return np.array(distributions)
+
+    def ranked_predictions(self, horizon=1, k=None):
+        '''
+        Returns list (one per step of predict_distribution) of (category, probability)
+        lists, best first, at most k each
+        '''
+        ranked = []
+        for probs in self.predict_distribution(horizon=horizon):
+            order = np.argsort(-probs, kind='mergesort')[:k]
+            ranked.append([(self.categories[i], probs[i]) for i in order])
+        return ranked
+
+    def score_sequences(self, sequences):
+        '''
+        Probability of each candidate continuation of the input so far: product
+        of category_probabilities of its inputs, step by step. All candidates
+        are stepped together as branches of one fork.
+
+        Returns:
+            (n_sequences,) np.array (0 for sequences with inputs outside categories)
+        '''
+        n = len(sequences)
+        scores = np.ones(n)
+        length = max([len(seq) for seq in sequences]) if n else 0
+        if not length:
+            return scores
+        fork = self.brain.fork(n_branches=n)
+        rows = np.arange(n)
+        for step in range(length):
+            live = np.array([step < len(seq) for seq in sequences])
+            # Finished sequences keep stepping with their last input, their score is final
+            current = [seq[min(step, len(seq) - 1)] if seq else None for seq in sequences]
+            index = np.array([self.category_index.get(c, -1) for c in current])
+            probs = self.category_probabilities(fork.region_state(0, "bias"))
+            step_probs = np.where(index >= 0, probs[rows, np.maximum(index, 0)], 0.0)
+            scores *= np.where(live, step_probs, 1.0)
+            if step < length - 1:
+                fork.process(np.array([self.encode(c) if c in self.category_index else np.zeros(self.brain.n_inputs) for c in current]))
+        return scores
+
+    def encode(self, raw_input):
+        i = ord(raw_input.upper()) - 65 # A == 0
+        return self.encoder.encode(i)
 
     def predict(self):
         if True:
-            return self.predict_via_overlap_lookup()
+            self.last_prediction = self.predict_via_overlap_lookup()
         else:
-            return self.predict_via_proximal_reversal()
+            self.last_prediction = self.predict_via_proximal_reversal()
+        return self.last_prediction
+
+    def accuracy(self):
+        '''
+        Fraction of predictions matching the input read next (None before any)
+        '''
+        return self.n_correct / float(self.n_scored) if self.n_scored else None
 
     def overlap(self, input, tallies):
         '''
@@ -81,9 +277,28 @@ class PPHTMPredictor(object):
         '''
         return util.bool_overlap(input, tallies)
 
+    def _add_category(self, raw_input):
+        # Input outside the categories given at construction, grow the lookup by a row
+        i = len(self.categories)
+        self.categories = list(self.categories) + [raw_input]
+        self.category_index[raw_input] = i
+        self.overlap_lookup = np.vstack((self.overlap_lookup, np.zeros((1, self.region.n_cells), dtype=self.overlap_lookup.dtype)))
+        self.overlap_norms = np.append(self.overlap_norms, 0.0)
+        self.overlap_seen = np.append(self.overlap_seen, False)
+        return i
+
     def read(self, raw_input, prior_input=None):
+        if self.last_prediction is not None:
+            self.n_scored += 1
+            self.n_correct += int(self.last_prediction == raw_input)
+            self.last_prediction = None
         if raw_input:
-            self.overlap_lookup[raw_input] = np.copy(self.region.overlap)
+            i = self.category_index.get(raw_input)
+            if i is None:
+                i = self._add_category(raw_input)
+            self.overlap_lookup[i] = self.region.overlap
+            self.overlap_norms[i] = self.overlap_lookup[i].sum()
+            self.overlap_seen[i] = True
             if prior_input:
                 key = prior_input + raw_input
                 self.activation_lookup[key] = np.copy(self.region.activation == 1)
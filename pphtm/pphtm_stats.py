@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+import math
+import time
+import numpy as np
+
+# Per-step instrumentation of a region: wall time of each phase of a step and
+# counters, kept in fixed-size ring buffers (one row per step).
+# LatencyHistogram records whole brain steps (see PPHTMBrain.latency).
+
+PHASES = [
+    "overlap",
+    "inhibition",
+    "segment_learning",
+    "duty_boost",
+    "radius",
+    "activation",
+    "bias",
+    "inference"  # Whole step run by the inference engine (FAST_INFERENCE)
+]
+COUNTERS = [
+    "active_cells",
+    "segments_evaluated",
+    "segments_learned",
+    "synapses_touched",
+    "synapses_increased",
+    "synapses_decreased",
+    "connections_made",
+    "connections_broken",
+    "cells_boosted",
+    "synapses_grown"
+]
+PHASE_INDEX = dict((phase, i) for i, phase in enumerate(PHASES))
+COUNTER_INDEX = dict((counter, i) for i, counter in enumerate(COUNTERS))
+
+
+class StepStats(object):
+    '''
+    Ring buffers of phase timings (seconds) and counters for the last
+    `size` steps of a region
+    '''
+
+    def __init__(self, size=256):
+        self.size = size
+        self.times = np.zeros((size, len(PHASES)))
+        self.counts = np.zeros((size, len(COUNTERS)), dtype=np.int64)
+        self.step_t = np.zeros(size, dtype=np.int64)  # Brain t of each row
+        self.totals = np.zeros(len(COUNTERS), dtype=np.int64)  # Counters over all steps
+        self.n_steps = 0  # Steps recorded in total
+        self.row = 0
+
+    def begin_step(self, t):
+        self.row = self.n_steps % self.size
+        self.times[self.row] = 0.0
+        self.counts[self.row] = 0
+        self.step_t[self.row] = t
+        return time.time()
+
+    def end_step(self):
+        self.n_steps += 1
+
+    def lap(self, phase, since):
+        '''
+        Add time elapsed since `since` to phase, returns now (start of next phase)
+        '''
+        now = time.time()
+        self.times[self.row, PHASE_INDEX[phase]] += now - since
+        return now
+
+    def count(self, counter, n=1):
+        self.counts[self.row, COUNTER_INDEX[counter]] += n
+        self.totals[COUNTER_INDEX[counter]] += n
+
+    def recorded(self):
+        '''
+        Returns (times, counts, step_t) of recorded steps, oldest first
+        '''
+        n = min(self.n_steps, self.size)
+        order = (np.arange(n) + (self.n_steps - n)) % self.size
+        return (self.times[order], self.counts[order], self.step_t[order])
+
+    def summary(self):
+        '''
+        Returns dict with per-phase mean / last / max step time (ms) and
+        per-counter mean / last / total over recorded steps
+        '''
+        times, counts, step_t = self.recorded()
+        phases = {}
+        counters = {}
+        if len(times):
+            for phase, i in PHASE_INDEX.items():
+                phases[phase] = {"mean": times[:, i].mean() * 1000., "last": times[-1, i] * 1000., "max": times[:, i].max() * 1000.}
+            for counter, i in COUNTER_INDEX.items():
+                counters[counter] = {"mean": counts[:, i].mean(), "last": int(counts[-1, i]), "total": int(counts[:, i].sum())}
+        return {
+            "steps": self.n_steps,
+            "window": len(times),
+            "step_ms": times.sum(axis=1).mean() * 1000. if len(times) else None,
+            "phases": phases,
+            "counters": counters
+        }
+
+
+class LatencyHistogram(object):
+    '''
+    HDR-style histogram of latencies (seconds): log-spaced buckets from
+    lowest to highest, so percentiles have a bounded relative error
+    (precision) over the whole range, with constant memory and O(1) record
+    '''
+
+    def __init__(self, lowest=1e-6, highest=100.0, precision=0.01):
+        self.lowest = lowest
+        self.log_ratio = math.log(1 + precision)
+        self.counts = np.zeros(int(math.ceil(math.log(highest / lowest) / self.log_ratio)) + 1, dtype=np.int64)
+        self.n = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value):
+        index = int(math.log(max(value, self.lowest) / self.lowest) / self.log_ratio)
+        self.counts[min(index, len(self.counts) - 1)] += 1
+        self.n += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def percentile(self, p):
+        '''
+        Upper bound of the bucket holding the p-th percentile (capped at max)
+        '''
+        if not self.n:
+            return None
+        index = int(np.searchsorted(np.cumsum(self.counts), math.ceil(self.n * p / 100.)))
+        return min(self.lowest * math.exp((index + 1) * self.log_ratio), self.max)
+
+    def summary(self):
+        '''
+        Returns dict with count, mean, p50, p90, p99 and max (ms)
+        '''
+        if not self.n:
+            return {"count": 0}
+        return {
+            "count": self.n,
+            "mean_ms": self.total / self.n * 1000.,
+            "p50_ms": self.percentile(50) * 1000.,
+            "p90_ms": self.percentile(90) * 1000.,
+            "p99_ms": self.percentile(99) * 1000.,
+            "max_ms": self.max * 1000.
+        }
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+# Opt-in call-level profiling of brain steps (chtm, pphtm)
+#
+# A Profiler attached to a brain wraps every Nth process() call, aggregates
+# stacks across profiled calls and dumps them in collapsed stack format
+# ("outer;inner;leaf value" per line), readable by flame graph tools
+# (flamegraph.pl, speedscope, inferno).
+#
+#   brain.profiler = profiling.Profiler(every=10, mode="sampling")
+#   ... run ...
+#   brain.profiler.dump("pphtm.folded")
+#
+# Modes:
+#   deterministic  Every call / return in profiled steps (sys.setprofile),
+#                  values are self time in microseconds. Exact, but slows
+#                  profiled steps down several times.
+#   sampling       Stack of the main thread every `interval` seconds of CPU
+#                  time (SIGPROF, Unix only), values are sample counts.
+
+import os
+import signal
+import sys
+import time
+
+MODES = ["deterministic", "sampling"]
+
+
+def _label(code):
+    return "%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+def _frame_stack(frame):
+    stack = []
+    while frame is not None:
+        stack.append(_label(frame.f_code))
+        frame = frame.f_back
+    return tuple(reversed(stack))
+
+
+class Profiler(object):
+    '''
+    Profiles every `every`-th call of call() and aggregates collapsed stacks
+    '''
+
+    def __init__(self, every=1, mode="deterministic", interval=0.001):
+        if mode not in MODES:
+            raise ValueError("Unknown profiler mode %s (one of %s)" % (mode, ", ".join(MODES)))
+        self.every = every
+        self.mode = mode
+        self.interval = interval
+        self.stacks = {}  # Stack (tuple of labels) -> microseconds (deterministic) or samples
+        self.n_calls = 0
+        self.n_profiled = 0
+        self.profiled_s = 0.0  # Wall time of profiled calls
+        self._stack = []  # Deterministic: [label, start, child time] of open calls
+        self._base = None  # Frames below the profiled call, left out of stacks
+
+    def call(self, fn, *args, **kwargs):
+        '''
+        Returns fn(*args, **kwargs), profiled if this is an Nth call
+        '''
+        self.n_calls += 1
+        if (self.n_calls - 1) % self.every:
+            return fn(*args, **kwargs)
+        self.n_profiled += 1
+        start = time.time()
+        self._base = len(_frame_stack(sys._getframe()))
+        self._start()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self._stop()
+            self.profiled_s += time.time() - start
+
+    def _start(self):
+        if self.mode == "deterministic":
+            self._stack = []
+            sys.setprofile(self._trace)
+        else:
+            signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def _stop(self):
+        if self.mode == "deterministic":
+            sys.setprofile(None)
+            self._stack = []  # Only the profiler's own calls are still open
+        else:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def _add(self, stack, value):
+        self.stacks[stack] = self.stacks.get(stack, 0) + value
+
+    def _close(self, now):
+        label, start, child = self._stack.pop()
+        elapsed = now - start
+        self._add(tuple([entry[0] for entry in self._stack]) + (label,), int((elapsed - child) * 1e6))
+        if self._stack:
+            self._stack[-1][2] += elapsed
+
+    def _trace(self, frame, event, arg):
+        now = time.time()
+        if event == "call":
+            self._stack.append([_label(frame.f_code), now, 0.0])
+        elif event == "c_call":
+            self._stack.append(["%s (builtin)" % getattr(arg, "__name__", arg), now, 0.0])
+        elif event in ("return", "c_return", "c_exception") and self._stack:
+            self._close(now)
+
+    def _sample(self, signum, frame):
+        stack = _frame_stack(frame)[self._base:]
+        if stack:
+            self._add(stack, 1)
+
+    def collapsed(self):
+        '''
+        Returns list of "frame;frame;frame value" lines, heaviest first
+        '''
+        lines = sorted(self.stacks.items(), key=lambda item: -item[1])
+        return ["%s %d" % (";".join(stack), value) for stack, value in lines if value > 0]
+
+    def dump(self, path):
+        '''
+        Write collapsed stacks of all profiled calls to path
+        '''
+        with open(path, "w") as f:
+            for line in self.collapsed():
+                f.write(line + "\n")
+        return path
+
+    def summary(self):
+        return {
+            "mode": self.mode,
+            "calls": self.n_calls,
+            "profiled": self.n_profiled,
+            "profiled_s": self.profiled_s,
+            "stacks": len(self.stacks)
+        }
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import golden_trace
+import tracing
+from htm.htm_brain import HTMBrain
+from chtm.chtm_brain import CHTMBrain
+from testing_pphtm import small_brain, encode, SEQUENCE
+
+
+def small_htm_brain(seed=1):
+    random.seed(seed)
+    np.random.seed(seed)
+    b = HTMBrain(columns_per_region=[16])
+    b.initialize(r1_inputs=len(encode("A")))
+    return b
+
+
+def small_chtm_brain(seed=1):
+    random.seed(seed)
+    np.random.seed(seed)
+    b = CHTMBrain(cells_per_region=[16, 16], r1_inputs=len(encode("A")))
+    b.initialize()
+    return b
+
+
+class GoldenTraceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.inputs = [encode(c) for c in SEQUENCE * 2]
+        self.levels = dict((module, tracing.get_tracer(module).level) for module in ["htm", "chtm"])
+        for module in self.levels:
+            tracing.set_level(module, 0)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+        for module, level in self.levels.items():
+            tracing.set_level(module, level)
+
+    def assertReplays(self, make_brain, fields):
+        inputs = self.inputs[:len(SEQUENCE)]
+        filename = os.path.join(self.path, "golden.npz")
+        golden_trace.record(make_brain(), inputs, path=filename)
+        trace = golden_trace.GoldenTrace.load(filename)
+        self.assertEqual(sorted(trace.state(0, 0).keys()), sorted(fields))
+        self.assertIsNone(golden_trace.replay(trace, make_brain(), inputs))
+        trace.state(3, 0)["boost"] += 1e-9
+        divergence = golden_trace.replay(trace, make_brain(), inputs)
+        self.assertEqual((divergence.step, divergence.region, divergence.field), (3, 0, "boost"))
+
+    def testHTM(self):
+        self.assertReplays(small_htm_brain, ["activation", "boost", "inhibition_radius", "overlap", "permanences"])
+        # Learning rule change shows up in the permanence checksum
+        trace = golden_trace.record(small_htm_brain(), self.inputs[:4])
+        changed = small_htm_brain()
+        changed.regions[0].permanence_inc *= 2
+        divergence = golden_trace.replay(trace, changed, self.inputs[:4])
+        self.assertEqual((divergence.region, divergence.field), (0, "permanences"))
+
+    def testCHTM(self):
+        self.assertReplays(small_chtm_brain, [field for field, phase in golden_trace.FIELDS["chtm"]])
+
+    def testPhaseOrder(self):
+        # Fields are compared in each engine's step order (bias is computed first
+        # in chtm, last in pphtm)
+        for make_brain, field in [(small_chtm_brain, "bias"), (small_brain, "overlap")]:
+            trace = golden_trace.record(make_brain(), self.inputs[:4])
+            trace.state(2, 0)["bias"] += 1e-9
+            trace.state(2, 0)["overlap"] += 1e-9
+            divergence = golden_trace.replay(trace, make_brain(), self.inputs[:4])
+            self.assertEqual((divergence.step, divergence.field, divergence.phase), (2, field, field))
+
+    def testBaselineGolden(self):
+        # Recorded from the baseline engine, optimised paths must replay it exactly
+        filename = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden", "pphtm_small.npz")
+        trace = golden_trace.GoldenTrace.load(filename)
+        self.assertEqual(trace.engine(), "pphtm")
+        for params in [{}, {"KERNEL_BACKEND": "numpy"}, {"BINARY_ENGINE": True}, {"FAST_INFERENCE": False}]:
+            divergence = golden_trace.replay(trace, small_brain(CHANCE_OF_INHIBITORY=0.2, **params), self.inputs)
+            self.assertIsNone(divergence, "%s: %s" % (params, divergence))
+
+    def testReplayMatches(self):
+        filename = os.path.join(self.path, "golden.npz")
+        golden_trace.record(small_brain(CHANCE_OF_INHIBITORY=0.2), self.inputs, path=filename)
+        self.assertIsNone(golden_trace.replay(filename, small_brain(CHANCE_OF_INHIBITORY=0.2), self.inputs))
+
+    def testFirstDivergence(self):
+        trace = golden_trace.record(small_brain(), self.inputs)
+        divergence = golden_trace.replay(trace, small_brain(PERM_LEARN_INC=0.08), self.inputs)
+        self.assertEqual((divergence.step, divergence.region, divergence.field, divergence.phase), (0, 0, "permanences", "segment_learning"))
+        # Small offsets only diverge in exact mode
+        trace.state(3, 1)["boost"] += 1e-9
+        divergence = golden_trace.replay(trace, small_brain(), self.inputs)
+        self.assertEqual((divergence.step, divergence.region, divergence.field), (3, 1, "boost"))
+        self.assertIsNone(golden_trace.replay(trace, small_brain(), self.inputs, atol=1e-6))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,790 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+import os
+import copy
+import json
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+import urllib2
+import numpy as np
+import util
+from pphtm.pphtm_brain import PPHTMBrain
+from pphtm.pphtm_predictor import PPHTMPredictor
+from pphtm import pphtm_kernels
+from pphtm import pphtm_checkpoint
+from pphtm import pphtm_inference
+from pphtm import pphtm_memory
+from pphtm.pphtm_checkpoint import DeltaCheckpointer, AsyncCheckpointWriter
+from pphtm.pphtm_metrics import MetricsExporter
+from encoders import SimpleFullWidthEncoder
+
+CATS = "ABCD"
+SEQUENCE = "ABCDABCDBADCABCD"
+
+
+def small_brain(seed=1, **params):
+    random.seed(seed)
+    np.random.seed(seed)
+    n_inputs = len(CATS) ** 2
+    b = PPHTMBrain(min_overlap=1, r1_inputs=n_inputs)
+    config = {
+        "CELLS_PER_REGION": 6**2,
+        "N_REGIONS": 2,
+        "PROXIMAL_ACTIVATION_THRESHHOLD": 2
+    }
+    config.update(params)
+    b.initialize(**config)
+    return b
+
+
+def encode(c):
+    encoder = SimpleFullWidthEncoder(n_inputs=len(CATS) ** 2, n_cats=len(CATS))
+    return encoder.encode(CATS.index(c))
+
+
+class PPHTMBrainTestCase(unittest.TestCase):
+
+    def testStepEvery(self):
+        b = small_brain(REGION_STEP_EVERY=[1, 3])
+        held = None
+        for t, c in enumerate(SEQUENCE):
+            b.process(encode(c), learning=True)
+            r1 = b.regions[1]
+            if t % 3 != 0:
+                # Held regions keep activation from their last step
+                self.assertTrue(np.array_equal(r1.activation, held))
+            held = np.copy(r1.activation)
+        self.assertEqual(b.regions[0].n_steps, len(SEQUENCE))
+        self.assertEqual(b.regions[1].n_steps, 6)
+        self.assertEqual(b.regions[1].n_skipped, len(SEQUENCE) - 6)
+
+    def testStepChangeThreshold(self):
+        b = small_brain(REGION_STEP_CHANGE_THRESHOLD=[0.0, 1000.0])
+        for c in SEQUENCE:
+            b.process(encode(c), learning=True)
+        # Only the first input steps a region whose input never changes enough
+        self.assertEqual(b.regions[1].n_steps, 1)
+
+    def testHoldKeepsNoInputCopy(self):
+        b = small_brain()
+        input = encode("A")
+        b.process(input, learning=True)
+        self.assertTrue(b.regions[0].input is input)
+        self.assertTrue(b.regions[0].last_stepped_input is None)
+        b = small_brain(REGION_STEP_CHANGE_THRESHOLD=0.5)
+        b.process(input, learning=True)
+        self.assertFalse(b.regions[0].input is input)
+        self.assertTrue(np.array_equal(b.regions[0].last_stepped_input, input))
+
+    def testFastInferenceMatchesReference(self):
+        reference = small_brain(FAST_INFERENCE=False, CHANCE_OF_INHIBITORY=0.2)
+        fast = small_brain(FAST_INFERENCE=True, CHANCE_OF_INHIBITORY=0.2)
+        for i, c in enumerate(SEQUENCE * 3):
+            learning = i % 4 != 3
+            reference.process(encode(c), learning=learning)
+            fast.process(encode(c), learning=learning)
+            for r_ref, r_fast in zip(reference.regions, fast.regions):
+                for attr in ["overlap", "pre_activation", "activation", "bias", "pre_bias"]:
+                    self.assertTrue(np.array_equal(getattr(r_ref, attr), getattr(r_fast, attr)), "%s differs at step %d" % (attr, i))
+
+    def testForkMatchesBrain(self):
+        b = small_brain(REGION_STEP_EVERY=[1, 2])
+        for c in SEQUENCE:
+            b.process(encode(c), learning=True)
+        fork = b.fork(n_branches=2)
+        bias_before = np.copy(b.regions[0].bias)
+        fork.process(np.array([encode("A"), encode("B")]))
+        # Fork leaves the brain untouched
+        self.assertTrue(np.array_equal(b.regions[0].bias, bias_before))
+        b.process(encode("B"), learning=False)
+        for i, r in enumerate(b.regions):
+            for attr in ["overlap", "activation", "bias"]:
+                self.assertTrue(np.array_equal(fork.region_state(i, attr)[1], getattr(r, attr)))
+
+    def testOverlapLookupPrediction(self):
+        b = small_brain()
+        predictor = PPHTMPredictor(b, categories=CATS)
+        predictor.initialize()
+        reference = {}
+        for c in SEQUENCE * 2:
+            b.process(encode(c), learning=True)
+            predictor.read(c)
+            reference[c] = np.copy(b.regions[0].overlap)
+            scores = dict((cat, np.dot(overlap, b.regions[0].bias) / sum(overlap)) for cat, overlap in reference.items())
+            best = max(scores.values())
+            self.assertTrue(scores[predictor.predict()] == best)
+            top = predictor.predict_top_k(k=2)
+            self.assertEqual(len(top), min(2, len(reference)))
+            self.assertAlmostEqual(top[0][1], best)
+        self.assertTrue(np.array_equal(predictor.overlap_for("B"), reference["B"]))
+        self.assertEqual(predictor.overlap_for("Z"), None)
+
+    def testProximalReversal(self):
+        b = small_brain()
+        predictor = PPHTMPredictor(b, categories=CATS)
+        predictor.initialize()
+        r = b.regions[0]
+        for c in SEQUENCE:
+            b.process(encode(c), learning=True)
+            tallies = np.zeros(r.n_inputs)
+            for i in np.nonzero(r.bias >= 0.5)[0]:
+                for seg in r.cells[i].proximal_segments:
+                    for source in seg.syn_sources:
+                        tallies[source] += 1
+            scores = predictor.reversal_scores()
+            self.assertTrue(np.array_equal(predictor.tallies, tallies))
+            self.assertEqual(list(scores), [util.bool_overlap(predictor.encode(cat), tallies) for cat in CATS])
+            self.assertEqual(predictor.predict_via_proximal_reversal(), CATS[list(scores).index(max(scores))])
+        # Matrix follows added synapses
+        seg = r.cells[0].proximal_segments[0]
+        before = predictor.proximal_matrix()[0, 3]
+        seg.add_synapse(3)
+        self.assertEqual(predictor.proximal_matrix()[0, 3], before + 1)
+        batch = predictor.reversal_scores(np.array([r.bias, np.ones(r.n_cells)]))
+        self.assertEqual(batch.shape, (2, len(CATS)))
+
+    def testPredictK(self):
+        b = small_brain()
+        predictor = PPHTMPredictor(b, categories=CATS)
+        predictor.initialize()
+        prior = None
+        for c in SEQUENCE:
+            b.process(encode(c), learning=True)
+            predictor.read(c, prior_input=prior)
+            prior = c
+        results = predictor.predict_k(k=3, branching=2)
+        self.assertEqual(len(results), 2)
+        for sequence, score in results:
+            self.assertEqual(len(sequence), 3)
+            self.assertTrue(0.0 <= score <= 1.0)
+        self.assertTrue(results[0][1] >= results[1][1])
+
+    def testPredictDistribution(self):
+        b = small_brain()
+        predictor = PPHTMPredictor(b, categories=CATS)
+        predictor.initialize()
+        for c in SEQUENCE:
+            b.process(encode(c), learning=True)
+            predictor.read(c)
+        distributions = predictor.predict_distribution(horizon=3)
+        self.assertEqual(distributions.shape, (3, len(CATS)))
+        self.assertTrue(np.allclose(distributions.sum(axis=1), 1.0))
+        self.assertTrue(np.allclose(distributions[0], predictor.category_probabilities(b.regions[0].bias)[0]))
+        # Two steps ahead is exact: sum over first inputs of the pair probabilities
+        pairs = [a + c for a in CATS for c in CATS]
+        pair_scores = predictor.score_sequences(pairs).reshape(len(CATS), len(CATS))
+        self.assertTrue(np.allclose(pair_scores.sum(axis=1), distributions[0]))
+        self.assertTrue(np.allclose(pair_scores.sum(axis=0), distributions[1]))
+        self.assertTrue(np.allclose(predictor.score_sequences(list(CATS) + ["", "AZ"]), list(distributions[0]) + [1.0, 0.0]))
+        ranked = predictor.ranked_predictions(horizon=2, k=2)
+        self.assertEqual(len(ranked), 2)
+        self.assertEqual(ranked[0][0][0], CATS[int(np.argmax(distributions[0]))])
+        self.assertTrue(ranked[1][0][1] >= ranked[1][1][1])
+        self.assertEqual(b.t, len(SEQUENCE))
+
+    def testSparseInputMatchesDense(self):
+        dense = small_brain()
+        sparse = small_brain()
+        encoder = SimpleFullWidthEncoder(n_inputs=len(CATS) ** 2, n_cats=len(CATS))
+        for i, c in enumerate(SEQUENCE * 2):
+            learning = i % 3 != 2
+            dense.process(encode(c), learning=learning)
+            sparse.process_sparse(encoder.encode_sparse(CATS.index(c)), learning=learning)
+            for r_dense, r_sparse in zip(dense.regions, sparse.regions):
+                for attr in ["overlap", "activation", "bias"]:
+                    self.assertTrue(np.array_equal(getattr(r_dense, attr), getattr(r_sparse, attr)), "%s differs at step %d" % (attr, i))
+
+    def testBinaryEngineMatchesDense(self):
+        for fade_rate in [0.5, 1.0]:
+            dense = small_brain(CHANCE_OF_INHIBITORY=0.2, FADE_RATE=fade_rate)
+            binary = small_brain(CHANCE_OF_INHIBITORY=0.2, FADE_RATE=fade_rate, BINARY_ENGINE=True)
+            for c in SEQUENCE:
+                dense.process(encode(c), learning=True)
+                binary.process(encode(c), learning=True)
+            for c in SEQUENCE:
+                dense.process(encode(c), learning=False)
+                binary.process(encode(c), learning=False)
+                for r_dense, r_binary in zip(dense.regions, binary.regions):
+                    self.assertTrue(np.array_equal(r_dense.bias, r_binary.bias))
+                    self.assertTrue(np.array_equal(r_dense.activation, r_binary.activation))
+
+    def testPopcount(self):
+        np.random.seed(1)
+        for n_bits in [100, 2**16 + 3]:  # uint16 and uint32 counts
+            bits = np.random.rand(3, n_bits) > 0.3
+            self.assertTrue(np.array_equal(pphtm_inference.popcount(pphtm_inference.pack_bits(bits)), bits.sum(axis=-1)))
+        rows = [(np.array([0, 1, 2]), np.array([1, -1, -1])), (np.array([0, 1, 3]), np.array([1, 1, -1]))]
+        active = np.array([[True, True, True, False]])
+        self.assertEqual(pphtm_inference.BitSegments(rows, 4).activation(active).tolist(), [[-1, 2]])
+        self.assertEqual(pphtm_inference.SignedSegments(rows, 4).activation(active.astype(float)).tolist(), [[-1, 2]])
+
+    def testInferenceSnapshotUpdates(self):
+        for binary in [False, True]:
+            b = small_brain(CHANCE_OF_INHIBITORY=0.2, BINARY_ENGINE=binary)
+            b.process(encode("A"), learning=False)
+            snapshots = list(b.engine.snapshots)
+            n_connected = snapshots[0].proximal.indptr[-1]
+            for c in SEQUENCE:
+                b.process(encode(c), learning=True)
+                b.process(encode(c), learning=False)
+            # Learning steps update rows in place of rebuilding, and match a rebuild
+            self.assertEqual(b.engine.snapshots, snapshots)
+            self.assertNotEqual(snapshots[0].proximal.indptr[-1], n_connected)
+            for r, snap in zip(b.regions, snapshots):
+                rebuilt = pphtm_inference.RegionSnapshot(r, binary=binary)
+                for type, matrix in snap.matrices.items():
+                    for attr in ["indptr", "indices", "signs", "excitatory", "inhibitory"]:
+                        if hasattr(matrix, attr):
+                            self.assertTrue(np.array_equal(getattr(matrix, attr), getattr(rebuilt.matrices[type], attr)), attr)
+
+    def testPredictorReusesSnapshot(self):
+        b = small_brain(CHANCE_OF_INHIBITORY=0.2)
+        predictor = PPHTMPredictor(b, categories=CATS)
+        predictor.initialize()
+        predictor.predict_distribution(horizon=2)
+        snapshots = list(b.engine.snapshots)
+        for c in SEQUENCE:
+            b.process(encode(c), learning=True)
+            predictor.predict_distribution(horizon=3)
+            predictor.predict_k(k=2)
+            predictor.score_sequences(["AB", "BA", "C"])
+        # Forks after learning steps update the changed rows of the same snapshot
+        self.assertEqual(b.engine.n_rebuilds, 1)
+        self.assertEqual(b.engine.snapshots, snapshots)
+        for r, snap in zip(b.regions, snapshots):
+            rebuilt = pphtm_inference.RegionSnapshot(r)
+            for type, matrix in snap.matrices.items():
+                self.assertTrue(np.array_equal(matrix.indices, rebuilt.matrices[type].indices))
+
+    def testSeededRandomInit(self):
+        # Recorded from the original random-mode initialization (same seed and config)
+        b = small_brain()
+        seg = b.regions[0].cells[0].distal_segments[0]
+        self.assertEqual(list(seg.syn_sources), [6, 11, 14, 17, 21, 22, 26, 32])
+        self.assertEqual([round(p, 6) for p in seg.syn_permanences], [0.204379, 0.187137, 0.20244, 0.196948, 0.199485, 0.177174, 0.183517, 0.200689])
+        for r, n_synapses, lateral_sum in zip(b.regions, [2308, 2407], [380.709403, 299.797587]):
+            segments = [seg for cell in r.cells for seg in cell.all_segments()]
+            self.assertEqual(sum([seg.n_synapses() for seg in segments]), n_synapses)
+            self.assertAlmostEqual(sum([sum(seg.syn_permanences) for seg in segments if not seg.proximal()]), lateral_sum, places=5)
+
+    def testLocalCappedConnectivity(self):
+        b = small_brain(DISTAL_CONNECTIVITY="radius", DISTAL_RADIUS=2.0, DISTAL_SYNAPSE_CHANCE=1.0, MAX_DISTAL_SYNAPSES=6)
+        r = b.regions[0]
+        for cell in r.cells:
+            for seg in cell.distal_segments:
+                self.assertTrue(0 < seg.n_synapses() <= 6)
+                self.assertNotIn(cell.index, seg.syn_sources)
+                for source in seg.syn_sources:
+                    self.assertTrue(util.dist_from_indexes(source, cell.index, r._cell_side_len()) <= 2.0)
+
+    def testGrowConnectivity(self):
+        b = small_brain(DISTAL_CONNECTIVITY="grow", NEW_SYNAPSE_COUNT=3, MAX_DISTAL_SYNAPSES=10)
+        segments = [seg for cell in b.regions[0].cells for seg in cell.distal_segments]
+        self.assertEqual(sum([seg.n_synapses() for seg in segments]), 0)
+        for c in SEQUENCE:
+            b.process(encode(c), learning=True)
+        n_synapses = [seg.n_synapses() for seg in segments]
+        self.assertTrue(sum(n_synapses) > 0)
+        self.assertTrue(max(n_synapses) <= 10)
+
+    def testPruning(self):
+        b = small_brain()
+        totals = [sum([seg.n_synapses() for cell in r.cells for seg in cell.all_segments()]) for r in b.regions]
+        self.assertEqual([report["remaining"] for report in b.pruning_report()], totals)
+        self.assertEqual([r.n_synapses for r in b.regions], totals)
+        seg = b.regions[0].cells[0].distal_segments[0]
+        n_synapses = seg.n_synapses()
+        for i in range(3):
+            seg.syn_permanences[i] = 0.0
+        b.CONFIG["PRUNE_GRACE"] = 2
+        b.prune()  # Marks candidates
+        self.assertEqual(seg.n_synapses(), n_synapses)
+        b.t += 2
+        b.prune()
+        self.assertEqual(seg.n_synapses(), n_synapses - 3)
+        report = b.pruning_report()
+        self.assertEqual(report[0]["pruned"], 3)
+        self.assertEqual(report[1]["pruned"], 0)
+        self.assertEqual([r["remaining"] for r in report], [totals[0] - 3, totals[1]])
+        self.assertTrue(all([p > 0.0 for p in seg.syn_permanences]))
+
+    def testPruneKeepsPoolsImplicit(self):
+        b = small_brain(IMPLICIT_POOLS=True, POOL_RELEASE_INTERVAL=0, PRUNE_GRACE=0)
+        r = b.regions[0]
+        segments = [seg for cell in r.cells for seg in cell.all_segments()]
+        seg = r.cells[3].distal_segments[1]
+        sources = list(seg.syn_sources)
+        seg.syn_permanences[2] = 0.0
+        seg.add_synapse(5 if 5 not in sources else 6, permanence=0.0)
+        b.release_pools()
+        r.recount_permanences()
+        total = sum(r.permanence_stats.n_synapses.values())
+        self.assertEqual(r.prune_synapses(), 2)
+        # Pruning works on the overlay, pools stay implicit
+        self.assertFalse(any([s.materialized() for s in segments]))
+        self.assertEqual(r.n_synapses, total - 2)
+        self.assertEqual(list(seg.syn_sources), sources[:2] + sources[3:])
+
+    def testImplicitPools(self):
+        b = small_brain(IMPLICIT_POOLS=True, POOL_RELEASE_INTERVAL=0)
+        segments = [seg for r in b.regions for cell in r.cells for seg in cell.all_segments()]
+        self.assertFalse(any([seg.materialized() for seg in segments]))
+        # Pools are deterministic
+        seg = b.regions[0].cells[3].distal_segments[1]
+        sources = list(seg.syn_sources)
+        seg.release()
+        self.assertEqual(list(seg.syn_sources), sources)
+        self.assertTrue(len(sources) > 0)
+        for c in SEQUENCE:
+            b.process(encode(c), learning=True)
+        permanences = [list(seg.syn_permanences) for seg in segments]
+        b.release_pools()
+        self.assertFalse(any([seg.materialized() for seg in segments]))
+        self.assertTrue(any([seg.pool_overlay for seg in segments]))
+        # Inference snapshot is built from released pools
+        b.synapse_version += 1
+        b.process(encode("A"), learning=False)
+        self.assertFalse(any([seg.materialized() for seg in segments]))
+        self.assertEqual([list(seg.syn_permanences) for seg in segments], permanences)
+
+    def testKernels(self):
+        b = small_brain(KERNEL_BACKEND="numpy")
+        self.assertEqual(b.kernels.name, "numpy")
+        fallback = pphtm_kernels.get_kernels("numba")
+        self.assertEqual(fallback.name, "numba" if pphtm_kernels.numba is not None else "numpy")
+        reference = pphtm_kernels.NumpyKernels()
+        r = b.regions[0]
+        values = np.random.rand(3, r.n_cells) - 0.2
+        mask = r.neighbor_mask()
+        self.assertTrue(np.array_equal(fallback.local_winners(values, mask, 2), reference.local_winners(values, mask, 2)))
+        for i in range(r.n_cells):
+            kth = r._kth_score(r._neighbors_of(r.cells[i]), values[0], k=2)
+            self.assertEqual(reference.local_winners(values, mask, 2)[0, i], values[0, i] > 0 and values[0, i] >= kth)
+        active = np.array([[True, False], [False, False], [False, True]])
+        learns = reference.segment_learning(np.array([True, True, False]), np.array([False, False, True]), active)
+        self.assertTrue(np.array_equal(learns, [[True, False], [True, True], [False, True]]))
+
+    def _assertSameState(self, a, b):
+        self.assertEqual(a.t, b.t)
+        for r_a, r_b in zip(a.regions, b.regions):
+            for attr in ["overlap", "pre_activation", "activation", "bias", "boost", "active_duty_cycle"]:
+                self.assertTrue(np.array_equal(getattr(r_a, attr), getattr(r_b, attr)), attr)
+            for cell_a, cell_b in zip(r_a.cells, r_b.cells):
+                self.assertEqual(cell_a.recent_active_duty, cell_b.recent_active_duty)
+                for seg_a, seg_b in zip(cell_a.all_segments(), cell_b.all_segments()):
+                    self.assertEqual(list(seg_a.syn_sources), list(seg_b.syn_sources))
+                    self.assertEqual(list(seg_a.syn_permanences), list(seg_b.syn_permanences))
+                    self.assertEqual(list(seg_a.syn_change), list(seg_b.syn_change))
+
+    def testCheckpointRoundTrip(self):
+        path = tempfile.mkdtemp()
+        try:
+            for params in [{"CHANCE_OF_INHIBITORY": 0.2, "REGION_STEP_EVERY": [1, 2]}, {"IMPLICIT_POOLS": True, "POOL_RELEASE_INTERVAL": 5}]:
+                b = small_brain(**params)
+                for i, c in enumerate(SEQUENCE):
+                    b.process(encode(c), learning=i % 4 != 3)
+                b.save(path)
+                draws = [random.random(), np.random.rand()]
+                restored = PPHTMBrain.load(path)
+                self.assertEqual([random.random(), np.random.rand()], draws)
+                self._assertSameState(b, restored)
+                # Continues bit-exact, including random draws
+                for i, c in enumerate(SEQUENCE):
+                    b.process(encode(c), learning=i % 3 != 2)
+                    restored.process(encode(c), learning=i % 3 != 2)
+                self._assertSameState(b, restored)
+        finally:
+            shutil.rmtree(path)
+
+    def testInterruptedSave(self):
+        path = tempfile.mkdtemp()
+        try:
+            b = small_brain()
+            for c in SEQUENCE[:8]:
+                b.process(encode(c), learning=True)
+            b.save(path)
+            saved = PPHTMBrain.load(path)
+            for c in SEQUENCE[8:]:
+                b.process(encode(c), learning=True)
+            # Crash after writing some arrays of the next base
+            manifest, arrays = pphtm_checkpoint.snapshot(b, path)
+            partial = dict(list(arrays.items())[:len(arrays) / 2])
+            for name, value in partial.items():
+                np.save(os.path.join(path, manifest["files"][name]), value)
+            self._assertSameState(saved, PPHTMBrain.load(path))
+            b.save(path)
+            self._assertSameState(b, PPHTMBrain.load(path))
+            # Only files of the current base remain
+            with open(os.path.join(path, pphtm_checkpoint.MANIFEST)) as f:
+                files = json.load(f)["files"]
+            self.assertEqual(sorted(os.listdir(path)), sorted(set(files.values()) | set([pphtm_checkpoint.MANIFEST])))
+        finally:
+            shutil.rmtree(path)
+
+    def testMappedSynapses(self):
+        path = tempfile.mkdtemp()
+        try:
+            b = small_brain()
+            for c in SEQUENCE:
+                b.process(encode(c), learning=True)
+            b.save(path)
+            mapped = PPHTMBrain.load(path, mmap_mode="r+")
+            seg = mapped.regions[0].cells[0].distal_segments[0]
+            self.assertTrue(isinstance(seg.syn_permanences, np.memmap))
+            for c in SEQUENCE:
+                b.process(encode(c), learning=True)
+                mapped.process(encode(c), learning=True)
+            self._assertSameState(b, mapped)
+            # Saving onto the mapped checkpoint keeps synapse files in place
+            mapped.save(path)
+            self._assertSameState(b, PPHTMBrain.load(path))
+            # Read-only mapping serves inference, rejects learning
+            readonly = PPHTMBrain.load(path, mmap_mode="r")
+            b.process(encode("A"), learning=False)
+            readonly.process(encode("A"), learning=False)
+            self.assertTrue(np.array_equal(b.regions[-1].activation, readonly.regions[-1].activation))
+            self.assertRaises(ValueError, readonly.process, encode("B"), learning=True)
+        finally:
+            shutil.rmtree(path)
+
+    def testMappedSaveRoundTrip(self):
+        path = tempfile.mkdtemp()
+        try:
+            b = small_brain()
+            for c in SEQUENCE:
+                b.process(encode(c), learning=True)
+            b.save(path)
+            mapped = PPHTMBrain.load(path, mmap_mode="r+")
+            for c in SEQUENCE[:4]:
+                b.process(encode(c), learning=True)
+                mapped.process(encode(c), learning=True)
+            # Learning resets change state of inactive segments in place
+            seg = mapped.regions[0].cells[0].distal_segments[0]
+            self.assertTrue(isinstance(seg.syn_change, np.memmap))
+            mapped.save(path)
+            del mapped
+            self._assertSameState(b, PPHTMBrain.load(path))
+        finally:
+            shutil.rmtree(path)
+
+    def testDeltaCheckpoints(self):
+        path = tempfile.mkdtemp()
+        try:
+            b = small_brain(CHANCE_OF_INHIBITORY=0.2)
+            checkpointer = DeltaCheckpointer(b, path, compact_every=2)
+            checkpointer.checkpoint()  # Base
+            for chunk in range(3):
+                for i, c in enumerate(SEQUENCE[:6]):
+                    b.process(encode(c), learning=i % 4 != 3)
+                checkpointer.checkpoint()
+                restored = PPHTMBrain.load(path)
+                self._assertSameState(b, restored)
+            # Two deltas, then compacted into a new base
+            self.assertEqual(checkpointer.n_deltas, 0)
+            self.assertEqual(len([f for f in os.listdir(path) if f.startswith("delta_")]), 0)
+            for c in SEQUENCE:
+                b.process(encode(c), learning=True)
+                restored.process(encode(c), learning=True)
+            self._assertSameState(b, restored)
+        finally:
+            shutil.rmtree(path)
+
+    def testDeltaCheckpointsMapped(self):
+        path = tempfile.mkdtemp()
+        try:
+            b = small_brain()
+            for c in SEQUENCE:
+                b.process(encode(c), learning=True)
+            b.save(path)
+            mapped = PPHTMBrain.load(path, mmap_mode="r+")
+            checkpointer = DeltaCheckpointer(mapped, path, compact_every=5)
+            checkpointer.checkpoint()  # Base
+            for chunk in range(2):
+                for c in SEQUENCE[:5]:
+                    b.process(encode(c), learning=True)
+                    mapped.process(encode(c), learning=True)
+                checkpointer.checkpoint()
+            self.assertEqual(checkpointer.n_deltas, 2)
+            captured = copy.deepcopy(b)
+            # Mapped synapses keep changing after the last delta
+            for c in SEQUENCE:
+                b.process(encode(c), learning=True)
+                mapped.process(encode(c), learning=True)
+            mapped.flush()
+            del mapped
+            self._assertSameState(captured, PPHTMBrain.load(path))
+            # Mapping "r+" folds the replayed deltas into the mapped base
+            remapped = PPHTMBrain.load(path, mmap_mode="r+")
+            self._assertSameState(captured, remapped)
+            self.assertEqual([f for f in os.listdir(path) if f.startswith("delta_")], [])
+            for c in SEQUENCE[:5]:
+                captured.process(encode(c), learning=True)
+                remapped.process(encode(c), learning=True)
+            remapped.save(path)
+            del remapped
+            self._assertSameState(captured, PPHTMBrain.load(path))
+        finally:
+            shutil.rmtree(path)
+
+    def testAsyncCheckpoints(self):
+        path = tempfile.mkdtemp()
+        try:
+            b = small_brain()
+            writer = AsyncCheckpointWriter(b, path, compact_every=3)
+            for i, c in enumerate(SEQUENCE):
+                b.process(encode(c), learning=True)
+                if i % 4 == 3:
+                    self.assertTrue(writer.checkpoint())
+            writer.close()
+            stats = writer.stats()
+            self.assertEqual(stats["written"], 4)
+            self.assertEqual(stats["pending"], 0)
+            self.assertTrue(stats["latency_ms"]["max"] >= stats["write_ms"]["max"])
+            self._assertSameState(b, PPHTMBrain.load(path))
+        finally:
+            shutil.rmtree(path)
+
+    def testAsyncCheckpointMapped(self):
+        path = tempfile.mkdtemp()
+        try:
+            b = small_brain()
+            for c in SEQUENCE:
+                b.process(encode(c), learning=True)
+            b.save(path)
+            mapped = PPHTMBrain.load(path, mmap_mode="r+")
+            writer = AsyncCheckpointWriter(mapped, path, delta=False)
+            for c in SEQUENCE[:4]:
+                b.process(encode(c), learning=True)
+                mapped.process(encode(c), learning=True)
+            captured = copy.deepcopy(b)
+            writer.checkpoint()
+            # Mapped synapses keep changing in place after the capture
+            for c in SEQUENCE[4:]:
+                b.process(encode(c), learning=True)
+                mapped.process(encode(c), learning=True)
+            writer.close()
+            self._assertSameState(captured, PPHTMBrain.load(path))
+            # The live mapped files stay in place for the brain
+            mapped.save(path)
+            del mapped
+            self._assertSameState(b, PPHTMBrain.load(path))
+        finally:
+            shutil.rmtree(path)
+
+    def testStats(self):
+        b = small_brain(STATS_HISTORY=8, REGION_STEP_EVERY=[1, 2])
+        for i, c in enumerate(SEQUENCE):
+            b.process(encode(c), learning=i % 4 != 3)
+        stats = b.stats()
+        self.assertEqual(stats["t"], len(SEQUENCE))
+        r0, r1 = stats["regions"]
+        self.assertEqual(r0["steps"], len(SEQUENCE))
+        self.assertEqual(r1["steps"], len(SEQUENCE) / 2)
+        self.assertEqual(r0["window"], 8)
+        self.assertTrue(r0["phases"]["overlap"]["mean"] > 0)
+        self.assertTrue(r0["phases"]["inference"]["max"] > 0)
+        self.assertTrue(r0["counters"]["segments_learned"]["total"] > 0)
+        self.assertTrue(r0["counters"]["active_cells"]["last"] > 0)
+
+    def testPermanenceStats(self):
+        for params in [{"CHANCE_OF_INHIBITORY": 0.2}, {"DISTAL_CONNECTIVITY": "grow", "PRUNE_INTERVAL": 4, "PRUNE_FLOOR": 0.2, "PRUNE_GRACE": 0}]:
+            b = small_brain(**params)
+            for c in SEQUENCE * 2:
+                b.process(encode(c), learning=True)
+            running = b.stats()["regions"]
+            for r, summary in zip(b.regions, running):
+                r.recount_permanences()
+                for name, exact in r.permanence_stats.summary().items():
+                    self.assertEqual(summary["permanences"][name]["synapses"], exact["synapses"])
+                    self.assertEqual(summary["permanences"][name]["connected"], exact["connected"])
+                    self.assertAlmostEqual(summary["permanences"][name]["mean_permanence"], exact["mean_permanence"])
+            self.assertTrue(running[0]["permanences"]["proximal"]["synapses"] > 0)
+
+    def testMemoryReport(self):
+        b = small_brain(MEMORY_SAMPLE_INTERVAL=4)
+        predictor = PPHTMPredictor(b, categories=CATS)
+        predictor.initialize()
+        for c in SEQUENCE:
+            b.process(encode(c), learning=True)
+            predictor.read(c)
+        report = b.memory_report(predictor=predictor)
+        self.assertEqual([sample["t"] for sample in report["history"]], [0, 4, 8, 12])
+        for r, region_report in zip(b.regions, report["regions"]):
+            self.assertEqual(region_report["total_bytes"], sum(region_report["kinds"].values()))
+            self.assertEqual(region_report["synapses"], sum([seg.n_synapses() for cell in r.cells for seg in cell.all_segments()]))
+            self.assertEqual(region_report["segment_types"]["distal"]["segments"], r.n_cells * b.config("DISTAL_SEGMENTS"))
+        self.assertTrue(report["kinds"]["synapses"] > 0)
+        self.assertEqual(report["kinds"]["mapped_synapses"], 0)
+        self.assertTrue(report["predictor"]["overlap_lookup"] > 0)
+        # Inference snapshots and fork buffers count per region
+        b.process(encode("A"))
+        fork = b.fork(n_branches=3)
+        report = b.memory_report(forks=[fork])
+        for snap, region_report in zip(b.engine.snapshots, report["regions"]):
+            self.assertTrue(region_report["kinds"]["inference_engine"] > snap.nbytes() > 0)
+        # Views count the array owning their data, once
+        data = np.zeros(1000)
+        views = [data[:10], data[10:], data]
+        self.assertEqual(pphtm_memory.sizeof(views), sys.getsizeof(views) + data.nbytes)
+
+    def testLatencyBudget(self):
+        b = small_brain(STEP_LATENCY_BUDGET=1e-9, STEP_BUDGET_MAX_DEFERRED_LEARNING=4)
+        permanences = [r.permanence_stats.perm_sum.copy() for r in b.regions]
+        for c in SEQUENCE:
+            b.process(encode(c), learning=True)
+        b.process(encode("A"), learning=False)
+        report = b.latency_report()
+        self.assertEqual(report["learn"]["count"], len(SEQUENCE))
+        self.assertEqual(report["infer"]["count"], 1)
+        self.assertTrue(report["learn"]["p50_ms"] <= report["learn"]["p99_ms"] <= report["learn"]["max_ms"])
+        # Every learning step is over budget before learning starts: segment learning
+        # is deferred (the oldest skipped past 4 steps), duty cycles still update,
+        # boost / radius updates are queued
+        n_learning = len(SEQUENCE) * len(b.regions)
+        self.assertEqual(report["degraded"]["learning_deferred"], n_learning)
+        self.assertEqual(report["degraded"]["learning_skipped"], n_learning - 4 * len(b.regions))
+        self.assertEqual(report["degraded"]["boost_deferred"], n_learning)
+        self.assertEqual(report["degraded"]["radius_deferred"], n_learning)
+        self.assertEqual(report["degraded"]["degraded_steps"], len(SEQUENCE))
+        self.assertEqual(report["pending"], 6 * len(b.regions))
+        self.assertEqual(b.pending(b.regions[0], "learning"), 4)
+        self.assertEqual([r.permanence_stats.perm_sum for r in b.regions], permanences)
+        self.assertTrue(all([r.active_duty_cycle.any() for r in b.regions]))
+        # Deferred work runs on catch up, learning of each region in step order
+        # and before its boost / radius updates
+        reference = copy.deepcopy(b)
+        self.assertEqual([key[1:] for key in reference.catch_up_queue if key[0] == 0],
+                         [("learning", t) for t in range(12, 16)] + [("boost", None), ("radius", None)])
+        for (index, task, t), args in reference.catch_up_queue.items():
+            region = reference.regions[index]
+            if task == "learning":
+                region.replay_learning(*args)
+            elif task == "boost":
+                region.update_boosts(*args)
+            else:
+                region.update_inhibition_radius()
+        self.assertEqual(b.catch_up(), 6 * len(b.regions))
+        self.assertEqual(b.latency_report()["pending"], 0)
+        for r, r_reference in zip(b.regions, reference.regions):
+            self.assertTrue(np.array_equal(r.boost, r_reference.boost))
+            self.assertEqual(r.inhibition_radius, r_reference.inhibition_radius)
+            self.assertEqual(r.permanence_stats.perm_sum, r_reference.permanence_stats.perm_sum)
+        self.assertNotEqual([r.permanence_stats.perm_sum for r in b.regions], permanences)
+
+    def testLatencyBudgetSkipLearning(self):
+        b = small_brain(STEP_LATENCY_BUDGET=1e-9, STEP_BUDGET_SKIP_LEARNING=True)
+        permanences = [r.permanence_stats.perm_sum.copy() for r in b.regions]
+        for c in SEQUENCE:
+            b.process(encode(c), learning=True)
+        report = b.latency_report()
+        n_learning = len(SEQUENCE) * len(b.regions)
+        self.assertEqual(report["degraded"]["learning_skipped"], n_learning)
+        self.assertEqual(report["degraded"]["learning_deferred"], 0)
+        self.assertEqual(report["pending"], 2 * len(b.regions))
+        self.assertEqual([r.permanence_stats.perm_sum for r in b.regions], permanences)
+
+    def testDeferredLearningReplay(self):
+        direct, deferred = small_brain(CHANCE_OF_INHIBITORY=0.2), small_brain(CHANCE_OF_INHIBITORY=0.2)
+        for c in SEQUENCE:
+            direct.process(encode(c), learning=True)
+            deferred.process(encode(c), learning=True)
+        # Defer all learning of one step, then replay it once activations moved on
+        deferred.CONFIG["STEP_LATENCY_BUDGET"] = 1e-9
+        direct.process(encode("A"), learning=True)
+        deferred.process(encode("A"), learning=True)
+        self.assertEqual(deferred.pending(task="learning"), len(deferred.regions))
+        self.assertNotEqual([r.permanence_stats.perm_sum for r in direct.regions], [r.permanence_stats.perm_sum for r in deferred.regions])
+        self.assertEqual(deferred.catch_up(), 3 * len(deferred.regions))
+        for r_direct, r_deferred in zip(direct.regions, deferred.regions):
+            for seg_direct, seg_deferred in zip([seg for cell in r_direct.cells for seg in cell.all_segments()], [seg for cell in r_deferred.cells for seg in cell.all_segments()]):
+                self.assertEqual(list(seg_direct.syn_permanences), list(seg_deferred.syn_permanences))
+                self.assertEqual(list(seg_direct.syn_contribution), list(seg_deferred.syn_contribution))
+            self.assertTrue(np.array_equal(r_direct.boost, r_deferred.boost))
+            self.assertEqual(r_direct.inhibition_radius, r_deferred.inhibition_radius)
+            self.assertTrue(np.array_equal(r_direct.activation, r_deferred.activation))
+        # Under budget again, pending learning of a region runs before its next step's
+        deferred.CONFIG["STEP_LATENCY_BUDGET"] = 1e-9
+        deferred.process(encode("B"), learning=True)
+        deferred.CONFIG["STEP_LATENCY_BUDGET"] = 0.0
+        deferred.process(encode("C"), learning=True)
+        self.assertEqual(deferred.pending(), 0)
+
+    def testCatchUp(self):
+        direct, deferred = small_brain(), small_brain()
+        for c in SEQUENCE:
+            direct.process(encode(c), learning=True)
+            deferred.process(encode(c), learning=True)
+        r_direct, r_deferred = direct.regions[0], deferred.regions[0]
+        prior = np.copy(r_direct.active_duty_cycle) * 0.5
+        r_direct.update_boosts(prior)
+        r_direct.update_inhibition_radius()
+        deferred.defer(r_deferred, "boost", np.zeros(r_deferred.n_cells))
+        deferred.defer(r_deferred, "boost", prior)  # Replaces pending boost
+        deferred.defer(r_deferred, "radius")
+        self.assertEqual(deferred.latency_report()["pending"], 2)
+        self.assertEqual(deferred.catch_up(), 2)
+        self.assertTrue(np.array_equal(r_direct.boost, r_deferred.boost))
+        self.assertEqual(r_direct.inhibition_radius, r_deferred.inhibition_radius)
+        self.assertEqual(deferred.degraded["caught_up"], 2)
+
+    def testMetrics(self):
+        path = tempfile.mkdtemp()
+        try:
+            b = small_brain()
+            predictor = PPHTMPredictor(b, categories=CATS)
+            predictor.initialize()
+            checkpointer = DeltaCheckpointer(b, os.path.join(path, "ckpt"))
+            exporter = MetricsExporter(b, predictor=predictor, checkpointer=checkpointer)
+            host, port = exporter.serve(port=0)
+            for i, c in enumerate(SEQUENCE):
+                b.process(encode(c), learning=True)
+                predictor.read(c)
+                predictor.predict()
+                if i == 9:
+                    checkpointer.checkpoint()
+            exporter.write_file(os.path.join(path, "pphtm.prom"))
+            with open(os.path.join(path, "pphtm.prom")) as f:
+                lines = f.read().splitlines()
+            served = urllib2.urlopen("http://%s:%d/metrics" % (host, port)).read().splitlines()
+            exporter.close()
+            samples = dict(line.rsplit(" ", 1) for line in lines if not line.startswith("#"))
+            self.assertEqual(samples["pphtm_steps_total"], str(len(SEQUENCE)))
+            self.assertEqual(samples["pphtm_checkpoint_lag_steps"], str(len(SEQUENCE) - 10))
+            self.assertEqual(samples["pphtm_predictions_total"], str(len(SEQUENCE) - 1))
+            self.assertEqual(float(samples["pphtm_prediction_accuracy"]), predictor.accuracy())
+            self.assertTrue(int(samples['pphtm_synapses{region="0",segment_type="proximal"}']) > 0)
+            self.assertTrue(float(samples['pphtm_phase_mean_seconds{phase="overlap",region="0"}']) > 0)
+            self.assertTrue('pphtm_region_events_total{counter="cells_boosted",region="0"}' in samples)
+            self.assertTrue("pphtm_steps_total %d" % len(SEQUENCE) in served)
+            self.assertEqual([line for line in served if line.startswith("# TYPE")], [line for line in lines if line.startswith("# TYPE")])
+        finally:
+            shutil.rmtree(path)
+
+    def testMetricsRatePerConsumer(self):
+        b = small_brain()
+        exporter = MetricsExporter(b)
+
+        def rate(consumer):
+            for metric in exporter.collect(consumer=consumer):
+                if metric.name == "pphtm_steps_per_second":
+                    return metric.samples[0][2]
+
+        self.assertEqual(rate("file"), None)
+        since, n_before = exporter.last_scrape["file"]
+        for c in SEQUENCE[:4]:
+            b.process(encode(c), learning=True)
+        self.assertEqual(rate("http"), None)  # Doesn't reset the file window
+        for c in SEQUENCE[4:8]:
+            b.process(encode(c), learning=True)
+        file_rate = rate("file")
+        now, n_after = exporter.last_scrape["file"]
+        self.assertEqual(n_after - n_before, 8)
+        self.assertAlmostEqual(file_rate, 8 / (now - since))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+import os
+import tempfile
+import unittest
+import profiling
+from testing_pphtm import small_brain, encode, SEQUENCE
+
+
+class ProfilingTestCase(unittest.TestCase):
+
+    def run_profiled(self, mode):
+        b = small_brain()
+        b.profiler = profiling.Profiler(every=4, mode=mode)
+        for c in SEQUENCE:
+            b.process(encode(c), learning=True)
+        self.assertEqual(b.t, len(SEQUENCE))
+        self.assertEqual(b.profiler.n_calls, len(SEQUENCE))
+        self.assertEqual(b.profiler.n_profiled, len(SEQUENCE) / 4)
+        return b.profiler
+
+    def testDeterministic(self):
+        profiler = self.run_profiled("deterministic")
+        lines = profiler.collapsed()
+        stack, value = lines[0].rsplit(" ", 1)
+        self.assertTrue(int(value) > 0)
+        self.assertTrue(stack.startswith("_process (pphtm_brain.py"))
+        self.assertTrue(any(["tempero_spatial_pooling" in line for line in lines]))
+        fd, path = tempfile.mkstemp(suffix=".folded")
+        os.close(fd)
+        try:
+            profiler.dump(path)
+            with open(path) as f:
+                self.assertEqual(f.read().splitlines(), lines)
+        finally:
+            os.remove(path)
+
+    def testSampling(self):
+        profiler = self.run_profiled("sampling")
+        self.assertTrue(sum(profiler.stacks.values()) > 0)
+        self.assertTrue(all([stack[0].startswith("_process") for stack in profiler.stacks]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+#!/usr/bin/python
+# -*- coding: utf8 -*-
+
+import unittest
+import tracing
+from tracing import lazy
+
+
+class TracingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.records = []
+        self.calls = []
+        # Tracer levels are global, restore them for later tests
+        self.levels = dict((module, tracer.level) for module, tracer in tracing._tracers.items())
+        tracing.add_sink(self.records.append)
+        tracing.remove_sink(tracing.print_sink)
+        self.tracer = tracing.get_tracer("testing")
+        tracing.set_level("testing", 1)
+
+    def tearDown(self):
+        tracing.remove_sink(self.records.append)
+        tracing.add_sink(tracing.print_sink)
+        for module, tracer in tracing._tracers.items():
+            tracer.level = self.levels.get(module, 0)
+
+    def expensive(self, value):
+        self.calls.append(value)
+        return value
+
+    def testLazyFormatting(self):
+        self.tracer.log("%s << Bias", lazy(self.expensive, "0101"), level=2)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(self.records, [])
+        self.tracer.log("%s << Bias", lazy(self.expensive, "0101"))
+        self.assertEqual(self.calls, ["0101"])
+        self.assertEqual(self.records[0]["message"], "0101 << Bias")
+        self.assertEqual(self.records[0]["module"], "testing")
+
+    def testEventsAndLevels(self):
+        tracing.set_level("testing", 3)
+        self.tracer.event("boost", level=3, region=0, n_boosted=lazy(self.expensive, 4))
+        self.assertEqual(self.records[0]["fields"], {"region": 0, "n_boosted": 4})
+        tracing.quiet()
+        self.assertFalse(self.tracer.enabled(1))
+        self.tracer.event("boost", region=0, n_boosted=lazy(self.expensive, 5))
+        self.assertEqual(self.calls, [4])
+        self.assertEqual(len(self.records), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,9 +4,11 @@ from os import path
 sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
 from pphtm.pphtm_brain import PPHTMBrain
 from pphtm.pphtm_predictor import PPHTMPredictor
+from pphtm.pphtm_metrics import MetricsExporter
 from datetime import datetime
 import numpy as np
 import util
+import profiling
 import random
 from encoders import SimpleFullWidthEncoder
 from helpers.file_processer import FileProcesser
@@ -127,7 +129,7 @@ class SwarmRunner(object):
 
     def _encode_letter(self, c):
         i = ord(c.upper()) - 65 # A == 0
-        return self.encoder.encode(i)
+        return self.encoder.encode_sparse(i)
 
     def _choose_params(self):
         params = {}
@@ -224,8 +226,8 @@ class SwarmRunner(object):
 
     def process(self, char):
         # Process one step
-        inputs = self._encode_letter(char)
-        self.b.process(inputs, learning=True)
+        active_inputs = self._encode_letter(char)
+        self.b.process_sparse(active_inputs, learning=True)
         self.classifier.read(char)
         prediction = self.classifier.predict()
         return prediction
@@ -285,9 +287,9 @@ def log(message, level=1):
 
 
 def main(argv):
-    HELP = 'swarm_pphtm.py -i <iterations> -c <crop> -f <file>'
+    HELP = 'swarm_pphtm.py -i <iterations> -c <crop> -f <file> -p <profile output> --profile-every <n> --profile-mode <deterministic|sampling> --metrics-port <port> --metrics-file <path>'
     try:
-        opts, args = getopt.getopt(argv,"hi:c:",["iterations=","crop="])
+        opts, args = getopt.getopt(argv,"hi:c:p:",["iterations=","crop=","profile=","profile-every=","profile-mode=","metrics-port=","metrics-file="])
     except getopt.GetoptError:
         print HELP
         sys.exit(2)
@@ -297,6 +299,8 @@ def main(argv):
         'crop': 300,
         'filename': "longer_char_sequences2.txt"
     }
+    profile = {'path': None, 'every': 10, 'mode': "sampling"}
+    metrics = {'port': None, 'file': None}
     for opt, arg in opts:
         if opt == '-h':
             print HELP
@@ -307,8 +311,28 @@ def main(argv):
             kwargs['crop'] = int(arg)
         elif opt in ("-f", "--file"):
             kwargs['filename'] = arg
+        elif opt in ("-p", "--profile"):
+            profile['path'] = arg
+        elif opt == "--profile-every":
+            profile['every'] = int(arg)
+        elif opt == "--profile-mode":
+            profile['mode'] = arg
+        elif opt == "--metrics-port":
+            metrics['port'] = int(arg)
+        elif opt == "--metrics-file":
+            metrics['file'] = arg
     swarm = SwarmRunner(**kwargs)
+    if profile['path']:
+        swarm.b.profiler = profiling.Profiler(every=profile['every'], mode=profile['mode'])
+    exporter = MetricsExporter(swarm.b, predictor=swarm.classifier)
+    if metrics['port'] is not None:
+        print "Serving metrics at http://%s:%d/metrics" % exporter.serve(port=metrics['port'])
+    if metrics['file']:
+        exporter.start_file_writer(metrics['file'])
     swarm.run()
+    exporter.close()
+    if profile['path']:
+        print "Wrote profile of %d steps to %s" % (swarm.b.profiler.n_profiled, swarm.b.profiler.dump(profile['path']))
 
 if __name__ == "__main__":
    main(sys.argv[1:])
\ No newline at end of file
@@ -5,7 +5,9 @@ sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
 from pphtm.pphtm_brain import PPHTMBrain
 from chtm.chtm_printer import CHTMPrinter
 from pphtm.pphtm_predictor import PPHTMPredictor
+from pphtm.pphtm_metrics import MetricsExporter
 from helpers.file_processer import FileProcesser
+import profiling
 import numpy as np
 
 from nupic.encoders.scalar import ScalarEncoder
@@ -117,9 +119,9 @@ class TestRunner(object):
 
 
 def main(argv):
-    HELP = 'test_pphtm.py -c <crop> -f <file>'
+    HELP = 'test_pphtm.py -c <crop> -f <file> -p <profile output> --profile-every <n> --profile-mode <deterministic|sampling> --metrics-port <port> --metrics-file <path>'
     try:
-        opts, args = getopt.getopt(argv,"hi:c:",["iterations=","crop="])
+        opts, args = getopt.getopt(argv,"hi:c:p:",["iterations=","crop=","profile=","profile-every=","profile-mode=","metrics-port=","metrics-file="])
     except getopt.GetoptError:
         print HELP
         sys.exit(2)
@@ -128,6 +130,8 @@ def main(argv):
         'crop': 400,
         'filename': "longer_char_sequences1.txt" # "simple_pattern2.txt"
     }
+    profile = {'path': None, 'every': 10, 'mode': "sampling"}
+    metrics = {'port': None, 'file': None}
     for opt, arg in opts:
         if opt == '-h':
             print HELP
@@ -136,8 +140,28 @@ def main(argv):
             kwargs['crop'] = int(arg)
         elif opt in ("-f", "--file"):
             kwargs['filename'] = arg
+        elif opt in ("-p", "--profile"):
+            profile['path'] = arg
+        elif opt == "--profile-every":
+            profile['every'] = int(arg)
+        elif opt == "--profile-mode":
+            profile['mode'] = arg
+        elif opt == "--metrics-port":
+            metrics['port'] = int(arg)
+        elif opt == "--metrics-file":
+            metrics['file'] = arg
     processor = TestRunner(animate=True, with_classifier=True, **kwargs)
+    if profile['path']:
+        processor.b.profiler = profiling.Profiler(every=profile['every'], mode=profile['mode'])
+    exporter = MetricsExporter(processor.b, predictor=processor.classifier)
+    if metrics['port'] is not None:
+        print "Serving metrics at http://%s:%d/metrics" % exporter.serve(port=metrics['port'])
+    if metrics['file']:
+        exporter.start_file_writer(metrics['file'])
     processor.run()
+    exporter.close()
+    if profile['path']:
+        print "Wrote profile of %d steps to %s" % (processor.b.profiler.n_profiled, processor.b.profiler.dump(profile['path']))
 
 if __name__ == "__main__":
    main(sys.argv[1:])
\ No newline at end of file
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# Lazy logging / tracing for the brain modules (htm, chtm, pphtm)
+#
+# Each module gets a Tracer with its own level. A message is only formatted,
+# and lazy arguments only evaluated, when the tracer's level reaches the
+# message level and at least one sink is attached. Setting a module's level
+# to 0 (or calling quiet()) reduces logging to a single comparison.
+#
+#   tracer = tracing.get_tracer("pphtm", level=1)
+#   tracer.log("Initialized %s", self)  # %s formatted only if enabled
+#   tracer.log("%s << Bias", tracing.lazy(printarray, bias), level=2)
+#   tracer.event("boost", level=2, region=0, n_boosted=lazy(count))
+#   if tracer.enabled(1): ... expensive aggregation ...
+
+import time
+
+_tracers = {}
+_sinks = []
+
+
+class lazy(object):
+    '''
+    Deferred value: fn(*args, **kwargs) is called when formatted (str / %s)
+    or when an event is emitted
+    '''
+
+    def __init__(self, fn, *args, **kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self):
+        return self.fn(*self.args, **self.kwargs)
+
+    def __str__(self):
+        return str(self())
+
+
+def _evaluate(value):
+    return value() if isinstance(value, lazy) else value
+
+
+def print_sink(record):
+    '''
+    Default sink: prints messages (and events as name key=value ...)
+    '''
+    if record["message"] is not None:
+        print record["message"]
+    else:
+        print "%s %s" % (record["name"], " ".join(["%s=%s" % (k, v) for k, v in sorted(record["fields"].items())]))
+
+
+class Tracer(object):
+
+    def __init__(self, module, level=0):
+        self.module = module
+        self.level = level
+
+    def enabled(self, level=1):
+        return self.level >= level and bool(_sinks)
+
+    def _emit(self, level, name, message, fields):
+        record = {"module": self.module, "level": level, "name": name, "message": message, "fields": fields, "time": time.time()}
+        for sink in _sinks:
+            sink(record)
+
+    def log(self, message, *args, **kwargs):
+        '''
+        Log message at level (keyword, default 1), formatted with args only if enabled
+        '''
+        level = kwargs.get("level", 1)
+        if self.level < level or not _sinks:
+            return
+        if args:
+            message = message % args
+        self._emit(level, "log", message, {})
+
+    def event(self, name, level=1, **fields):
+        '''
+        Structured event, lazy field values are evaluated only if enabled
+        '''
+        if self.level < level or not _sinks:
+            return
+        self._emit(level, name, None, dict((k, _evaluate(v)) for k, v in fields.items()))
+
+
+def get_tracer(module, level=0):
+    '''
+    Returns the module's Tracer (level only applies when first created)
+    '''
+    if module not in _tracers:
+        _tracers[module] = Tracer(module, level=level)
+    return _tracers[module]
+
+
+def set_level(module, level):
+    get_tracer(module).level = level
+
+
+def quiet():
+    '''
+    Disable logging of all modules
+    '''
+    for tracer in _tracers.values():
+        tracer.level = 0
+
+
+def add_sink(sink):
+    '''
+    sink(record) receives dicts with module, level, name, message (log) or fields (event) and time
+    '''
+    _sinks.append(sink)
+
+
+def remove_sink(sink):
+    _sinks.remove(sink)
+
+
+add_sink(print_sink)